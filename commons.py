@@ -1,7 +1,24 @@
+from collections import deque
+
+
 def chunker(seq, size):
     return (seq[pos:pos + size] for pos in range(0, len(seq), size))
 
 
+def imap_bounded(pool, func, items, max_pending):
+    """
+    Results of func over items by the pool in order, as pool.imap,
+    but a task is submitted only when fewer than max_pending results are waiting to be taken.
+    """
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item, )))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
 ensemble_models = {
     'stage1_test': {
         'rcnn': [
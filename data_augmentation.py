@@ -8,31 +8,117 @@ from scipy.ndimage import gaussian_filter, map_coordinates
 from hyperparams import HyperParams
 
 
+def map_masks(data, func, label_func=None):
+    """
+    Apply a function to every mask, or once to the label image if the data has one.
+    :param data: CellImageData
+    :param func: function for a (h, w) uint8 binary mask
+    :param label_func: function for a (h, w) int32 label image. 'func' is used if not specified.
+    :return: CellImageData
+    """
+    if data.label is not None:
+        data.label = (label_func or func)(data.label)
+    else:
+        data.masks = [func(mask) for mask in data.masks]
+    return data
+
+
+def masks_to_label(masks, shape):
+    """
+    :param masks: list of (h, w) binary masks
+    :return: (h, w) int32 label image. an earlier mask wins on overlapped pixels.
+    """
+    label = np.zeros(shape[:2], dtype=np.int32)
+    idx = 0
+    for mask in masks:
+        region = np.logical_and(mask > 0, label == 0)
+        if not np.any(region):
+            continue
+        idx += 1
+        label[region] = idx
+    return label
+
+
+def record_aug(data, op):
+    """
+    Keep track of geometric augmentations applied to masks, to identify the result (eg. to cache unet weights).
+    :param data: CellImageData
+    :param op: tuple of the operation name and its parameters. None if it can not be reproduced.
+    """
+    if data.aug_history is None or op is None:
+        data.aug_history = None
+    else:
+        data.aug_history.append(op)
+
+
 def erosion_mask(data):
     """
     As described in the original paper, Separation between cluttered cells is enhanced by using morphological algorithm.
+    Every instance is eroded at once on the label image, whose instances never overlap.
+    Overlapped masks are eroded one by one instead, where a mask loses pixels of the earlier eroded ones.
 
     :param data: CellImageData
     :return: CellImageData
     """
-    if len(data.masks) == 0:
-        return data
-    total_map = np.zeros_like(data.masks[0], dtype=np.uint8)
-    masks = []
-    for mask in data.masks:
-        mask[total_map > 0] = 0
-        mask = ndimage.morphology.binary_erosion(
-            (mask > 0),
-            border_value=1,
-            iterations=HyperParams.get().pre_erosion_iter
-        ).astype(np.uint8)
-        total_map = total_map + mask
-
-        masks.append(mask)
-    data.masks = masks
+    if data.label is None:
+        if len(data.masks) == 0:
+            return data
+        if masks_overlap(data.masks):
+            data.label = erode_masks(data.masks, HyperParams.get().pre_erosion_iter)
+            record_aug(data, ('erosion', HyperParams.get().pre_erosion_iter))
+            return data
+        data.label = masks_to_label(data.masks, data.masks[0].shape)
+    data.label = erode_label(data.label, HyperParams.get().pre_erosion_iter)
+    record_aug(data, ('erosion', HyperParams.get().pre_erosion_iter))
     return data
 
 
+def masks_overlap(masks):
+    """
+    :return: True if any pixel is in more than one mask
+    """
+    total = np.zeros(masks[0].shape[:2], dtype=np.int32)
+    for mask in masks:
+        total += mask > 0
+    return total.max() > 1
+
+
+def erode_masks(masks, iterations=1):
+    """
+    Erode overlapped masks one by one, as binary_erosion(border_value=1, iterations) on each mask
+    after removing pixels of the earlier eroded masks.
+    :param masks: list of (h, w) binary masks
+    :return: (h, w) int32 label image
+    """
+    label = np.zeros(masks[0].shape[:2], dtype=np.int32)
+    idx = 0
+    for mask in masks:
+        region = np.logical_and(mask > 0, label == 0)
+        if iterations > 0:
+            region = ndimage.binary_erosion(region, border_value=1, iterations=iterations)
+        if not np.any(region):
+            continue
+        idx += 1
+        label[region] = idx
+    return label
+
+
+def erode_label(label, iterations=1):
+    """
+    Erode every instance of a label image, as binary_erosion(border_value=1, iterations) with the cross structure
+    on each mask. A pixel remains only if all pixels in the diamond of the radius are in the same instance.
+    :param label: (h, w) int label image
+    :return: (h, w) int32 label image
+    """
+    label = label.astype(np.int32)
+    if iterations <= 0:
+        return label
+    footprint = ndimage.iterate_structure(ndimage.generate_binary_structure(2, 1), iterations)
+    lower = ndimage.grey_erosion(label, footprint=footprint, mode='constant', cval=np.iinfo(np.int32).max)
+    upper = ndimage.grey_dilation(label, footprint=footprint, mode='constant', cval=0)
+    return np.where((lower == label) & (upper == label), label, 0).astype(np.int32)
+
+
 def random_flip_lr(data):
     """
     randomly flip(50%) horizontally
@@ -63,7 +149,8 @@ def flip(data, orientation=0):
     """
     # flip
     data.img = cv2.flip(data.img, orientation)
-    data.masks = [cv2.flip(mask, orientation) for mask in data.masks]
+    map_masks(data, lambda mask: cv2.flip(mask, orientation))
+    record_aug(data, ('flip', orientation))
     return data
 
 
@@ -88,7 +175,8 @@ def pad_if_small(data, target_size):
         return data
 
     data.img = crop_mirror(data.img, 0, 0, img_w, img_h, padding)
-    data.masks = [crop_mirror(mask, 0, 0, img_w, img_h, padding) for mask in data.masks]
+    map_masks(data, lambda mask: crop_mirror(mask, 0, 0, img_w, img_h, padding))
+    record_aug(data, ('pad', padding))
     return data
 
 
@@ -99,14 +187,25 @@ def resize_shortedge(data, target_size):
     :return: CellImageData
     """
     img_h, img_w = data.img.shape[:2]
+    new_w, new_h = get_shortedge_size(img_w, img_h, target_size)
+    data.img = cv2.resize(data.img, (new_w, new_h), interpolation=cv2.INTER_AREA)
+    map_masks(data,
+              lambda mask: cv2.resize(mask, (new_w, new_h), interpolation=cv2.INTER_AREA),
+              lambda label: cv2.resize(label, (new_w, new_h), interpolation=cv2.INTER_NEAREST))
+    record_aug(data, ('resize', new_w, new_h))
+    return data
+
+
+def get_shortedge_size(img_w, img_h, target_size):
+    """
+    :return: (w, h) resized as the shorter axis would be the same size of the target.
+    """
     scale = target_size / min(img_h, img_w)
     if img_h < img_w:
         new_h, new_w = target_size, round(scale * img_w)
     else:
         new_h, new_w = round(scale * img_h), target_size
-    data.img = cv2.resize(data.img, (new_w, new_h), interpolation=cv2.INTER_AREA)
-    data.masks = [cv2.resize(mask, (new_w, new_h), interpolation=cv2.INTER_AREA) for mask in data.masks]
-    return data
+    return new_w, new_h
 
 
 def random_crop(data, w, h, padding=0):
@@ -121,6 +220,7 @@ def random_crop(data, w, h, padding=0):
     y = random.randint(0, img_h - h)
 
     crop(data, x, y, w, h, padding=padding)
+    record_aug(data, None)
 
     return data
 
@@ -159,7 +259,8 @@ def crop(data, x, y, w, h, padding=0):
     assert img_h >= y+h and img_w >= x+w, 'w=%d, h=%d' % (img_w, img_h)
 
     data.img = crop_mirror(data.img, x, y, w, h, padding)
-    data.masks = [mask[y:y + h, x:x + w] for mask in data.masks]
+    map_masks(data, lambda mask: mask[y:y + h, x:x + w])
+    record_aug(data, ('crop', x, y, w, h))
 
     img_h2, img_w2 = data.img.shape[:2]
     assert img_h2 == h+padding*2 and img_w2 == w+padding*2, 'w=%d->%d, h=%d->%d, target=(%d, %d) padding=%d' % (img_w, img_w2, img_h, img_h2, w, h, padding)
@@ -169,10 +270,7 @@ def crop(data, x, y, w, h, padding=0):
 
 
 def mirror_pad(img, padding):
-    if len(img.shape) == 3:
-        padded_img = np.array([np.pad(ch, padding, 'reflect') for ch in img.transpose((2, 0, 1))]).transpose((1, 2, 0))
-    else:
-        padded_img = np.pad(img, padding, 'reflect')
+    padded_img = crop_mirror(img, 0, 0, img.shape[1], img.shape[0], padding)
     assert padded_img.shape[0] == img.shape[0] + padding * 2, (img.shape, padded_img.shape)
     assert padded_img.shape[1] == img.shape[1] + padding * 2, (img.shape, padded_img.shape)
     if len(img.shape) == 3:
@@ -180,12 +278,34 @@ def mirror_pad(img, padding):
     return padded_img
 
 
+def reflect_indices(start, length, size):
+    """
+    :return: indices of [start, start + length) on an axis of the size, reflected at borders as np.pad(mode='reflect')
+    """
+    indices = np.arange(start, start + length)
+    if size == 1:
+        return np.zeros_like(indices)
+    period = 2 * (size - 1)
+    indices = np.mod(indices, period)
+    return np.where(indices < size, indices, period - indices)
+
+
 def crop_mirror(img, x, y, w, h, padding=0):
+    """
+    Crop (w + padding * 2, h + padding * 2) window around (x, y, w, h), whose regions out of the image are mirrored.
+    Only the window is read, not the whole padded image.
+    """
     assert x >= 0 and y >= 0 and w > 0 and h > 0
 
-    mirror_padded = mirror_pad(img, padding)
-    cropped_img = mirror_padded[y:y+h+padding*2, x:x+w+padding*2]
-    return cropped_img
+    img_h, img_w = img.shape[:2]
+    x1, y1 = x - padding, y - padding
+    x2, y2 = x + w + padding, y + h + padding
+    if x1 >= 0 and y1 >= 0 and x2 <= img_w and y2 <= img_h:
+        return img[y1:y2, x1:x2].copy()
+
+    rows = reflect_indices(y1, min(y2, img_h + padding) - y1, img_h)
+    cols = reflect_indices(x1, min(x2, img_w + padding) - x1, img_w)
+    return img[np.ix_(rows, cols)]
 
 
 def random_scaling(data):
@@ -194,19 +314,34 @@ def random_scaling(data):
     :param data: CellImageData
     :return: CellImageData
     """
+    img_h, img_w = data.img.shape[:2]
+    new_size = get_random_scaling_size(img_w, img_h)
+    if new_size is None:
+        return data
+    new_w, new_h = new_size
+
+    data.img = cv2.resize(data.img, (new_w, new_h), interpolation=cv2.INTER_AREA)
+    map_masks(data,
+              lambda mask: cv2.resize(mask, (new_w, new_h), interpolation=cv2.INTER_AREA),
+              lambda label: cv2.resize(label, (new_w, new_h), interpolation=cv2.INTER_NEAREST))
+    data.img_w, data.img_h = new_w, new_h
+    record_aug(data, None)
+    return data
+
+
+def get_random_scaling_size(img_w, img_h):
+    """
+    Draw the random size of random_scaling.
+    :return: (w, h) or None if not scaled.
+    """
     s = random.randint(0, 1)
     if s <= 0:
-        return data
-    img_h, img_w = data.img.shape[:2]
+        return None
     scale_f1 = HyperParams.get().pre_scale_f1
     scale_f2 = HyperParams.get().pre_scale_f2
     new_w = int(random.uniform(1.-scale_f1, 1.+scale_f2) * img_w)
     new_h = int(random.uniform(1.-scale_f1, 1.+scale_f2) * img_h)
-
-    data.img = cv2.resize(data.img, (new_w, new_h), interpolation=cv2.INTER_AREA)
-    data.masks = [cv2.resize(mask, (new_w, new_h), interpolation=cv2.INTER_AREA) for mask in data.masks]
-    data.img_w, data.img_h = new_w, new_h
-    return data
+    return new_w, new_h
 
 
 def random_affine(data):
@@ -215,16 +350,173 @@ def random_affine(data):
     :param data: CellImageData
     :return: CellImageData
     """
+    params = get_random_affine_params()
+    if params is None:
+        return data
+    rand_rotate, rand_shear, rand_translate = params
+
+    aug = iaa.Affine(scale=1.0, translate_percent=rand_translate, rotate=rand_rotate, shear=rand_shear, cval=0, mode='reflect')
+    aug_label = iaa.Affine(scale=1.0, translate_percent=rand_translate, rotate=rand_rotate, shear=rand_shear, cval=0, mode='reflect', order=0)
+    data.img = aug.augment_image(data.img)
+    map_masks(data, aug.augment_image, aug_label.augment_image)
+    record_aug(data, None)
+    return data
+
+
+def get_random_affine_params():
+    """
+    Draw the random parameters of random_affine.
+    :return: (rotate, shear, translate) or None if not transformed.
+    """
     s = random.randint(0, 2)
     if s >= 1:
-        return data
+        return None
     rand_rotate = np.random.randint(-HyperParams.get().pre_affine_rotate, HyperParams.get().pre_affine_rotate)
     rand_shear = np.random.randint(-HyperParams.get().pre_affine_shear, HyperParams.get().pre_affine_shear)
     rand_translate = np.random.uniform(-HyperParams.get().pre_affine_translate, HyperParams.get().pre_affine_translate)
+    return rand_rotate, rand_shear, rand_translate
 
-    aug = iaa.Affine(scale=1.0, translate_percent=rand_translate, rotate=rand_rotate, shear=rand_shear, cval=0, mode='reflect')
-    data.img = aug.augment_image(data.img)
-    data.masks = [aug.augment_image(mask) for mask in data.masks]
+
+class GeometricTransform:
+    """
+    Accumulate geometric augmentations(affine, resize, crop, flip) into a single affine matrix,
+    so an image and its label map are warped only once, directly into the final crop,
+    instead of resizing, padding and cropping the whole image and every mask at each step.
+
+    Bilinear warping aliases when it shrinks an image a lot, so an image downscaled below MIN_WARP_SCALE
+    is resized by area first, as resize_shortedge does, and warped for the rest of the transform.
+    """
+    MIN_WARP_SCALE = 0.5
+
+    def __init__(self, img_w, img_h):
+        # source -> current coordinates, in pixel centers
+        self.matrix = np.eye(3)
+        self.w, self.h = img_w, img_h
+
+    def _push(self, matrix, w, h):
+        self.matrix = np.dot(matrix, self.matrix)
+        self.w, self.h = w, h
+        return self
+
+    def affine(self, rotate, shear, translate):
+        """
+        Same as iaa.Affine(translate_percent=translate, rotate=rotate, shear=shear), around the center.
+        """
+        shift_x, shift_y = self.w / 2.0 - 0.5, self.h / 2.0 - 0.5
+        rotate, shear = np.deg2rad(rotate), np.deg2rad(shear)
+        to_topleft = np.array([[1, 0, -shift_x], [0, 1, -shift_y], [0, 0, 1]])
+        transform = np.array([
+            [np.cos(rotate), -np.sin(rotate + shear), translate * self.w],
+            [np.sin(rotate), np.cos(rotate + shear), translate * self.h],
+            [0, 0, 1]
+        ])
+        to_center = np.array([[1, 0, shift_x], [0, 1, shift_y], [0, 0, 1]])
+        return self._push(np.dot(to_center, np.dot(transform, to_topleft)), self.w, self.h)
+
+    def resize(self, new_w, new_h):
+        sx, sy = new_w / self.w, new_h / self.h
+        return self._push(np.array([[sx, 0, 0.5 * sx - 0.5], [0, sy, 0.5 * sy - 0.5], [0, 0, 1]]), new_w, new_h)
+
+    def resize_shortedge(self, target_size):
+        return self.resize(*get_shortedge_size(self.w, self.h, target_size))
+
+    def crop(self, x, y, w, h):
+        return self._push(np.array([[1, 0, -x], [0, 1, -y], [0, 0, 1]], dtype=np.float64), w, h)
+
+    def flip(self, orientation=0):
+        """
+        :param orientation: 0=vertical, 1=horizontal, as cv2.flip
+        """
+        if orientation == 0:
+            matrix = np.array([[1, 0, 0], [0, -1, self.h - 1], [0, 0, 1]], dtype=np.float64)
+        else:
+            matrix = np.array([[-1, 0, self.w - 1], [0, 1, 0], [0, 0, 1]], dtype=np.float64)
+        return self._push(matrix, self.w, self.h)
+
+    def warp(self, img, padding=0, interpolation=cv2.INTER_LINEAR):
+        """
+        :param padding: mirrored margin around the output, as crop_mirror
+        :return: (h + padding * 2, w + padding * 2) image
+        """
+        matrix = self.matrix
+        if interpolation != cv2.INTER_NEAREST:
+            # scales of the source axes
+            sx, sy = np.linalg.norm(matrix[:2, 0]), np.linalg.norm(matrix[:2, 1])
+            if min(sx, sy) < GeometricTransform.MIN_WARP_SCALE:
+                img_h, img_w = img.shape[:2]
+                new_w = max(1, int(round(img_w * min(sx, 1.0))))
+                new_h = max(1, int(round(img_h * min(sy, 1.0))))
+                img = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_AREA)
+                pre_matrix = GeometricTransform(img_w, img_h).resize(new_w, new_h).matrix
+                matrix = np.dot(matrix, np.linalg.inv(pre_matrix))
+        matrix = np.dot(np.array([[1, 0, padding], [0, 1, padding], [0, 0, 1]], dtype=np.float64), matrix)
+        return cv2.warpAffine(img, matrix[:2], (self.w + padding * 2, self.h + padding * 2),
+                              flags=interpolation, borderMode=cv2.BORDER_REFLECT_101)
+
+    def apply(self, data, padding=0):
+        """
+        Warp the image(with padding, bilinear) and masks(without padding, nearest) of CellImageData.
+        """
+        if data.label is None and len(data.masks) > 0:
+            data.label = masks_to_label(data.masks, data.img.shape)
+
+        data.img = self.warp(data.img, padding)
+        if data.label is not None:
+            data.label = self.warp(data.label, interpolation=cv2.INTER_NEAREST)
+        data.remove_redundant_masks()
+        return data
+
+
+def random_geometric(data, target_size, padding=0, affine=False):
+    """
+    Fused version of (random_affine), mask_size_normalize, resize_shortedge_if_small, random_crop,
+    random_flip_lr and random_flip_ud. Random parameters are drawn in the same order as those functions do,
+    and the image and masks are warped once.
+    :param data: CellImageData
+    :param target_size: size of the random crop
+    :param padding: mirrored margin of the image crop
+    :return: CellImageData
+    """
+    img_h, img_w = data.img.shape[:2]
+    transform = GeometricTransform(img_w, img_h)
+
+    if affine:
+        params = get_random_affine_params()
+        if params is not None:
+            transform.affine(*params)
+
+    # mask_size_normalize
+    s = random.randint(0, 1)
+    maximum_size = 0
+    if s > 0:
+        if data.label is not None:
+            maximum_size = get_max_size_of_label(data.label)
+        else:
+            maximum_size = get_max_size_of_masks(data.masks)
+    if maximum_size <= 1:
+        new_size = get_random_scaling_size(transform.w, transform.h)
+        if new_size is not None:
+            transform.resize(*new_size)
+    else:
+        transform.resize_shortedge(get_size_normalized_edge(min(transform.w, transform.h), maximum_size))
+
+    # resize_shortedge_if_small
+    if transform.h < target_size or transform.w < target_size:
+        transform.resize_shortedge(target_size)
+
+    # random_crop
+    x = random.randint(0, transform.w - target_size)
+    y = random.randint(0, transform.h - target_size)
+    transform.crop(x, y, target_size, target_size)
+
+    # random_flip_lr, random_flip_ud
+    if random.randint(0, 1) != 0:
+        transform.flip(orientation=1)
+    if random.randint(0, 1) != 0:
+        transform.flip(orientation=0)
+
+    transform.apply(data, padding)
+    record_aug(data, None)
     return data
 
 
@@ -334,6 +626,7 @@ def data_to_elastic_transform_wrapper(data):
     i, ms = data_to_elastic_transform(data, data.img.shape[1] * 2, data.img.shape[1] * 0.08, data.img.shape[1] * 0.08)
     data.img = i
     data.masks = ms
+    record_aug(data, None)
     return data
 
 
@@ -382,29 +675,41 @@ def data_to_elastic_transform(data, alpha, sigma, alpha_affine, random_state=Non
 
 
 def mask_size_normalize(data, target_size=None):
+    is_random = target_size is None
     s = random.randint(0, 1)
     if s <= 0 and target_size is None:
         data = random_scaling(data)
         return data
 
     # getting maximum size of masks
-    maximum_size = get_max_size_of_masks(data.masks)
+    if data.label is not None:
+        maximum_size = get_max_size_of_label(data.label)
+    else:
+        maximum_size = get_max_size_of_masks(data.masks)
     if maximum_size <= 1:
         return random_scaling(data)
 
+    target_edge_size = get_size_normalized_edge(min(data.img.shape[:2]), maximum_size, target_size)
+
+    data = resize_shortedge(data, target_edge_size)
+    if is_random:
+        record_aug(data, None)
+
+    return data
+
+
+def get_size_normalized_edge(shorter_edge_size, maximum_size, target_size=None):
+    """
+    :return: size of the shorter edge, with which the biggest instance would be the target size(random if None).
+    """
     # normalize by the target size
     if target_size is None:
         target_size = random.uniform(HyperParams.get().pre_size_norm_min, HyperParams.get().pre_size_norm_max)
-    shorter_edge_size = min(data.img.shape[:2])
     size_factor = target_size / maximum_size
     size_factor = min(3000 / shorter_edge_size, size_factor)
     size_factor = max(120 / shorter_edge_size, size_factor)
 
-    target_edge_size = int(shorter_edge_size * size_factor)
-
-    data = resize_shortedge(data, target_edge_size)
-
-    return data
+    return int(shorter_edge_size * size_factor)
 
 
 def get_rect_of_mask(img):
@@ -429,6 +734,19 @@ def get_max_size_of_masks(masks):
         maximum_size = max(maximum_size, size)
     return maximum_size
 
+
+def get_max_size_of_label(label):
+    """
+    same as get_max_size_of_masks, but for a label image.
+    """
+    maximum_size = 1  # in pixel
+    for rect in ndimage.find_objects(label):
+        if rect is None:
+            continue
+        size = max(rect[0].stop - rect[0].start, rect[1].stop - rect[1].start) - 1
+        maximum_size = max(maximum_size, size)
+    return maximum_size
+
 # TODO : Image Drop Augmentation, imgaug pepper? dropout? blur? constrast?
 # TODO : Thick line Occlusion, add/multiply some values? sharpen?
 
@@ -2,10 +2,12 @@ import unittest
 
 import cv2
 import numpy as np
+from scipy import ndimage
 
 from data_augmentation import resize_shortedge, random_crop, center_crop, resize_shortedge_if_small, \
     flip, data_to_elastic_transform, random_color2, mask_size_normalize, get_max_size_of_masks, crop, crop_mirror, \
-    random_add_thick_area, random_transparent
+    random_add_thick_area, random_transparent, GeometricTransform, erosion_mask, erode_label, erode_masks, \
+    masks_overlap, masks_to_label
 from data_feeder import CellImageData, master_dir_train
 
 
@@ -57,6 +59,12 @@ class TestAugmentation(unittest.TestCase):
         cropped = self.d.img[0:224, 0:224, :]
         self.assertTrue(np.array_equal(img, cropped))
 
+        # out of the image, as the mirror padded image
+        for x, y, w, h, padding in [(0, 0, 320, 256, 20), (300, 10, 20, 30, 44), (5, 250, 17, 6, 300)]:
+            padded = np.pad(self.d.img, ((padding, padding), (padding, padding), (0, 0)), 'reflect')
+            img = crop_mirror(self.d.img, x, y, w, h, padding)
+            self.assertTrue(np.array_equal(img, padded[y:y + h + padding * 2, x:x + w + padding * 2]))
+
     def test_resize_shortedge_if_small(self):
         # not changed, since its size is larger than target_size
         d = resize_shortedge_if_small(self.d, 224)
@@ -115,6 +123,60 @@ class TestAugmentation(unittest.TestCase):
         cv2.imshow('image', data.img)
         cv2.waitKey(0)
 
+    def test_erosion_mask(self):
+        expected = [ndimage.binary_erosion(mask > 0, border_value=1, iterations=1) for mask in self.d.masks]
+        d = erosion_mask(self.d)
+        self.assertEqual(d.label.dtype, np.int32)
+        for idx, mask in enumerate(expected):
+            self.assertTrue(np.array_equal(d.label == (idx + 1), mask))
+
+    def test_geometric_transform(self):
+        img = self.d.img
+        transform = GeometricTransform(img.shape[1], img.shape[0]).crop(30, 20, 100, 120).flip(orientation=1)
+        warped = transform.warp(img, padding=10)
+        expected = cv2.flip(crop_mirror(img, 30, 20, 100, 120, padding=10), 1)
+        self.assertTrue(np.array_equal(warped, expected))
+
+        transform = GeometricTransform(img.shape[1], img.shape[0]).resize(img.shape[1] * 2, img.shape[0] * 2)
+        resized = transform.warp(self.d.masks[0], interpolation=cv2.INTER_NEAREST)
+        self.assertTrue(np.array_equal(resized, cv2.resize(self.d.masks[0], None, fx=2, fy=2, interpolation=cv2.INTER_NEAREST)))
+
+
+class TestGeometricTransform(unittest.TestCase):
+    def test_warp_downscale(self):
+        # high frequency pattern, which aliases if it is shrunk by bilinear sampling only
+        img = np.random.RandomState(0).randint(0, 256, size=(400, 500, 3)).astype(np.uint8)
+        expected = cv2.resize(img, (150, 120), interpolation=cv2.INTER_AREA)[10:10 + 100, 20:20 + 100]
+        transform = GeometricTransform(img.shape[1], img.shape[0]).resize(150, 120).crop(20, 10, 100, 100)
+        warped = transform.warp(img)
+        self.assertLessEqual(np.abs(warped.astype(np.int32) - expected).max(), 1)
+
+
+class TestErosion(unittest.TestCase):
+    def test_erode_overlapped_masks(self):
+        masks = [np.zeros((40, 40), dtype=np.uint8) for _ in range(3)]
+        masks[0][5:20, 5:20] = 255
+        masks[1][12:30, 12:30] = 255
+        masks[2][32:38, 2:10] = 255
+        self.assertTrue(masks_overlap(masks))
+        self.assertFalse(masks_overlap([masks[0], masks[2]]))
+
+        # as the per-mask erosion, where an earlier eroded mask wins
+        total_map = np.zeros((40, 40), dtype=np.uint8)
+        expected = []
+        for mask in masks:
+            mask = mask.copy()
+            mask[total_map > 0] = 0
+            mask = ndimage.binary_erosion(mask > 0, border_value=1, iterations=2).astype(np.uint8)
+            total_map = total_map + mask
+            expected.append(mask)
+        label = erode_masks(masks, 2)
+        for idx, mask in enumerate(expected):
+            self.assertTrue(np.array_equal(label == (idx + 1), mask > 0))
+
+        # the label path agrees if masks do not overlap
+        masks = [masks[0], masks[2]]
+        self.assertTrue(np.array_equal(erode_masks(masks, 2), erode_label(masks_to_label(masks, (40, 40)), 2)))
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,5 +1,7 @@
 import random
-from collections import defaultdict
+import hashlib
+import json
+from collections import defaultdict, OrderedDict
 
 import sys
 import logging
@@ -8,12 +10,14 @@ import numpy as np
 import os
 import cv2
 import time
+from PIL import Image
 from scipy import ndimage
 from tensorpack.dataflow.common import BatchData, MapData, MapDataComponent
 from tensorpack.dataflow.base import RNGDataFlow
 from tensorpack.dataflow import PrefetchData
 
-from data_augmentation import data_to_segment_input, data_to_normalize01
+from data_augmentation import data_to_segment_input, data_to_normalize01, masks_to_label
+from data_store import CellImageStore
 from hyperparams import HyperParams
 
 logger = logging.getLogger('train')
@@ -29,58 +33,241 @@ if HyperParams.get().dataset_stage == 1:
     master_dir_train = '/data/public/rw/datasets/dsb2018/train'
     master_dir_train2 = None
     master_dir_test = '/data/public/rw/datasets/dsb2018/test'
-
-    # train/valid set k folds implementation
-    IDX_LIST = list(next(os.walk(master_dir_train))[1])
-
-    logger.info('Loading Dataset for Stage1(%d)' % (len(IDX_LIST)))
-
-    if HyperParams.get().data_fold > 0:
-        VALID_IDX_LIST = IDX_LIST[-94*HyperParams.get().data_fold:][:94]
-        TRAIN_IDX_LIST = sorted(list(set(IDX_LIST) - set(VALID_IDX_LIST)))
-        assert len(VALID_IDX_LIST) == 94, len(VALID_IDX_LIST)
-        assert len(TRAIN_IDX_LIST) == 576, len(TRAIN_IDX_LIST)
-    else:
-        # to test all images
-        VALID_IDX_LIST = IDX_LIST
-        TRAIN_IDX_LIST = []
-        assert len(VALID_IDX_LIST) == 670, len(VALID_IDX_LIST)
-        assert len(TRAIN_IDX_LIST) == 0, len(TRAIN_IDX_LIST)
 else:
     master_dir_train = '/data/public/rw/datasets/dsb2018/train'
     master_dir_train2 = '/data/public/rw/datasets/dsb2018/test_stage1'
     master_dir_test = '/data/public/rw/datasets/dsb2018/stage2_test_final'
 
-    # train/valid set k folds implementation
-    IDX_LIST = list(next(os.walk(master_dir_train))[1])
-    IDX_LIST2 = list(next(os.walk(master_dir_train2))[1])
-
-    logger.info('Loading Dataset for Stage2(%d+%d)' % (len(IDX_LIST), len(IDX_LIST2)))
-
-    if HyperParams.get().data_fold > 0:
-        VALID_IDX_LIST = IDX_LIST[-98 * HyperParams.get().data_fold:][:98]
-        TRAIN_IDX_LIST = sorted(list(set(IDX_LIST) - set(VALID_IDX_LIST)))
-        VALID_IDX_LIST += IDX_LIST2[-14 * HyperParams.get().data_fold:][:14]
-        TRAIN_IDX_LIST += sorted(list(set(IDX_LIST2) - set(VALID_IDX_LIST)))
-        assert len(VALID_IDX_LIST) == 98 + 14, len(VALID_IDX_LIST)
-        assert len(TRAIN_IDX_LIST) == 572 + 51, len(TRAIN_IDX_LIST)
-    else:
-        # to test all test images in stage1
-        VALID_IDX_LIST = IDX_LIST2
-        TRAIN_IDX_LIST = []
-        assert len(VALID_IDX_LIST) == 65, len(VALID_IDX_LIST)
-        assert len(TRAIN_IDX_LIST) == 0, len(TRAIN_IDX_LIST)
-TEST_IDX_LIST = list(next(os.walk(master_dir_test))[1])
-
 # extra1 ref : https://www.kaggle.com/voglinio/external-h-e-data-with-mask-annotations/notebook
 # extra2 ref : https://www.kaggle.com/branislav1991/converting-tnbc-external-data-to-dsb2018-format/
 extra1_dir = '/data/public/rw/datasets/dsb2018/extra_data'
 extra2_dir = '/data/public/rw/datasets/dsb2018/extra_data_tnbc'
 
+# (name, directory, extension) of the datasets
+DATA_SOURCES = [
+    ('train', master_dir_train, 'png'),
+    ('train2', master_dir_train2, 'png'),
+    ('test', master_dir_test, 'png'),
+    ('extra1', extra1_dir, 'tif'),
+    ('extra2', extra2_dir, 'png'),
+]
+NUM_FOLDS = 7
+
+
+def get_image_shape(path):
+    """
+    :return: [h, w] from the header of the image file, None if it can not be read
+    """
+    try:
+        with Image.open(path) as img:
+            w, h = img.size
+        return [h, w]
+    except (IOError, OSError):
+        return None
+
+
+class DataManifest:
+    """
+    Cached listing of the dataset : ids of every source in directory order, with their image shape,
+    number of instances and the folds in which they are validation images.
+
+    It is built by walking the dataset directories once and saved at HyperParams.data_manifest,
+    so importing modules or starting scripts never lists the (network) file system.
+    It is rebuilt when a dataset directory is modified, appears or disappears.
+    Missing directories are recorded as skipped, so the manifest is rebuilt once they appear.
+    """
+    VERSION = 2
+
+    # Here will be the instance stored.
+    __instance = None
+
+    @staticmethod
+    def get():
+        """ Static access method. """
+        if DataManifest.__instance is None:
+            DataManifest()
+        return DataManifest.__instance
+
+    def __init__(self):
+        """ Virtually private constructor. """
+        if DataManifest.__instance is not None:
+            raise Exception("This class is a singleton!")
+        else:
+            DataManifest.__instance = self
+
+        self.path = HyperParams.get().data_manifest
+        stage = HyperParams.get().dataset_stage
+        manifest = None
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                manifest = json.load(f)
+            if manifest.get('version') != DataManifest.VERSION or manifest.get('stage') != stage:
+                logger.warning('manifest at %s is outdated, rebuild it' % self.path)
+                manifest = None
+            elif not DataManifest.is_valid(manifest):
+                logger.warning('dataset changed since the manifest at %s, rebuild it' % self.path)
+                manifest = None
+        if manifest is None:
+            manifest = DataManifest.build(stage)
+            DataManifest.save(manifest, self.path)
+
+        self.sources = manifest['sources']
+        self.entries = manifest['entries']
+        logger.info('Loading Dataset for Stage%d(%s)' % (stage, '+'.join([str(len(self.ids(name))) for name in ['train', 'train2'] if name in self.sources])))
+
+    def ids(self, source):
+        """
+        :return: list of ids in the source, in the order of the directory listing.
+        """
+        if source not in self.sources:
+            return []
+        return list(self.sources[source]['ids'])
+
+    def __contains__(self, target_id):
+        return target_id in self.entries
+
+    def source_of(self, target_id):
+        """
+        :return: (directory, extension) of the source which the image belongs to.
+        """
+        source = self.sources[self.entries[target_id]['source']]
+        return source['dir'], source['ext']
+
+    def fold_split(self, fold):
+        """
+        :param fold: 1~NUM_FOLDS. 0 to validate on every labeled test image.
+        :return: (train ids, valid ids) of the original dataset.
+        """
+        stage = HyperParams.get().dataset_stage
+        ids, ids2 = self.ids('train'), self.ids('train2')
+        if fold > 0:
+            valid_list = [idx for idx in ids + ids2 if fold in self.entries[idx]['valid_folds']]
+            train_list = sorted(list(set(ids) - set(valid_list))) + sorted(list(set(ids2) - set(valid_list)))
+            if stage == 1:
+                assert len(valid_list) == 94, len(valid_list)
+                assert len(train_list) == 576, len(train_list)
+            else:
+                assert len(valid_list) == 98 + 14, len(valid_list)
+                assert len(train_list) == 572 + 51, len(train_list)
+        elif stage == 1:
+            # to test all images
+            valid_list, train_list = ids, []
+            assert len(valid_list) == 670, len(valid_list)
+        else:
+            # to test all test images in stage1
+            valid_list, train_list = ids2, []
+            assert len(valid_list) == 65, len(valid_list)
+        return train_list, valid_list
+
+    @staticmethod
+    def valid_folds(stage, ids, ids2):
+        """
+        train/valid set k folds implementation
+        :return: dict of id -> list of folds in which the id is a validation image
+        """
+        folds = defaultdict(list)
+        for fold in range(1, NUM_FOLDS + 1):
+            if stage == 1:
+                valid_list = ids[-94 * fold:][:94]
+            else:
+                valid_list = ids[-98 * fold:][:98] + ids2[-14 * fold:][:14]
+            for idx in valid_list:
+                folds[idx].append(fold)
+        return folds
+
+    @staticmethod
+    def is_valid(manifest):
+        """
+        :return: False if a source directory is modified(eg. ids added or removed), or it exists now but is not listed.
+        """
+        for name, path, _ in DATA_SOURCES:
+            if path is None:
+                continue
+            exists = os.path.exists(path)
+            if name not in manifest['sources']:
+                if exists:
+                    return False
+                continue
+            source = manifest['sources'][name]
+            if not exists or source['dir'] != path or os.stat(path).st_mtime != source['mtime']:
+                return False
+        return True
+
+    @staticmethod
+    def build(stage):
+        """
+        Walk the dataset directories. Shapes of images are read from their file headers, without decoding pixels.
+        """
+        sources = OrderedDict()
+        entries = OrderedDict()
+        skipped = []
+        for name, path, ext in DATA_SOURCES:
+            if path is None:
+                continue
+            if not os.path.exists(path):
+                logger.warning('%s not found, skipped in the manifest' % path)
+                skipped.append(name)
+                continue
+            mtime = os.stat(path).st_mtime
+            ids = list(next(os.walk(path))[1])
+            sources[name] = {'dir': path, 'ext': ext, 'ids': ids, 'mtime': mtime}
+
+            for target_id in ids:
+                mask_dir = os.path.join(path, target_id, 'masks')
+                entries[target_id] = {
+                    'source': name,
+                    'shape': get_image_shape(os.path.join(path, target_id, 'images', target_id + '.' + ext)),
+                    'instances': len(next(os.walk(mask_dir))[2]) if os.path.exists(mask_dir) else 0,
+                    'valid_folds': [],
+                }
+
+        ids = sources['train']['ids'] if 'train' in sources else []
+        ids2 = sources['train2']['ids'] if 'train2' in sources else []
+        for target_id, folds in DataManifest.valid_folds(stage, ids, ids2).items():
+            entries[target_id]['valid_folds'] = folds
+
+        logger.info('manifest built, %s' % ', '.join(['%s=%d' % (name, len(s['ids'])) for name, s in sources.items()]))
+        return {'version': DataManifest.VERSION, 'stage': stage, 'sources': sources, 'entries': entries, 'skipped': skipped}
+
+    @staticmethod
+    def save(manifest, path):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(path + '.tmp', path)
+
+
+class _ManifestList:
+    """
+    Class attribute of an id list, computed from the DataManifest on the first access.
+    """
+    def __init__(self, func):
+        self.func = func
+        self.value = None
+
+    def __get__(self, obj, objtype=None):
+        if self.value is None:
+            self.value = self.func(DataManifest.get())
+        return self.value
+
 
 class CellImageData:
-    def __init__(self, target_id, path, ext='png'):
+    def __init__(self, target_id, path, ext='png', store=None, use_label=False):
+        """
+        :param store: CellImageStore to read from, instead of the png directory
+        :param use_label: keep masks as a single int32 label image. it is always true for images from the store.
+        """
         self.target_id = target_id
+        self._label = None
+        self._masks = []
+        # geometric augmentations applied to masks, None if it includes random ones. see record_aug()
+        self.aug_history = []
+
+        if store is not None and target_id in store:
+            self._read_store(store)
+            return
 
         # read
         if '/' in target_id:
@@ -120,7 +307,61 @@ class CellImageData:
             mask = mask >> 7    # faster than mask // 129
             self.masks.append(mask)
 
+        if use_label:
+            self.label = masks_to_label(self.masks, self.img.shape)
+
+    def _read_store(self, store):
+        self.img, label = store.read(self.target_id)
+        self.img_h, self.img_w = self.img.shape[:2]
+        self.mask_h, self.mask_w = 0, 0
+        if label is not None:
+            self.label = label
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if state['_label'] is not None:
+            # derived from the label image again, if needed
+            state['_masks'] = None
+        return state
+
+    @property
+    def label(self):
+        """
+        (h, w) int32 label image(0=background, i=i-th instance) or None if masks are kept as a list.
+        """
+        return self._label
+
+    @label.setter
+    def label(self, label):
+        self._label = label
+        self._masks = None if label is not None else []
+
+    @property
+    def masks(self):
+        """
+        list of (h, w) uint8 binary masks. derived lazily from the label image if the data has one.
+        """
+        if self._masks is None:
+            self._masks = [(self._label == idx).astype(np.uint8) for idx in range(1, self._label.max() + 1)]
+        return self._masks
+
+    @masks.setter
+    def masks(self, masks):
+        self._masks = masks
+        self._label = None
+
     def remove_redundant_masks(self):
+        if self._label is not None:
+            self.mask_h, self.mask_w = self._label.shape[:2]
+            # relabel as 1...n, without empty labels
+            present = np.flatnonzero(np.bincount(self._label.ravel())[1:]) + 1
+            if len(present) == 0 or present[-1] == len(present):
+                return
+            lut = np.zeros((present[-1] + 1,), dtype=np.int32)
+            lut[present] = np.arange(1, len(present) + 1, dtype=np.int32)
+            self.label = lut[self._label]
+            return
+
         if len(self.masks) > 0:
             self.mask_h, self.mask_w = self.masks[0].shape[:2]
             self.masks = [mask for mask in self.masks if np.max(mask) > 0]
@@ -130,8 +371,11 @@ class CellImageData:
         :return: (h, w, 1) numpy
         """
         self.remove_redundant_masks()
-        multi_masks = self.multi_masks()
-        multi_masks = np.sum(multi_masks, axis=2)
+        if self._label is not None:
+            multi_masks = (self._label > 0).astype(np.uint8)
+        else:
+            multi_masks = self.multi_masks()
+            multi_masks = np.sum(multi_masks, axis=2)
         if ch1:
             multi_masks = multi_masks[..., np.newaxis]
         return multi_masks
@@ -141,7 +385,10 @@ class CellImageData:
         :return: (h, w, m) numpy
         """
         self.remove_redundant_masks()
-        if len(self.masks) == 0:
+        if self._label is not None and self._label.max() > 0:
+            idxs = np.arange(1, self._label.max() + 1, dtype=np.int32)
+            r = (self._label[np.newaxis, ...] == idxs[:, np.newaxis, np.newaxis]).astype(np.uint8)
+        elif len(self.masks) == 0:
             if self.mask_h > 0 and self.mask_w > 0:
                 img_h, img_w = self.mask_h, self.mask_w
             else:
@@ -154,17 +401,19 @@ class CellImageData:
         return r
 
     def multi_masks_batch(self):
+        """
+        :return: (h, w, 1) int32 label image, 0=background, i=i-th instance
+        """
         self.remove_redundant_masks()
+        if self._label is not None:
+            return self._label[..., np.newaxis].astype(np.int32)
         if len(self.masks) > 0:
-            img_h, img_w = self.masks[0].shape[:2]
+            return masks_to_label(self.masks, self.masks[0].shape)[..., np.newaxis]
         elif self.mask_h > 0 and self.mask_w > 0:
             img_h, img_w = self.mask_h, self.mask_w
         else:
             img_h, img_w = 228, 228  # TODO : temporal code
-        m = np.zeros(shape=(img_h, img_w, 1), dtype=np.uint8)
-        for idx, mask in enumerate(self.masks):
-            m = m + mask[..., np.newaxis] * (idx + 1)
-        return m
+        return np.zeros(shape=(img_h, img_w, 1), dtype=np.int32)
 
     def image(self, is_gray=True):
         """
@@ -178,29 +427,98 @@ class CellImageData:
 
     def unet_weights(self):
         # ref : https://www.kaggle.com/piotrczapla/tensorflow-u-net-starter-lb-0-34/notebook
-        if len(self.masks) == 0:
+        self.remove_redundant_masks()
+        if self._label is not None:
+            label = self._label
+        elif len(self.masks) > 0:
+            label = masks_to_label(self.masks, self.masks[0].shape)
+        else:
+            label = None
+
+        if label is None or label.max() == 0:
             if self.mask_h > 0 and self.mask_w > 0:
                 img_h, img_w = self.mask_h, self.mask_w
             else:
                 img_h, img_w = 228, 228  # TODO : temporal code
             return np.ones((img_h, img_w, 1), dtype=np.float32)
 
-        w0 = 10
-        sigma = 5
+        # only deterministic samples are cached. eg. random crops are not.
+        cache = get_unet_weight_cache()
+        key = None
+        if cache is not None and self.aug_history is not None:
+            key = (self.target_id, tuple(self.aug_history), HyperParams.get().pre_erosion_iter)
+            weight = cache.get(key)
+            if weight is not None:
+                return weight
+
+        weight = unet_border_weights(label)[..., np.newaxis]
+        if key is not None:
+            cache.put(key, weight)
+        return weight
+
+
+def unet_border_weights(label, w0=10, sigma=5, eps=1e-3):
+    """
+    Weight map of the original u-net paper, w0 * exp(-(d1 + d2)^2 / (2 * sigma^2)) on the background,
+    where d1, d2 are distances to the nearest and the second nearest cell.
+
+    Distances to a cell are computed only around its bounding box, within the distance
+    where the weight term drops under 'eps', so there is no (# of cells, h, w) distance stack.
+    :param label: (h, w) int32 label image
+    :return: (h, w) float32 weights
+    """
+    margin = int(np.ceil(sigma * np.sqrt(2 * np.log(w0 / eps))))
+    img_h, img_w = label.shape[:2]
+
+    d1 = np.full((img_h, img_w), np.inf, dtype=np.float64)
+    d2 = np.full((img_h, img_w), np.inf, dtype=np.float64)
+    rects = ndimage.find_objects(label)
+    for idx, rect in enumerate(rects):
+        if rect is None:
+            continue
+        window = (
+            slice(max(rect[0].start - margin, 0), min(rect[0].stop + margin, img_h)),
+            slice(max(rect[1].start - margin, 0), min(rect[1].stop + margin, img_w))
+        )
+        dist = ndimage.distance_transform_edt(label[window] != (idx + 1))
+
+        nearest = d1[window]
+        d2[window] = np.minimum(d2[window], np.maximum(nearest, dist))
+        d1[window] = np.minimum(nearest, dist)
+
+    if sum(1 for rect in rects if rect is not None) == 1:
+        # distance to the border of the second nearest cell, as in the single cell case of the paper
+        d2 = np.zeros_like(d1)
 
-        merged_mask = self.single_mask(ch1=False)
+    weight = w0 * np.exp(-(d1 + d2) ** 2 / (2 * sigma ** 2)).astype(np.float32)
+    weight = 1 + (label == 0) * weight
+    return weight
 
-        distances = np.array([ndimage.distance_transform_edt(m == 0) for m in self.masks])
-        shortest_dist = np.sort(distances, axis=0)
 
-        # distance to the border of the nearest cell
-        d1 = shortest_dist[0]
-        # distance to the border of the second nearest cell
-        d2 = shortest_dist[1] if len(shortest_dist) > 1 else np.zeros(d1.shape)
+class UnetWeightCache:
+    """
+    On-disk cache of unet weights, keyed by (image id, geometric augmentations, pre_erosion_iter).
+    Prefetch workers may share it, since every entry is written atomically.
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _filepath(self, key):
+        return os.path.join(self.path, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.npy')
+
+    def get(self, key):
+        try:
+            return np.load(self._filepath(key))
+        except (IOError, ValueError):
+            return None
 
-        weight = w0 * np.exp(-(d1 + d2) ** 2 / (2 * sigma ** 2)).astype(np.float32)
-        weight = 1 + (merged_mask == 0) * weight
-        return weight[..., np.newaxis]
+    def put(self, key, weight):
+        filepath = self._filepath(key)
+        tmp_path = '%s.%d.tmp' % (filepath, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, weight)
+        os.replace(tmp_path, filepath)
 
 
 class CellImageDataManager(RNGDataFlow):
@@ -219,23 +537,15 @@ class CellImageDataManager(RNGDataFlow):
             random.shuffle(self.idx_list)
 
         for idx in self.idx_list:
-            if 'TCGA' in idx:
-                # extra1 dataset
-                yield [CellImageData(idx, extra1_dir, ext='tif')]
-            elif 'TNBC' in idx:
-                yield [CellImageData(idx, extra2_dir, ext='png')]
-            elif idx in IDX_LIST2:
-                yield [CellImageData(idx, master_dir_train2, ext='png')]
-            else:
-                # default dataset
-                yield [CellImageData(idx, self.path)]
+            path, ext = get_data_source(idx, self.path)
+            yield [CellImageData(idx, path, ext=ext, store=get_data_store())]
 
 
 class CellImageDataManagerTrain(CellImageDataManager):
-    LIST_ORIG = TRAIN_IDX_LIST
-    LIST_EXT1 = list(next(os.walk(extra1_dir))[1])[:-9]
-    LIST_EXT2 = list(next(os.walk(extra2_dir))[1])[:-5]
-    LIST = LIST_ORIG + LIST_EXT1 # + LIST_EXT2
+    LIST_ORIG = _ManifestList(lambda m: m.fold_split(HyperParams.get().data_fold)[0])
+    LIST_EXT1 = _ManifestList(lambda m: m.ids('extra1')[:-9])
+    LIST_EXT2 = _ManifestList(lambda m: m.ids('extra2')[:-5])
+    LIST = _ManifestList(lambda m: CellImageDataManagerTrain.LIST_ORIG + CellImageDataManagerTrain.LIST_EXT1)  # + LIST_EXT2
 
     def __init__(self):
         super().__init__(
@@ -247,10 +557,10 @@ class CellImageDataManagerTrain(CellImageDataManager):
 
 
 class CellImageDataManagerValid(CellImageDataManager):
-    LIST_ORIG = VALID_IDX_LIST
-    LIST_EXT1 = list(next(os.walk(extra1_dir))[1])[-9:]
-    LIST_EXT2 = list(next(os.walk(extra2_dir))[1])[-5:]
-    LIST = LIST_EXT2 + LIST_EXT1 + LIST_ORIG
+    LIST_ORIG = _ManifestList(lambda m: m.fold_split(HyperParams.get().data_fold)[1])
+    LIST_EXT1 = _ManifestList(lambda m: m.ids('extra1')[-9:])
+    LIST_EXT2 = _ManifestList(lambda m: m.ids('extra2')[-5:])
+    LIST = _ManifestList(lambda m: CellImageDataManagerValid.LIST_EXT2 + CellImageDataManagerValid.LIST_EXT1 + CellImageDataManagerValid.LIST_ORIG)
 
     def __init__(self):
         super().__init__(
@@ -262,7 +572,7 @@ class CellImageDataManagerValid(CellImageDataManager):
 
 
 class CellImageDataManagerTest(CellImageDataManager):
-    LIST = TEST_IDX_LIST
+    LIST = _ManifestList(lambda m: m.ids('test'))
 
     def __init__(self):
         super().__init__(
@@ -306,6 +616,67 @@ class MetaData:
         self.test_cluster = MetaData.read_cluster('./metadata/share_test_df.csv')
 
 
+_data_store = None
+
+
+def get_data_store():
+    """
+    :return: CellImageStore at HyperParams.data_store, or None if not configured.
+    """
+    global _data_store
+    if _data_store is None and HyperParams.get().data_store:
+        _data_store = CellImageStore(HyperParams.get().data_store)
+        logger.info('data store opened at %s, size=%d' % (HyperParams.get().data_store, len(_data_store)))
+    return _data_store
+
+
+_unet_weight_cache = None
+
+
+def get_unet_weight_cache():
+    """
+    :return: UnetWeightCache at HyperParams.data_weight_cache, or None if not configured.
+    """
+    global _unet_weight_cache
+    if _unet_weight_cache is None and HyperParams.get().data_weight_cache:
+        _unet_weight_cache = UnetWeightCache(HyperParams.get().data_weight_cache)
+    return _unet_weight_cache
+
+
+def get_data_source(target_id, default_path):
+    """
+    :return: (directory, extension) of the image, from which CellImageData reads it.
+    """
+    store = get_data_store()
+    if store is not None and target_id in store:
+        # read from the store, the directory is not used
+        return default_path, 'png'
+    manifest = DataManifest.get()
+    if target_id in manifest:
+        return manifest.source_of(target_id)
+    # default dataset
+    return default_path, 'png'
+
+
+def build_data_store(path, verify=True):
+    """
+    One-time conversion of every image and its masks into a packed CellImageStore.
+    Use it by setting the environment variable 'data_store' to the path.
+    """
+    manifest = DataManifest.get()
+
+    def items():
+        for idx in manifest.entries.keys():
+            d = CellImageData(idx, *manifest.source_of(idx))
+            label = masks_to_label(d.masks, d.img.shape) if len(d.masks) > 0 else None
+            yield idx, d.img, label
+
+    CellImageStore.build(path, items())
+    if verify:
+        broken = CellImageStore(path).verify_all()
+        assert len(broken) == 0, broken
+
+
 def get_default_dataflow():
     ds = CellImageDataManagerTrain()
     ds = PrefetchData(ds, 1000, 12)
@@ -324,12 +695,19 @@ def get_default_dataflow_batch(batchsize=32):
 
 
 def batch_to_multi_masks(multi_masks_batch, transpose=True):
-    a = np.array([multi_masks_batch == (idx + 1) for idx in range(np.max(multi_masks_batch))], dtype=np.uint8)
+    """
+    :param multi_masks_batch: (h, w, 1) label image
+    :return: (h, w, m) or (m, h, w) uint8 masks
+    """
+    label = multi_masks_batch[..., 0]
+    a = np.zeros((int(np.max(label)),) + label.shape, dtype=np.uint8)
+    coords = np.nonzero(label)
+    a[(label[coords] - 1,) + coords] = 1
 
     if transpose:
-        return a[..., 0].transpose([1, 2, 0])
+        return a.transpose([1, 2, 0])
     else:
-        return a[..., 0]
+        return a
 
 
 if __name__ == '__main__':
@@ -1,3 +1,6 @@
+import os
+import shutil
+import tempfile
 import unittest
 
 import time
@@ -7,10 +10,11 @@ import numpy as np
 from tensorpack.dataflow.common import TestDataSpeed, MapDataComponent, MapData
 from tensorpack.dataflow.parallel import PrefetchData
 
+import data_feeder
 from data_augmentation import data_to_image, random_affine, random_color, random_scaling, resize_shortedge_if_small, \
     random_crop, random_flip_lr, random_flip_ud, erosion_mask
 from data_feeder import CellImageData, get_default_dataflow, master_dir_train, get_default_dataflow_batch, \
-    CellImageDataManagerTest, master_dir_test, CellImageDataManagerTrain, batch_to_multi_masks
+    CellImageDataManagerTest, master_dir_test, CellImageDataManagerTrain, batch_to_multi_masks, DataManifest
 
 
 class DataFeederTest(unittest.TestCase):
@@ -49,6 +53,7 @@ class DataFeederTest(unittest.TestCase):
             [256, 320, 1]
         )
         self.assertEqual(np.max(d.multi_masks_batch()), 15)
+        self.assertEqual(d.multi_masks_batch().dtype, np.int32)
 
         # single mask
         self.assertListEqual(
@@ -70,6 +75,26 @@ class DataFeederTest(unittest.TestCase):
         )
         self.assertEqual(np.max(d.multi_masks()), 1)
 
+    def test_image_data_label(self):
+        d = CellImageData('a6515d73077866808ad4cb837ecdac33612527b8a1041e82135e40fce2bb9380', path=master_dir_train)
+        d_label = CellImageData('a6515d73077866808ad4cb837ecdac33612527b8a1041e82135e40fce2bb9380', path=master_dir_train, use_label=True)
+        self.assertEqual(d_label.label.dtype, np.int32)
+        self.assertEqual(np.max(d_label.label), 15)
+
+        self.assertTrue(np.array_equal(d.single_mask(), d_label.single_mask()))
+        self.assertTrue(np.array_equal(d.multi_masks(), d_label.multi_masks()))
+        self.assertTrue(np.array_equal(d.multi_masks_batch(), d_label.multi_masks_batch()))
+
+        # list of masks are derived lazily
+        self.assertEqual(len(d_label.masks), 15)
+        self.assertTrue(np.array_equal(d_label.masks[0], d.masks[0]))
+
+        # empty instances are removed
+        d_label.label[d_label.label == 1] = 0
+        d_label.remove_redundant_masks()
+        self.assertEqual(np.max(d_label.label), 14)
+        self.assertEqual(len(d_label.masks), 14)
+
     def test_image_train2(self):
         # test erosion & unet-weight
         d = CellImageData('00ae65c1c6631ae6f2be1a449902976e6eb8483bf6b0740d00530220832c6d3e', path=master_dir_train)
@@ -168,6 +193,41 @@ class DataFeederTest(unittest.TestCase):
             if idx > 10:
                 break
 
+    def test_manifest_folds(self):
+        ids = ['train%03d' % i for i in range(670)]
+        ids2 = ['test%02d' % i for i in range(65)]
+        folds = DataManifest.valid_folds(2, ids, ids2)
+        for fold in range(1, 8):
+            valid_list = [idx for idx in ids + ids2 if fold in folds[idx]]
+            self.assertListEqual(valid_list, ids[-98 * fold:][:98] + ids2[-14 * fold:][:14])
+
+    def test_manifest_validity(self):
+        path = tempfile.mkdtemp()
+        sources = data_feeder.DATA_SOURCES
+        try:
+            os.makedirs(os.path.join(path, 'a', 'id0', 'images'))
+            cv2.imwrite(os.path.join(path, 'a', 'id0', 'images', 'id0.png'), np.zeros((5, 7, 3), dtype=np.uint8))
+            data_feeder.DATA_SOURCES = [('test', os.path.join(path, 'a'), 'png'), ('extra1', os.path.join(path, 'b'), 'png')]
+            manifest = DataManifest.build(2)
+            self.assertListEqual(manifest['skipped'], ['extra1'])
+            self.assertListEqual(manifest['entries']['id0']['shape'], [5, 7])
+            self.assertTrue(DataManifest.is_valid(manifest))
+
+            # a source appears
+            os.makedirs(os.path.join(path, 'b'))
+            self.assertFalse(DataManifest.is_valid(manifest))
+            manifest = DataManifest.build(2)
+            self.assertListEqual(manifest['skipped'], [])
+            self.assertTrue(DataManifest.is_valid(manifest))
+
+            # an id is added
+            time.sleep(0.01)
+            os.makedirs(os.path.join(path, 'a', 'id1'))
+            self.assertFalse(DataManifest.is_valid(manifest))
+        finally:
+            data_feeder.DATA_SOURCES = sources
+            shutil.rmtree(path)
+
     # def test_unet_weights(self):
     #     d = CellImageData('a6515d73077866808ad4cb837ecdac33612527b8a1041e82135e40fce2bb9380', path=master_dir_train)
     #     weights = d.unet_weights()
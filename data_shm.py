@@ -0,0 +1,129 @@
+import logging
+import multiprocessing as mp
+import os
+import queue
+import random
+import sys
+import time
+import traceback
+
+import numpy as np
+from tensorpack.dataflow.base import ProxyDataFlow
+from tensorpack.utils.concurrency import ensure_proc_terminate, start_proc_mask_signal
+
+logger = logging.getLogger('data_shm')
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler(sys.stdout)
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter('[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s')
+ch.setFormatter(formatter)
+logger.handlers = []
+logger.addHandler(ch)
+
+
+class SharedMemoryPrefetchData(ProxyDataFlow):
+    """
+    Prefetch datapoints of fixed shapes with forked workers, like PrefetchData,
+    but the workers write them into a ring of preallocated shared memory slots instead of pickling them.
+
+    The consumer gets numpy views of a slot, not copies. The slot is reused once the next datapoint is requested,
+    so a consumer which keeps datapoints(eg. a queue or BatchData after it) sees them overwritten.
+    It should be the last dataflow of a chain, eg. after BatchData, and its output fed to a session right away.
+
+    An exception in a worker is sent back and raised in the main process, as well as a worker dying without it.
+    """
+    class _Worker(mp.Process):
+        def __init__(self, ds, buffers, free_queue, ready_queue):
+            super().__init__()
+            self.ds = ds
+            self.buffers = buffers
+            self.free_queue = free_queue
+            self.ready_queue = ready_queue
+
+        def run(self):
+            # forked workers share the state of global random generators, which augmentations use
+            seed = (os.getpid() + int(time.time() * 1000)) % (2 ** 32)
+            random.seed(seed)
+            np.random.seed(seed)
+
+            try:
+                self.ds.reset_state()
+                while True:
+                    for dp in self.ds.get_data():
+                        slot = self.free_queue.get()
+                        for buf, component in zip(self.buffers, dp):
+                            component = np.asarray(component)
+                            if component.shape != buf.shape[1:]:
+                                raise Exception('datapoint of shape %s, expected %s' % (component.shape, buf.shape[1:]))
+                            buf[slot][...] = component
+                        self.ready_queue.put((slot, None))
+            except Exception:
+                # (slot, error) : the main process raises it instead of waiting forever
+                self.ready_queue.put((None, traceback.format_exc()))
+
+    def __init__(self, ds, nr_slot, nr_proc):
+        """
+        :param ds: dataflow of fixed-shape datapoints. A datapoint is fetched in the main process to infer the shapes.
+        :param nr_slot: number of datapoints held in the shared memory
+        :param nr_proc: number of worker processes
+        """
+        super().__init__(ds)
+        self.nr_slot = nr_slot
+        self.nr_proc = nr_proc
+
+        self.ds.reset_state()
+        probe = [np.asarray(component) for component in next(self.ds.get_data())]
+        for component in probe:
+            if component.dtype.hasobject:
+                raise Exception('object arrays can not be shared, dtype=%s' % component.dtype)
+
+        self.buffers = []
+        for component in probe:
+            raw = mp.RawArray('b', int(nr_slot * component.nbytes))
+            buf = np.frombuffer(raw, dtype=component.dtype).reshape((nr_slot,) + component.shape)
+            self.buffers.append(buf)
+        logger.info('shared memory slots=%d, size=%d bytes, shapes=%s' % (
+            nr_slot, sum([buf.nbytes for buf in self.buffers]), [component.shape for component in probe]))
+
+        self.free_queue = mp.Queue(nr_slot)
+        self.ready_queue = mp.Queue(nr_slot)
+        for slot in range(nr_slot):
+            self.free_queue.put(slot)
+        self.slot = None
+
+        self.procs = [SharedMemoryPrefetchData._Worker(self.ds, self.buffers, self.free_queue, self.ready_queue) for _ in range(nr_proc)]
+        ensure_proc_terminate(self.procs)
+        start_proc_mask_signal(self.procs)
+
+    def _release(self):
+        if self.slot is not None:
+            self.free_queue.put(self.slot)
+            self.slot = None
+
+    def _get_ready(self, timeout=5):
+        while True:
+            try:
+                slot, err = self.ready_queue.get(timeout=timeout)
+            except queue.Empty:
+                dead = [p.pid for p in self.procs if not p.is_alive()]
+                if dead:
+                    raise Exception('prefetch workers died, pids=%s' % dead)
+                continue
+            if err is not None:
+                raise Exception('prefetch worker failed:\n%s' % err)
+            return slot
+
+    def get_data(self):
+        """
+        :return: generator of datapoints, which are views of a shared slot valid until the next one is requested
+        """
+        # the previous datapoint is released once the next one is requested
+        for _ in range(self.size()):
+            self._release()
+            self.slot = self._get_ready()
+            yield [buf[self.slot] for buf in self.buffers]
+        self._release()
+
+    def reset_state(self):
+        # workers have been forked and reset in __init__
+        pass
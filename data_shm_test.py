@@ -0,0 +1,51 @@
+import unittest
+
+import numpy as np
+from tensorpack.dataflow.base import DataFlow
+
+from data_shm import SharedMemoryPrefetchData
+
+
+class FixedShapeData(DataFlow):
+    def __init__(self, num):
+        self.num = num
+
+    def size(self):
+        return self.num
+
+    def get_data(self):
+        for idx in range(self.num):
+            yield [np.full((4, 5, 3), idx, dtype=np.float32), np.array([idx, idx * 2], dtype=np.int32)]
+
+
+class BrokenShapeData(FixedShapeData):
+    def get_data(self):
+        yield [np.zeros((4, 5, 3), dtype=np.float32)]
+        yield [np.zeros((4, 6, 3), dtype=np.float32)]
+
+
+class TestSharedMemoryPrefetchData(unittest.TestCase):
+    def test_prefetch(self):
+        ds = SharedMemoryPrefetchData(FixedShapeData(20), 4, 2)
+        self.assertEqual(ds.size(), 20)
+        for _ in range(2):
+            cnt = 0
+            for img, vals in ds.get_data():
+                self.assertListEqual(list(img.shape), [4, 5, 3])
+                self.assertEqual(img.dtype, np.float32)
+                # every component of a datapoint comes from the same sample
+                self.assertTrue(np.all(img == vals[0]))
+                self.assertEqual(vals[1], vals[0] * 2)
+                cnt += 1
+            self.assertEqual(cnt, 20)
+
+    def test_worker_error(self):
+        ds = SharedMemoryPrefetchData(BrokenShapeData(10), 4, 1)
+        with self.assertRaises(Exception) as ctx:
+            for _ in ds.get_data():
+                pass
+        self.assertIn('datapoint of shape', str(ctx.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,230 @@
+import json
+import logging
+import os
+import sys
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from instance import PackedInstances
+
+logger = logging.getLogger('data_store')
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler(sys.stdout)
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter('[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s')
+ch.setFormatter(formatter)
+logger.handlers = []
+logger.addHandler(ch)
+
+STORE_VERSION = 1
+INSTANCE_STORE_VERSION = 1
+INDEX_NAME = 'index.json'
+DATA_NAME = 'data.bin'
+ALIGNMENT = 64  # in bytes
+
+
+class CellImageStore:
+    """
+    Packed, memory-mapped store of cell images and their instance label maps.
+
+    Every image and its label map(int32, 0=background, i=i-th instance) are written back-to-back into a single
+    'data.bin', and 'index.json' keeps id -> (offset, shape, dtype, crc32) with the store version.
+    Reading an image is a zero-copy slice of the memory-mapped file.
+    """
+    def __init__(self, path, verify=False):
+        self.path = path
+        with open(os.path.join(path, INDEX_NAME), 'r') as f:
+            self.index = json.load(f)
+        if self.index.get('version') != STORE_VERSION:
+            raise Exception('unsupported store version(%s) at %s, expected %d' % (self.index.get('version'), path, STORE_VERSION))
+
+        data_path = os.path.join(path, DATA_NAME)
+        data_size = os.path.getsize(data_path)
+        if data_size != self.index['size']:
+            raise Exception('corrupted store at %s, size=%d expected=%d' % (path, data_size, self.index['size']))
+
+        # copy-on-write : in-place augmentations never reach the file
+        self.data = np.memmap(data_path, dtype=np.uint8, mode='c') if data_size > 0 else np.zeros((0,), dtype=np.uint8)
+        self.entries = self.index['entries']
+        self.verify = verify
+        self.verified = set()
+
+    def __contains__(self, target_id):
+        return target_id in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def ids(self):
+        return list(self.entries.keys())
+
+    def _view(self, desc):
+        dtype = np.dtype(desc['dtype'])
+        nbytes = int(np.prod(desc['shape'])) * dtype.itemsize
+        buf = self.data[desc['offset']:desc['offset'] + nbytes]
+        return np.asarray(buf).view(dtype).reshape(desc['shape'])
+
+    def read(self, target_id):
+        """
+        :return: (image, label) numpy views. label is None if the image has no masks.
+        """
+        entry = self.entries[target_id]
+        img = self._view(entry['image'])
+        label = self._view(entry['label']) if 'label' in entry else None
+
+        if self.verify and target_id not in self.verified:
+            if CellImageStore.checksum(img, label) != entry['crc32']:
+                raise Exception('checksum mismatch, id=%s at %s' % (target_id, self.path))
+            self.verified.add(target_id)
+        return img, label
+
+    def verify_all(self):
+        """
+        :return: list of ids whose checksum does not match.
+        """
+        broken = []
+        for target_id, entry in self.entries.items():
+            img = self._view(entry['image'])
+            label = self._view(entry['label']) if 'label' in entry else None
+            if CellImageStore.checksum(img, label) != entry['crc32']:
+                broken.append(target_id)
+        return broken
+
+    @staticmethod
+    def checksum(img, label):
+        crc = zlib.crc32(np.ascontiguousarray(img).data)
+        if label is not None:
+            crc = zlib.crc32(np.ascontiguousarray(label).data, crc)
+        return crc
+
+    @staticmethod
+    def build(path, items):
+        """
+        Write a new store. Existing store at the path is replaced only after every item is written.
+        :param path: directory of the store
+        :param items: iterable of (target_id, image, label or None)
+        """
+        os.makedirs(path, exist_ok=True)
+        data_path = os.path.join(path, DATA_NAME)
+        index_path = os.path.join(path, INDEX_NAME)
+
+        entries = OrderedDict()
+        offset = 0
+        with open(data_path + '.tmp', 'wb') as f:
+            for target_id, img, label in items:
+                entry = OrderedDict()
+                for key, arr in [('image', img), ('label', label)]:
+                    if arr is None:
+                        continue
+                    arr = np.ascontiguousarray(arr)
+                    padding = (-offset) % ALIGNMENT
+                    f.write(b'\0' * padding)
+                    offset += padding
+                    f.write(arr.data)
+                    entry[key] = {'offset': offset, 'shape': list(arr.shape), 'dtype': arr.dtype.str}
+                    offset += arr.nbytes
+                entry['instances'] = int(label.max()) if label is not None and label.size > 0 else 0
+                entry['crc32'] = CellImageStore.checksum(img, label)
+                entries[target_id] = entry
+
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump({'version': STORE_VERSION, 'size': offset, 'entries': entries}, f)
+
+        os.replace(data_path + '.tmp', data_path)
+        os.replace(index_path + '.tmp', index_path)
+        logger.info('store built at %s, size=%d images=%d' % (path, offset, len(entries)))
+
+
+class InstanceStore:
+    """
+    Memory-mapped store of PackedInstances, indexed by set(eg. 'test_instances') and image id.
+
+    Arrays of a PackedInstances are written back-to-back into 'data.bin' as CellImageStore does,
+    and only the pages of a requested image are read.
+    """
+    ARRAYS = ['offsets', 'sizes', 'areas', 'scores', 'byte_offsets', 'bits']
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX_NAME), 'r') as f:
+            self.index = json.load(f)
+        if self.index.get('version') != INSTANCE_STORE_VERSION:
+            raise Exception('unsupported instance store version(%s) at %s, expected %d' % (self.index.get('version'), path, INSTANCE_STORE_VERSION))
+
+        data_path = os.path.join(path, DATA_NAME)
+        data_size = os.path.getsize(data_path)
+        if data_size != self.index['size']:
+            raise Exception('corrupted store at %s, size=%d expected=%d' % (path, data_size, self.index['size']))
+        self.data = np.memmap(data_path, dtype=np.uint8, mode='r') if data_size > 0 else np.zeros((0,), dtype=np.uint8)
+        self.sets = self.index['sets']
+
+    def ids(self, set_name):
+        return list(self.sets.get(set_name, {}).keys())
+
+    def _view(self, desc):
+        dtype = np.dtype(desc['dtype'])
+        nbytes = int(np.prod(desc['shape'])) * dtype.itemsize
+        buf = self.data[desc['offset']:desc['offset'] + nbytes]
+        return np.asarray(buf).view(dtype).reshape(desc['shape'])
+
+    def count(self, set_name, target_id):
+        """
+        :return: # of instances of the image from the index only, 0 if not found.
+        """
+        entry = self.sets.get(set_name, {}).get(target_id, None)
+        return entry['areas']['shape'][0] if entry is not None else 0
+
+    def read(self, set_name, target_id):
+        """
+        :return: PackedInstances whose arrays are views of the file, None if not found.
+        """
+        entry = self.sets.get(set_name, {}).get(target_id, None)
+        if entry is None:
+            return None
+        arrays = [self._view(entry[name]) for name in InstanceStore.ARRAYS]
+        return PackedInstances(entry['shape'], *arrays)
+
+    @staticmethod
+    def build(path, sets):
+        """
+        Write a new store. Existing store at the path is replaced only after every item is written.
+        :param sets: set name -> (image id -> PackedInstances)
+        """
+        os.makedirs(path, exist_ok=True)
+        data_path = os.path.join(path, DATA_NAME)
+        index_path = os.path.join(path, INDEX_NAME)
+
+        index_sets = OrderedDict()
+        offset = 0
+        with open(data_path + '.tmp', 'wb') as f:
+            for set_name, packed_dict in sets.items():
+                entries = OrderedDict()
+                for target_id, packed in packed_dict.items():
+                    entry = OrderedDict()
+                    entry['shape'] = list(packed.shape)
+                    for name in InstanceStore.ARRAYS:
+                        arr = np.ascontiguousarray(getattr(packed, name))
+                        padding = (-offset) % ALIGNMENT
+                        f.write(b'\0' * padding)
+                        offset += padding
+                        f.write(arr.data)
+                        entry[name] = {'offset': offset, 'shape': list(arr.shape), 'dtype': arr.dtype.str}
+                        offset += arr.nbytes
+                    entries[target_id] = entry
+                index_sets[set_name] = entries
+
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump({'version': INSTANCE_STORE_VERSION, 'size': offset, 'sets': index_sets}, f)
+
+        os.replace(data_path + '.tmp', data_path)
+        os.replace(index_path + '.tmp', index_path)
+        logger.info('instance store built at %s, size=%d images=%s' % (
+            path, offset, {k: len(v) for k, v in index_sets.items()}))
+
+
+if __name__ == '__main__':
+    import fire
+    from data_feeder import build_data_store
+    fire.Fire(build_data_store)
@@ -0,0 +1,74 @@
+import unittest
+import shutil
+import tempfile
+
+import numpy as np
+
+from data_store import CellImageStore, InstanceStore
+from instance import Instance, PackedInstances
+
+
+class TestCellImageStore(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.img = np.random.randint(0, 255, size=(31, 45, 3)).astype(np.uint8)
+        self.label = np.random.randint(0, 5, size=(31, 45)).astype(np.int32)
+        CellImageStore.build(self.path, [
+            ('train_id', self.img, self.label),
+            ('test_id', self.img[:20, :10], None),
+        ])
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_read(self):
+        store = CellImageStore(self.path, verify=True)
+        self.assertEqual(len(store), 2)
+        self.assertTrue('train_id' in store)
+        self.assertFalse('unknown_id' in store)
+
+        img, label = store.read('train_id')
+        self.assertTrue(np.array_equal(img, self.img))
+        self.assertTrue(np.array_equal(label, self.label))
+        self.assertEqual(label.dtype, np.int32)
+        self.assertEqual(store.entries['train_id']['instances'], self.label.max())
+
+        img, label = store.read('test_id')
+        self.assertListEqual(list(img.shape), [20, 10, 3])
+        self.assertIsNone(label)
+
+    def test_checksum(self):
+        store = CellImageStore(self.path)
+        self.assertListEqual(store.verify_all(), [])
+
+        # copy-on-write : modified in memory only
+        img, _ = store.read('train_id')
+        img[0, 0, 0] = 255 - img[0, 0, 0]
+        self.assertListEqual(store.verify_all(), ['train_id'])
+        self.assertListEqual(CellImageStore(self.path).verify_all(), [])
+
+
+class TestInstanceStore(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_read(self):
+        mask = np.zeros((31, 45), dtype=np.bool_)
+        mask[3:9, 10:20] = True
+        packed = PackedInstances.pack([Instance.from_mask(mask)], [0.9])
+        InstanceStore.build(self.path, {'test_instances': {'a': packed, 'b': PackedInstances.pack([], [])}})
+
+        store = InstanceStore(self.path)
+        self.assertListEqual(store.ids('test_instances'), ['a', 'b'])
+        self.assertIsNone(store.read('valid_instances', 'a'))
+        instances, scores = store.read('test_instances', 'a').unpack()
+        self.assertTrue(np.array_equal(instances[0].to_mask(), mask))
+        self.assertAlmostEqual(scores[0], 0.9, delta=1e-6)
+        self.assertEqual(len(store.read('test_instances', 'b')), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
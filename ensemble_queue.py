@@ -0,0 +1,184 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+import socket
+import sys
+import time
+
+import numpy as np
+
+logger = logging.getLogger('ensemble_queue')
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler(sys.stdout)
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter('[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s')
+ch.setFormatter(formatter)
+logger.handlers = []
+logger.addHandler(ch)
+
+PLAN_NAME = 'plan.json'
+
+
+def get_config_hash(config):
+    """
+    :param config: json-serializable configuration of the work, eg. models and thresholds of an ensemble
+    """
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+
+class ShardQueue:
+    """
+    Work queue of shards on a (shared) filesystem, so that workers of a local pool or of other hosts take shards until
+    none is left.
+
+    A shard is claimed by creating its lock file exclusively, and done when its result file is written.
+    Shards are planned by estimated costs, expensive ones first, so that a slow image does not keep the others waiting.
+
+    A lock holds the host, pid and time of its worker. A lock without a result is claimed again
+    if its worker on this host is dead, or its lease has expired. Two workers may then run the same shard,
+    which is harmless since a result is written atomically.
+    """
+    def __init__(self, path, lease=6 * 3600):
+        """
+        :param lease: seconds after which a lock without a result is taken over
+        """
+        self.path = path
+        self.lease = lease
+        with open(os.path.join(path, PLAN_NAME), 'r') as f:
+            plan = json.load(f)
+        self.shards = plan['shards']
+        self.config_hash = plan.get('config_hash', '')
+
+    def __len__(self):
+        return len(self.shards)
+
+    def _lockpath(self, shard_idx):
+        return os.path.join(self.path, '%05d.lock' % shard_idx)
+
+    def _resultpath(self, shard_idx):
+        return os.path.join(self.path, '%05d.pkl' % shard_idx)
+
+    def _lock(self, shard_idx):
+        try:
+            fd = os.open(self._lockpath(shard_idx), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        lock = {'host': socket.gethostname(), 'pid': os.getpid(), 'time': time.time()}
+        os.write(fd, json.dumps(lock).encode('utf-8'))
+        os.close(fd)
+        return True
+
+    def _is_stale(self, shard_idx):
+        """
+        :return: True if the worker of the lock is dead on this host, or its lease has expired
+        """
+        try:
+            with open(self._lockpath(shard_idx), 'r') as f:
+                lock = json.load(f)
+        except FileNotFoundError:
+            return False
+        except ValueError:
+            # being written, or of an old format
+            lock = {'host': '', 'pid': 0, 'time': os.path.getmtime(self._lockpath(shard_idx))}
+        if time.time() - lock['time'] > self.lease:
+            return True
+        if lock['host'] == socket.gethostname():
+            try:
+                os.kill(lock['pid'], 0)
+            except ProcessLookupError:
+                return True
+            except PermissionError:
+                pass
+        return False
+
+    def claim(self):
+        """
+        :return: index of a claimed shard, None if every shard has been taken.
+        """
+        for shard_idx in range(len(self.shards)):
+            if os.path.exists(self._resultpath(shard_idx)):
+                continue
+            if self._lock(shard_idx):
+                return shard_idx
+            if self._is_stale(shard_idx):
+                logger.warning('shard %d : taking over a stale lock' % shard_idx)
+                self.release(shard_idx)
+                if self._lock(shard_idx):
+                    return shard_idx
+        return None
+
+    def release(self, shard_idx):
+        """
+        Remove the lock, so that the shard is claimed again unless its result is written.
+        """
+        try:
+            os.remove(self._lockpath(shard_idx))
+        except FileNotFoundError:
+            pass
+
+    def put(self, shard_idx, results):
+        path = self._resultpath(shard_idx)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(results, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+
+    def missing(self):
+        """
+        :return: indices of shards without results
+        """
+        return [idx for idx in range(len(self.shards)) if not os.path.exists(self._resultpath(idx))]
+
+    def results(self):
+        """
+        :return: generator of shard results, in the order of shards
+        """
+        missing = self.missing()
+        if missing:
+            raise Exception('%d shards are not done, eg. %s at %s' % (len(missing), missing[:5], self.path))
+        for shard_idx in range(len(self.shards)):
+            with open(self._resultpath(shard_idx), 'rb') as f:
+                yield pickle.load(f)
+
+    def check_config(self, config_hash):
+        if self.config_hash != config_hash:
+            raise Exception('a plan of another config(%s, expected %s) exists at %s' % (self.config_hash, config_hash, self.path))
+
+    @staticmethod
+    def plan(path, ids, costs, num_shards, config_hash=''):
+        """
+        Split ids into shards of similar costs. An existing plan of the same ids and config is kept,
+        so that a run can be resumed.
+        :param costs: estimated cost of each id
+        :param config_hash: get_config_hash of the work, results of another config are never merged
+        :return: ShardQueue
+        """
+        os.makedirs(path, exist_ok=True)
+        plan_path = os.path.join(path, PLAN_NAME)
+        if os.path.exists(plan_path):
+            queue = ShardQueue(path)
+            queue.check_config(config_hash)
+            if sorted(sum(queue.shards, [])) == sorted(ids):
+                logger.info('resume %d shards, done=%d at %s' % (len(queue), len(queue) - len(queue.missing()), path))
+                return queue
+            raise Exception('a plan of different ids exists at %s' % path)
+
+        # the most expensive first, and a shard is closed once it reaches the target cost
+        order = np.argsort(-np.array(costs, dtype=np.float64), kind='stable')
+        target = float(np.sum(costs)) / max(num_shards, 1)
+        shards = [[]]
+        shard_cost = 0.0
+        for idx in order:
+            if shards[-1] and shard_cost >= target:
+                shards.append([])
+                shard_cost = 0.0
+            shards[-1].append(ids[idx])
+            shard_cost += costs[idx]
+        shards = [x for x in shards if x]
+
+        with open(plan_path + '.tmp', 'w') as f:
+            json.dump({'shards': shards, 'config_hash': config_hash}, f)
+        os.replace(plan_path + '.tmp', plan_path)
+        logger.info('planned %d shards of %d ids at %s' % (len(shards), len(ids), path))
+        return ShardQueue(path)
@@ -0,0 +1,83 @@
+import json
+import multiprocessing as mp
+import os
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+
+from ensemble_queue import ShardQueue, get_config_hash
+
+
+def _work(path):
+    queue = ShardQueue(path)
+    while True:
+        shard_idx = queue.claim()
+        if shard_idx is None:
+            break
+        queue.put(shard_idx, [(x, len(x)) for x in queue.shards[shard_idx]])
+
+
+class TestShardQueue(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.ids = ['id%d' % i for i in range(50)]
+        self.costs = [1000 if i == 7 else i + 1 for i in range(50)]
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_plan(self):
+        queue = ShardQueue.plan(self.path, self.ids, self.costs, 10)
+        self.assertListEqual(queue.shards[0], ['id7'])
+        self.assertListEqual(sorted(sum(queue.shards, [])), sorted(self.ids))
+
+        # resumed with the same plan
+        self.assertListEqual(ShardQueue.plan(self.path, self.ids, self.costs, 3).shards, queue.shards)
+        with self.assertRaises(Exception):
+            ShardQueue.plan(self.path, self.ids[1:], self.costs[1:], 10)
+        with self.assertRaises(Exception):
+            ShardQueue.plan(self.path, self.ids, self.costs, 10, config_hash=get_config_hash({'th': 0.5}))
+
+    def test_stale_lock(self):
+        queue = ShardQueue.plan(self.path, self.ids, self.costs, 3)
+        self.assertEqual(queue.claim(), 0)
+        self.assertEqual(queue.claim(), 1)
+
+        # a dead worker of this host
+        proc = mp.Process(target=time.sleep, args=(0, ))
+        proc.start()
+        proc.join()
+        with open(queue._lockpath(0), 'w') as f:
+            json.dump({'host': socket.gethostname(), 'pid': proc.pid, 'time': time.time()}, f)
+        # an expired lease
+        with open(queue._lockpath(1), 'w') as f:
+            json.dump({'host': 'other', 'pid': 1, 'time': time.time() - queue.lease - 1}, f)
+        self.assertEqual(queue.claim(), 0)
+        self.assertEqual(queue.claim(), 1)
+        self.assertEqual(queue.claim(), 2)
+        self.assertIsNone(queue.claim())
+
+        queue.release(2)
+        self.assertEqual(queue.claim(), 2)
+
+    def test_workers(self):
+        queue = ShardQueue.plan(self.path, self.ids, self.costs, 10)
+        with self.assertRaises(Exception):
+            list(queue.results())
+
+        procs = [mp.Process(target=_work, args=(self.path,)) for _ in range(4)]
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
+
+        self.assertListEqual(queue.missing(), [])
+        results = sum(list(queue.results()), [])
+        self.assertListEqual(sorted([x[0] for x in results]), sorted(self.ids))
+        self.assertIsNone(queue.claim())
+
+
+if __name__ == '__main__':
+    unittest.main()
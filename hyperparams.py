@@ -35,11 +35,23 @@ class HyperParams:
         self.pre_affine_translate = 0.1     # 0.4?
         self.pre_size_norm_min = 10         # in pixel
         self.pre_size_norm_max = 150         # in pixel
+        # warp size normalization, crop and flips at once. see random_geometric
+        self.pre_fused_geometric = bool(int(os.environ.get('pre_fused_geometric', 0)))
 
         # 1~7, 7-folds
         self.data_fold = int(os.environ.get('fold', 1))
         print('---------- data folds = %d ---------' % self.data_fold)
 
+        # cached listing of the dataset, built on the first use. see DataManifest
+        self.data_manifest = os.environ.get('data_manifest', os.path.join(
+            os.path.dirname(os.path.realpath(__file__)), 'metadata', 'manifest_stage%d.json' % self.dataset_stage))
+        # packed dataset store built by data_store.py, empty to read png directories
+        self.data_store = os.environ.get('data_store', '')
+        # on-disk cache of unet weights for deterministic samples, empty to disable
+        self.data_weight_cache = os.environ.get('data_weight_cache', '')
+        # pass training batches from prefetch workers through shared memory, instead of pickling
+        self.data_shm_prefetch = bool(int(os.environ.get('data_shm_prefetch', 0)))
+
         self.net_bn_decay = 0.9
         self.net_bn_epsilon = 0.001
         self.net_dropout_keep = 0.9
@@ -62,10 +74,25 @@ class HyperParams:
         self.post_filter_th = 0.0
         self.post_cutoff_max_th = 0.9
         self.post_cutoff_avg_th = 0.0
+        # in MB, for a batch of sliding-window tiles and their outputs in inference. see TileBatcher
+        self.test_tile_memory = int(os.environ.get('test_tile_memory', 128))
+        # models('unet', 'basic') whose tiles are stitched without overlaps, each output pixel computed once
+        self.test_tile_exact = os.environ.get('test_tile_exact', '').split(',')
+        # unet-valid : whole-image inference on a dynamic-size tower, in tiles only beyond the memory(in MB)
+        self.test_whole_image = bool(int(os.environ.get('test_whole_image', 0)))
+        self.test_whole_image_memory = int(os.environ.get('test_whole_image_memory', 2048))
+        # directory of probability maps cached per checkpoint, image and view, empty to disable. see ProbMapCache
+        self.test_prob_cache = os.environ.get('test_prob_cache', '')
         self.test_aug_nms_iou = 0.3
         self.test_aug_scale_max = 2.0
         self.test_aug_scale_min = 0.75
         self.test_aug_scale_t = 80.0
+        # adaptive test-time augmentation : flips only for an ambiguous image, and rescaling only if flips disagree.
+        # ambiguity is the ratio of pixels within the margin from the cutoff, to the pixels above (cutoff - margin).
+        self.test_aug_adaptive = bool(int(os.environ.get('test_aug_adaptive', 0)))
+        self.test_aug_adaptive_margin = 0.2
+        self.test_aug_adaptive_ambiguity_th = 0.15
+        self.test_aug_adaptive_stability_th = 0.9
 
         # ensemble between models
         self.rcnn_score_rescale = 0.95
@@ -0,0 +1,342 @@
+from collections import defaultdict
+
+import cv2
+import numpy as np
+from scipy import ndimage, sparse
+
+
+class Instance:
+    """
+    Instance-aware segmentation of a single object, stored as a bool mask cropped to its bounding box.
+    Operations(iou, flip, resize, ...) only touch the crop, not the whole image.
+    """
+    __slots__ = ('shape', 'offset', 'mask', 'area', 'score')
+
+    def __init__(self, shape, offset, mask, score=None, area=None):
+        """
+        :param shape: (h, w) of the whole image
+        :param offset: (y, x) of the crop in the image
+        :param mask: bool crop, tight to the bounding box. use Instance.from_crop() for a loose one.
+        :param score: optional score of the instance
+        """
+        self.shape = (int(shape[0]), int(shape[1]))
+        self.offset = (int(offset[0]), int(offset[1]))
+        self.mask = mask
+        self.area = int(np.count_nonzero(mask)) if area is None else int(area)
+        self.score = score
+
+    @staticmethod
+    def from_crop(shape, offset, crop, score=None):
+        """
+        :param crop: (h, w) mask at the offset, which may have empty margins.
+        """
+        crop = np.asarray(crop).astype(np.bool_)
+        rows = np.flatnonzero(np.any(crop, axis=1))
+        if len(rows) == 0:
+            return Instance(shape, (0, 0), np.zeros((0, 0), dtype=np.bool_), score=score, area=0)
+        cols = np.flatnonzero(np.any(crop, axis=0))
+        rmin, rmax, cmin, cmax = rows[0], rows[-1], cols[0], cols[-1]
+        return Instance(shape, (offset[0] + rmin, offset[1] + cmin), crop[rmin:rmax + 1, cmin:cmax + 1].copy(), score=score)
+
+    @staticmethod
+    def from_mask(mask, score=None):
+        """
+        :param mask: (h, w) or (h, w, 1) full-size mask
+        """
+        mask = np.asarray(mask)
+        if len(mask.shape) == 3:
+            mask = mask[..., 0]
+        return Instance.from_crop(mask.shape, (0, 0), mask, score=score)
+
+    @property
+    def rect(self):
+        """
+        :return: slices of the crop in the image
+        """
+        y, x = self.offset
+        return slice(y, y + self.mask.shape[0]), slice(x, x + self.mask.shape[1])
+
+    @property
+    def bbox(self):
+        """
+        :return: (rmin, rmax, cmin, cmax) inclusive as get_rect_of_mask(), None if empty.
+        """
+        if self.area == 0:
+            return None
+        y, x = self.offset
+        return y, y + self.mask.shape[0] - 1, x, x + self.mask.shape[1] - 1
+
+    @property
+    def size(self):
+        """
+        :return: longer side of the bounding box, as get_size_of_mask()
+        """
+        if self.area == 0:
+            return 0
+        return max(self.mask.shape[0] - 1, self.mask.shape[1] - 1)
+
+    def to_mask(self):
+        """
+        :return: (h, w) full-size bool mask
+        """
+        mask = np.zeros(self.shape, dtype=np.bool_)
+        if self.area > 0:
+            mask[self.rect] = self.mask
+        return mask
+
+    def iou(self, other):
+        """
+        Intersection over union, computed on the intersection of bounding boxes only.
+        """
+        if self.area == 0 or other.area == 0:
+            return 0.0
+        (y1, x1), (y2, x2) = self.offset, other.offset
+        top, left = max(y1, y2), max(x1, x2)
+        bottom = min(y1 + self.mask.shape[0], y2 + other.mask.shape[0])
+        right = min(x1 + self.mask.shape[1], x2 + other.mask.shape[1])
+        if top >= bottom or left >= right:
+            return 0.0
+        a = self.mask[top - y1:bottom - y1, left - x1:right - x1]
+        b = other.mask[top - y2:bottom - y2, left - x2:right - x2]
+        intersection = np.count_nonzero(a & b)
+        if intersection == 0:
+            return 0.0
+        return intersection / (self.area + other.area - intersection)
+
+    def flip(self, orientation=0):
+        """
+        :param orientation: 0=vertical, 1=horizontal, as cv2.flip
+        :return: flipped Instance
+        """
+        if self.area == 0:
+            return self
+        (y, x), (h, w) = self.offset, self.mask.shape
+        if orientation == 0:
+            return Instance(self.shape, (self.shape[0] - y - h, x), self.mask[::-1].copy(), self.score, self.area)
+        return Instance(self.shape, (y, self.shape[1] - x - w), self.mask[:, ::-1].copy(), self.score, self.area)
+
+    def clip(self, h, w):
+        """
+        :return: Instance in the (h, w) image, cut at its border
+        """
+        y, x = self.offset
+        crop = self.mask[:max(h - y, 0), :max(w - x, 0)]
+        return Instance.from_crop((h, w), self.offset, crop, self.score)
+
+    def resize(self, h, w):
+        """
+        Resize as cv2.resize(INTER_AREA) of the full-size mask with a threshold at 0.5, only on the crop.
+        :return: Instance in the (h, w) image
+        """
+        if self.area == 0:
+            return Instance((h, w), (0, 0), self.mask, self.score, 0)
+        (y, x), (mh, mw) = self.offset, self.mask.shape
+        weights_y, oy = _resize_weights(self.shape[0], h, y, mh)
+        weights_x, ox = _resize_weights(self.shape[1], w, x, mw)
+        resized = np.dot(np.dot(weights_y, self.mask.astype(np.float32)), weights_x.T)
+        # as (mask * 255).astype(np.uint8) >> 7
+        return Instance.from_crop((h, w), (oy, ox), resized * 255 >= 127.5, self.score)
+
+    def fill_holes(self):
+        """
+        :return: Instance whose holes are filled. The crop is enough, since the outside of it is background.
+        """
+        if self.area == 0:
+            return self
+        return Instance(self.shape, self.offset, ndimage.morphology.binary_fill_holes(self.mask), self.score)
+
+
+class PackedInstances:
+    """
+    Compact record of the instances of an image, to be pickled.
+    Crops are bit-packed back-to-back, and bounding boxes, areas and float32 scores are kept as arrays,
+    so that they are available without unpacking any crop.
+    """
+    def __init__(self, shape, offsets, sizes, areas, scores, byte_offsets, bits):
+        self.shape = (int(shape[0]), int(shape[1]))
+        self.offsets = offsets              # (n, 2) int32, (y, x) of crops
+        self.sizes = sizes                  # (n, 2) int32, (h, w) of crops
+        self.areas = areas                  # (n,) int32
+        self.scores = scores                # (n,) float32
+        self.byte_offsets = byte_offsets    # (n + 1,) int64, crop i is bits[byte_offsets[i]:byte_offsets[i + 1]]
+        self.bits = bits                    # uint8
+
+    @staticmethod
+    def pack(instances, scores, shape=None):
+        """
+        :param instances: list of Instances or full-size masks
+        :param scores: list of scores
+        :param shape: (h, w) of the image, taken from the instances if None
+        """
+        instances = [to_instance(x) for x in instances]
+        if shape is None:
+            shape = instances[0].shape if len(instances) > 0 else (0, 0)
+        crops = [np.packbits(x.mask.ravel()) for x in instances]
+        return PackedInstances(
+            shape,
+            np.array([x.offset for x in instances], dtype=np.int32).reshape((-1, 2)),
+            np.array([x.mask.shape for x in instances], dtype=np.int32).reshape((-1, 2)),
+            np.array([x.area for x in instances], dtype=np.int32),
+            np.array(scores, dtype=np.float32),
+            np.cumsum([0] + [len(x) for x in crops], dtype=np.int64),
+            np.concatenate(crops) if crops else np.zeros((0,), dtype=np.uint8)
+        )
+
+    def __len__(self):
+        return len(self.areas)
+
+    def __getitem__(self, idx):
+        """
+        :return: idx-th Instance, only its crop is unpacked.
+        """
+        h, w = self.sizes[idx]
+        bits = self.bits[self.byte_offsets[idx]:self.byte_offsets[idx + 1]]
+        mask = np.unpackbits(bits, count=int(h * w)).astype(np.bool_).reshape((h, w))
+        return Instance(self.shape, self.offsets[idx], mask, float(self.scores[idx]), self.areas[idx])
+
+    @property
+    def bboxes(self):
+        """
+        :return: (n, 4) of (rmin, rmax, cmin, cmax) inclusive
+        """
+        return np.concatenate([
+            self.offsets[:, :1], self.offsets[:, :1] + self.sizes[:, :1] - 1,
+            self.offsets[:, 1:], self.offsets[:, 1:] + self.sizes[:, 1:] - 1
+        ], axis=1)
+
+    def unpack(self):
+        """
+        :return: (list of Instances, list of scores)
+        """
+        return [self[idx] for idx in range(len(self))], [float(x) for x in self.scores]
+
+
+def _resize_weights(src, dst, start, length):
+    """
+    Rows of the linear map cv2.resize(INTER_AREA) along an axis, for the input range [start, start + length).
+    :return: (weights of (n, length), output offset)
+    """
+    partial_eye = np.zeros((src, length), dtype=np.float32)
+    partial_eye[np.arange(start, start + length), np.arange(length)] = 1.0
+    weights = cv2.resize(partial_eye, (length, dst), interpolation=cv2.INTER_AREA)
+    rows = np.flatnonzero(np.any(weights > 0, axis=1))
+    return weights[rows[0]:rows[-1] + 1], rows[0]
+
+
+def to_instance(x):
+    """
+    :param x: Instance or full-size mask
+    :return: Instance
+    """
+    if isinstance(x, Instance):
+        return x
+    return Instance.from_mask(x)
+
+
+def instances_from_label(label, scores=None):
+    """
+    :param label: (h, w) or (h, w, 1) label image
+    :return: list of Instances, in the order of labels. empty labels are skipped.
+    """
+    label = np.asarray(label)
+    if len(label.shape) == 3:
+        label = label[..., 0]
+    instances = []
+    for idx, rect in enumerate(ndimage.find_objects(label)):
+        if rect is None:
+            continue
+        instances.append(Instance.from_crop(
+            label.shape, (rect[0].start, rect[1].start), label[rect] == (idx + 1),
+            scores[idx] if scores is not None else None
+        ))
+    return instances
+
+
+def paint_instances(instances, shape):
+    """
+    :return: (h, w) int32 label image of i+1 for i-th instance. a later one wins on overlapped pixels.
+    """
+    label = np.zeros(shape, dtype=np.int32)
+    for idx, instance in enumerate(instances):
+        if instance.area > 0:
+            label[instance.rect][instance.mask] = idx + 1
+    return label
+
+
+class BBoxIndex:
+    """
+    Uniform grid over the bounding boxes of Instances, built once per image.
+    A query returns only the instances whose bounding boxes overlap the given one.
+    """
+    def __init__(self, instances, cell_size=32):
+        """
+        :param instances: list of Instances
+        :param cell_size: size of a grid cell in pixels
+        """
+        self.cell_size = cell_size
+        self.cells = defaultdict(list)
+        # (rmin, rmax, cmin, cmax) inclusive, an empty instance never overlaps.
+        self.bboxes = np.array([[1, 0, 1, 0]] * len(instances), dtype=np.int64).reshape((-1, 4))
+        for idx, instance in enumerate(instances):
+            bbox = instance.bbox
+            if bbox is None:
+                continue
+            self.bboxes[idx] = bbox
+            for cell in self._cells_of(bbox):
+                self.cells[cell].append(idx)
+
+    def __len__(self):
+        return len(self.bboxes)
+
+    def _cells_of(self, bbox):
+        rmin, rmax, cmin, cmax = [v // self.cell_size for v in bbox]
+        for cy in range(rmin, rmax + 1):
+            for cx in range(cmin, cmax + 1):
+                yield cy, cx
+
+    def query(self, bbox):
+        """
+        :param bbox: (rmin, rmax, cmin, cmax) inclusive, or None
+        :return: sorted int array of indices whose bounding boxes overlap the bbox
+        """
+        if bbox is None:
+            return np.zeros((0,), dtype=np.int64)
+        candidates = set()
+        for cell in self._cells_of(bbox):
+            candidates.update(self.cells.get(cell, []))
+        candidates = np.array(sorted(candidates), dtype=np.int64)
+
+        rmin, rmax, cmin, cmax = bbox
+        b = self.bboxes[candidates]
+        overlapped = (b[:, 0] <= rmax) & (rmin <= b[:, 1]) & (b[:, 2] <= cmax) & (cmin <= b[:, 3])
+        return candidates[overlapped]
+
+
+def pairwise_iou(instances, others=None):
+    """
+    Sparse iou matrix, computed only on the pairs whose bounding boxes overlap.
+    :param instances: list of Instances
+    :param others: list of Instances, or None for the pairs within instances(the diagonal is 1 for a non-empty one)
+    :return: scipy.sparse.csr_matrix of (len(instances), len(others)). missing entries are 0.
+    """
+    symmetric = others is None
+    if symmetric:
+        others = instances
+    index = BBoxIndex(others)
+
+    rows, cols, values = [], [], []
+    for idx1, instance in enumerate(instances):
+        for idx2 in index.query(instance.bbox):
+            if symmetric and idx2 < idx1:
+                continue
+            iou = instance.iou(others[idx2])
+            if iou <= 0.0:
+                continue
+            rows.append(idx1)
+            cols.append(idx2)
+            values.append(iou)
+            if symmetric and idx2 != idx1:
+                rows.append(idx2)
+                cols.append(idx1)
+                values.append(iou)
+    return sparse.csr_matrix((values, (rows, cols)), shape=(len(instances), len(others)), dtype=np.float64)
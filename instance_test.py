@@ -0,0 +1,95 @@
+import unittest
+
+import cv2
+import numpy as np
+from scipy import ndimage
+
+from instance import BBoxIndex, Instance, PackedInstances, instances_from_label, paint_instances, pairwise_iou
+from submission import get_iou1
+
+
+class TestInstance(unittest.TestCase):
+    def setUp(self):
+        self.mask = np.zeros((40, 50), dtype=np.bool_)
+        self.mask[5:20, 10:18] = True
+        self.mask[10:14, 12:15] = False    # a hole
+        self.other = np.roll(self.mask, 4, axis=1)
+
+    def test_crop(self):
+        instance = Instance.from_mask(self.mask[..., np.newaxis], score=0.7)
+        self.assertEqual(instance.shape, (40, 50))
+        self.assertEqual(instance.bbox, (5, 19, 10, 17))
+        self.assertEqual(instance.mask.shape, (15, 8))
+        self.assertEqual(instance.area, np.sum(self.mask))
+        self.assertEqual(instance.size, 14)
+        self.assertTrue(np.array_equal(instance.to_mask(), self.mask))
+
+        empty = Instance.from_mask(np.zeros((40, 50)))
+        self.assertEqual(empty.area, 0)
+        self.assertIsNone(empty.bbox)
+        self.assertEqual(np.sum(empty.to_mask()), 0)
+
+    def test_iou(self):
+        a, b = Instance.from_mask(self.mask), Instance.from_mask(self.other)
+        self.assertAlmostEqual(a.iou(b), get_iou1(self.mask, self.other), delta=1e-6)
+        self.assertAlmostEqual(a.iou(a), 1.0, delta=1e-6)
+        self.assertEqual(a.iou(Instance.from_mask(np.roll(self.mask, 20, axis=0))), 0.0)
+
+    def test_ops(self):
+        instance = Instance.from_mask(self.mask)
+        for orientation in range(2):
+            flipped = cv2.flip(self.mask.astype(np.uint8), orientation) > 0
+            self.assertTrue(np.array_equal(instance.flip(orientation).to_mask(), flipped))
+        self.assertTrue(np.array_equal(instance.fill_holes().to_mask(), ndimage.morphology.binary_fill_holes(self.mask)))
+        self.assertTrue(np.array_equal(instance.clip(12, 15).to_mask(), self.mask[:12, :15]))
+
+        for h, w in [(20, 25), (80, 100), (33, 71)]:
+            resized = cv2.resize(self.mask.astype(np.uint8) * 255, (w, h), interpolation=cv2.INTER_AREA) >> 7
+            self.assertTrue(np.array_equal(instance.resize(h, w).to_mask(), resized > 0))
+
+    def test_label(self):
+        label = np.zeros((40, 50), dtype=np.int32)
+        label[self.mask] = 1
+        label[30:35, 30:35] = 3
+        instances = instances_from_label(label, scores=[0.1, 0.2, 0.3])
+        self.assertEqual(len(instances), 2)
+        self.assertListEqual([x.score for x in instances], [0.1, 0.3])
+        self.assertTrue(np.array_equal(paint_instances(instances, label.shape), np.minimum(label, 2)))
+
+    def test_bbox_index(self):
+        instances = [Instance.from_mask(self.mask), Instance.from_mask(self.other), Instance.from_mask(np.zeros((40, 50)))]
+        instances.append(Instance.from_mask(np.roll(self.mask, 20, axis=0)))
+        index = BBoxIndex(instances, cell_size=8)
+        self.assertListEqual(list(index.query(instances[0].bbox)), [0, 1])
+        self.assertListEqual(list(index.query((0, 39, 0, 49))), [0, 1, 3])
+        self.assertListEqual(list(index.query((30, 39, 0, 5))), [])
+        self.assertListEqual(list(index.query(None)), [])
+
+    def test_pairwise_iou(self):
+        masks = [self.mask, self.other, np.zeros((40, 50)), np.roll(self.mask, 20, axis=0)]
+        instances = [Instance.from_mask(x) for x in masks]
+        ious = pairwise_iou(instances).toarray()
+        expected = np.array([[get_iou1(a, b) if np.any(a) and np.any(b) else 0.0 for b in masks] for a in masks])
+        self.assertTrue(np.allclose(ious, expected, atol=1e-6))
+
+        ious = pairwise_iou(instances[:1], instances[1:])
+        self.assertEqual(ious.shape, (1, 3))
+        self.assertEqual(ious.nnz, 1)
+
+    def test_packed(self):
+        instances = [Instance.from_mask(self.mask), Instance.from_mask(np.zeros((40, 50))), Instance.from_mask(self.other)]
+        packed = PackedInstances.pack(instances, [0.5, 0.6, 0.7])
+        self.assertEqual(len(packed), 3)
+        self.assertListEqual(list(packed.bboxes[0]), list(instances[0].bbox))
+        self.assertListEqual(list(packed.areas), [x.area for x in instances])
+
+        unpacked, scores = packed.unpack()
+        self.assertAlmostEqual(scores[2], 0.7, delta=1e-6)
+        for a, b in zip(instances, unpacked):
+            self.assertTrue(np.array_equal(a.to_mask(), b.to_mask()))
+
+        self.assertEqual(len(PackedInstances.pack([], [])), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,9 +11,9 @@ from skimage.morphology import label
 from colors import get_colors
 from data_augmentation import get_size_of_mask
 from hyperparams import HyperParams
+from instance import Instance, to_instance, paint_instances, pairwise_iou
 from data_feeder import batch_to_multi_masks
 from separator import separation
-from submission import get_iou
 
 
 class Network:
@@ -66,19 +66,21 @@ class Network:
     def visualize_segments(segments, original_image):
         """
         Visualize Segments
-        :param segments: (# of instances, h, w) or list of (h, w)
+        :param segments: (# of instances, h, w) or list of Instances
         :return: (h, w, 3) numpy image with colored instances
         """
         if not isinstance(segments, list):
-            segments = Network.parse_merged_output(segments)
+            segments, _ = Network.parse_merged_output(segments)
 
         img_h, img_w = original_image.shape[:2]
         canvas = np.zeros((img_h, img_w, 3), dtype=np.uint8)
         for idx, seg in enumerate(segments):
+            seg = to_instance(seg)
+            if seg.area == 0:
+                continue
             r, g, b = get_colors(idx)
-            canvas[:, :, 0] = canvas[:, :, 0] + b * seg[:, :]
-            canvas[:, :, 1] = canvas[:, :, 1] + g * seg[:, :]
-            canvas[:, :, 2] = canvas[:, :, 2] + r * seg[:, :]
+            region = canvas[seg.rect]
+            region[seg.mask] += np.array([b, g, r], dtype=np.uint8)
         return canvas
 
     @staticmethod
@@ -93,69 +95,88 @@ class Network:
     @staticmethod
     def parse_merged_output(output, cutoff=0.5, cutoff_instance_max=0.8, cutoff_instance_avg=0.2):
         """
-        Split 1-channel merged output for instance segmentation
+        Split 1-channel merged output for instance segmentation.
+        Scores are reduced by labels, and dilation & hole filling are done on the bounding box of each instance.
         :param cutoff:
-        :param output: (h, w, 1) segmentation image
-        :return: list of (h, w, 1). instance-aware segmentations.
+        :param output: (h, w) or (h, w, 1) segmentation image
+        :return: (list of Instances, list of scores)
         """
+        output = output.reshape(output.shape[:2])
+        img_h, img_w = output.shape
+
         cutoffed = output > cutoff
         lab_img = label(cutoffed, connectivity=1)
-        instances = []
-        for i in range(1, lab_img.max() + 1):
-            instances.append((lab_img == i).astype(np.bool))
+        num_instances = lab_img.max()
+        if num_instances == 0:
+            return [], []
 
-        filtered_instances = []
-        scores = []
-        for instance in instances:
+        index = np.arange(1, num_instances + 1)
+        scores_max = ndimage.maximum(output, lab_img, index)    # score max
+        scores_avg = ndimage.sum(output, lab_img, index) / np.bincount(lab_img.ravel())[1:]    # score avg
+
+        # list of (bounding box, mask in the box, score)
+        dilation_iter = HyperParams.get().post_dilation_iter
+        crops = []
+        for i, rect in enumerate(ndimage.find_objects(lab_img)):
             # TODO : max or avg?
-            instance_score_max = np.max(instance * output)    # score max
-            if instance_score_max < cutoff_instance_max:
+            if scores_max[i] < cutoff_instance_max:
                 continue
-            instance_score_avg = np.sum(instance * output) / np.sum(instance)   # score avg
-            if instance_score_avg < cutoff_instance_avg:
+            if scores_avg[i] < cutoff_instance_avg:
                 continue
-            filtered_instances.append(instance)
-            scores.append(instance_score_avg)
-        instances = filtered_instances
-
-        # dilation
-        instances_tmp = []
-        if HyperParams.get().post_dilation_iter > 0:
-            for instance in filtered_instances:
-                instance = ndimage.morphology.binary_dilation(instance, iterations=HyperParams.get().post_dilation_iter)
-                instances_tmp.append(instance)
-            instances = instances_tmp
+
+            # dilation
+            if dilation_iter > 0:
+                rect = (
+                    slice(max(rect[0].start - dilation_iter, 0), min(rect[0].stop + dilation_iter, img_h)),
+                    slice(max(rect[1].start - dilation_iter, 0), min(rect[1].stop + dilation_iter, img_w))
+                )
+                mask = ndimage.morphology.binary_dilation(lab_img[rect] == (i + 1), iterations=dilation_iter)
+            else:
+                mask = lab_img[rect] == (i + 1)
+            crops.append((rect, mask, float(scores_avg[i])))
 
         # sorted by size
-        sorted_idx = [i[0] for i in sorted(enumerate(instances), key=lambda x: get_size_of_mask(x[1]))]
-        instances = [instances[x] for x in sorted_idx]
-        scores = [scores[x] for x in sorted_idx]
+        crops = sorted(crops, key=lambda x: get_size_of_mask(x[1]))
 
-        # make sure there are no overlaps
-        instances, scores = Network.remove_overlaps(instances, scores)
+        # make sure there are no overlaps, a bigger one wins
+        lab_img = np.zeros((img_h, img_w), dtype=np.int32)
+        for i, (rect, mask, _) in enumerate(crops):
+            lab_img[rect][mask] = i + 1
 
-        # fill holes
-        if HyperParams.get().post_fill_holes:
-            instances = [ndimage.morphology.binary_fill_holes(i) for i in instances]
+        instances = []
+        scores = []
+        for i, rect in enumerate(ndimage.find_objects(lab_img)):
+            if rect is None:
+                continue
+            instance = Instance.from_crop((img_h, img_w), (rect[0].start, rect[1].start), lab_img[rect] == (i + 1), crops[i][2])
+
+            # fill holes
+            if HyperParams.get().post_fill_holes:
+                instance = instance.fill_holes()
+
+            instances.append(instance)
+            scores.append(crops[i][2])
 
         return instances, scores
 
     @staticmethod
     def remove_overlaps(instances, scores):
+        """
+        :param instances: list of Instances or (h, w) masks. a later one wins on overlapped pixels.
+        :return: (list of non-overlapped Instances, list of scores). fully covered ones are removed.
+        """
         if len(instances) == 0:
             return [], []
-        lab_img = np.zeros(instances[0].shape, dtype=np.int32)
-        for i, instance in enumerate(instances):
-            lab_img = np.maximum(lab_img, instance * (i + 1))
-        instances = []
+        instances = [to_instance(x) for x in instances]
+        lab_img = paint_instances(instances, instances[0].shape)
+        new_instances = []
         new_scores = []
-        for i in range(1, lab_img.max() + 1):
-            instance = (lab_img == i).astype(np.bool)
-            if np.max(instance) == 0:
+        for i, rect in enumerate(ndimage.find_objects(lab_img)):
+            if rect is None:
                 continue
-            instances.append(instance)
-            new_scores.append(scores[i - 1])
-        return instances, new_scores
+            new_instances.append(Instance.from_crop(lab_img.shape, (rect[0].start, rect[1].start), lab_img[rect] == (i + 1), scores[i]))
+            new_scores.append(scores[i])
+        return new_instances, new_scores
 
     @staticmethod
     def watershed_merged_output(instances):
@@ -196,54 +217,61 @@ class Network:
 
     @staticmethod
     def resize_instances(instances, target_size):
+        """
+        Resize instances on their bounding boxes, then make sure that there are no overlappings(a later one wins).
+        :param instances: list of Instances or (h, w) masks
+        :return: list of Instances of the same length, so that scores are kept aligned. covered ones become empty.
+        """
         h, w = target_size
+        instances = [to_instance(x).resize(h, w) for x in instances]
 
-        def resize_instance(instance):
-            shp = instance.shape
-            instance = (instance * 255).astype(np.uint8)
-            instance = cv2.resize(instance, (w, h), interpolation=cv2.INTER_AREA)
-            instance = instance >> 7
-            if len(shp) > len(instance.shape):
-                instance = instance[..., np.newaxis]
-            assert len(shp) == len(instance.shape)
-            return instance
-
-        instances = [resize_instance(instance) for instance in instances]
-
-        # make sure that there are no overlappings
-        if len(instances) > 0 and len(instances[0].shape) == 2:
-            lab_img = np.zeros((h, w), dtype=np.int32)
-        else:
-            lab_img = np.zeros((h, w, 1), dtype=np.int32)
-        for i, instance in enumerate(instances):
-            lab_img = np.maximum(lab_img, instance * (i+1))
+        lab_img = paint_instances(instances, (h, w))
         new_instances = []
-        for i in range(1, lab_img.max() + 1):
-            new_instances.append(lab_img == i)
+        for i, instance in enumerate(instances):
+            if instance.area == 0:
+                new_instances.append(instance)
+                continue
+            crop = lab_img[instance.rect] == (i + 1)
+            new_instances.append(Instance.from_crop((h, w), instance.offset, crop, instance.score))
 
         return new_instances
 
     @staticmethod
-    def nms(instances, scores, from_set=None, thresh=0.3):
+    def nms_indices(scores, ious, from_set=None, thresh=0.3):
+        """
+        Greedy non-maximum suppression over a precomputed iou matrix.
+        :param ious: sparse (n, n) iou matrix, as pairwise_iou()
+        :param from_set: optional list of n, instances from the same set never suppress each other.
+        :return: list of kept indices, in the order of scores
+        """
         scores = np.array(scores)
+        ious = ious.tocsr()
+        from_set = np.array(from_set) if from_set is not None else None
         order = scores.argsort()[::-1]
 
         keep = []
-        while order.size > 0:
-            idx1 = order[0]
+        suppressed = np.zeros((len(scores),), dtype=np.bool_)
+        for idx1 in order:
+            if suppressed[idx1]:
+                continue
             keep.append(idx1)
 
-            ovr = []
-            for idx2 in order[1:]:
-                if from_set is not None and from_set[idx1] == from_set[idx2]:
-                    ovr.append(0.0)
-                    continue
-                ovr.append(get_iou(instances[idx1], instances[idx2]))
-            ovr = np.array(ovr, dtype=np.float32)
+            row = slice(ious.indptr[idx1], ious.indptr[idx1 + 1])
+            overlapped = ious.indices[row][ious.data[row] > thresh]
+            if from_set is not None:
+                overlapped = overlapped[from_set[overlapped] != from_set[idx1]]
+            suppressed[overlapped] = True
 
-            inds = np.where(ovr <= thresh)[0]
-            order = order[inds + 1]
+        return keep
 
+    @staticmethod
+    def nms(instances, scores, from_set=None, thresh=0.3, ious=None):
+        """
+        :param ious: precomputed pairwise_iou(instances), computed here if None
+        """
+        if ious is None:
+            ious = pairwise_iou([to_instance(x) for x in instances])
+        keep = Network.nms_indices(scores, ious, from_set, thresh)
         return [instances[x] for x in keep], [scores[x] for x in keep]
 
     def __init__(self):
@@ -265,6 +293,27 @@ class Network:
     def build(self):
         pass
 
+    def get_tile_batcher(self):
+        """
+        :return: TileBatcher of the input of the network, None if it does not run on sliding windows
+        """
+        return None
+
+    def predict_probs(self, tf_sess, images):
+        """
+        Probability maps of images, whose tiles are run through the network in shared batches.
+        :param images: list of (h, w, c) images, which may have different sizes
+        :return: list of (h, w) float32 maps
+        """
+        tile_batcher = self.get_tile_batcher()
+        if tile_batcher is None:
+            raise Exception('predict_probs is not supported by %s' % self.__class__.__name__)
+        input_batch = self.get_placeholders()[0]
+        return tile_batcher.predict(images, lambda batch: tf_sess.run(self.get_output(), feed_dict={
+            input_batch: batch,
+            self.get_is_training(): False
+        }))
+
     @abc.abstractmethod
     def inference(self, tf_sess, image):
         """
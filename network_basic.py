@@ -7,7 +7,9 @@ from data_augmentation import data_to_segment_input, \
     random_color, data_to_normalize1, data_to_elastic_transform_wrapper, random_color2, erosion_mask, random_crop, \
     resize_shortedge_if_small, center_crop
 from data_feeder import CellImageDataManagerTrain, CellImageDataManagerValid, CellImageDataManagerTest
+from hyperparams import HyperParams
 from network import Network
+from tile_batcher import TileBatcher, get_receptive_margin
 
 from tensorpack.dataflow.common import BatchData, MapData, MapDataComponent
 from tensorpack.dataflow.parallel import PrefetchData
@@ -32,6 +34,11 @@ class NetworkBasic(Network):
         self.loss = None
         self.loss_opt = None
         self.unet_weight = unet_weight
+        # receptive field of build() : preconvs, 4 x (conv, pool), conv5, bilinear upsampling to 112, conv_last and
+        # bilinear upsampling to 224. offsets are aligned to 4 poolings, so that tiles share the phase of the resizes.
+        margin = get_receptive_margin([(3, 1), (3, 1), (1, 1)] + [(3, 1), (3, 2)] * 4 + [(3, 1), (3, 1 / 8.0), (5, 1), (3, 1 / 2.0)])
+        self.tile_batcher = TileBatcher(224, 0.5, memory_budget=HyperParams.get().test_tile_memory,
+                                        exact='basic' in HyperParams.get().test_tile_exact, margin=margin, align=16)
 
     def get_placeholders(self):
         return self.input_batch, self.mask_batch, self.unused
@@ -199,28 +206,12 @@ class NetworkBasic(Network):
         x = data_to_normalize1(x)
         return x
 
+    def get_tile_batcher(self):
+        return self.tile_batcher
+
     def inference(self, tf_sess, image):
-        cascades, windows = Network.sliding_window(image, 224, 0.5)
-
-        outputs = tf_sess.run(self.get_output(), feed_dict={
-            self.input_batch: cascades,
-            self.is_training: False
-        })
-
-        # merge multiple results
-        merged_output = np.zeros((image.shape[0], image.shape[1], 1), dtype=np.float32)
-        # merged_counts = np.zeros((image.shape[0], image.shape[1], 1), dtype=np.int32)
-        for window, output in zip(windows, outputs):
-            # suppress with maximum value
-            merged_output[window.indices()] = np.maximum(output, merged_output[window.indices()])
-            # suppress with average
-            # merged_output[window.indices()] = output + merged_output[window.indices()]
-            # merged_counts[window.indices()] = merged_counts[window.indices()] + 1
-
-        # notzeroidx = merged_counts > 0
-        # merged_output[notzeroidx] = merged_output[notzeroidx] / merged_counts[notzeroidx]
-
-        merged_output = merged_output.reshape((image.shape[0], image.shape[1]))
+        # merge multiple results, suppressed with maximum value
+        merged_output = self.predict_probs(tf_sess, [image])[0]
 
         # sementation to instance-aware segmentations.
         instances, scores = Network.parse_merged_output(
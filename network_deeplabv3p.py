@@ -10,9 +10,11 @@ from data_augmentation import data_to_segment_input, \
 from data_feeder import CellImageDataManagerTrain, CellImageDataManagerValid, CellImageDataManagerTest
 from tensorpack.dataflow.common import BatchData, MapData, MapDataComponent
 from tensorpack.dataflow.parallel import PrefetchData
+from data_shm import SharedMemoryPrefetchData
 
 from hyperparams import HyperParams
 from network import Network
+from tile_batcher import TileBatcher
 
 
 class NetworkDeepLabV3p(Network):
@@ -23,6 +25,10 @@ class NetworkDeepLabV3p(Network):
         self.atrous_rates = [6, 12, 18]
         self.output_stride = 16
         self.batchsize = batchsize
+        # image-level pooling of ASPP makes every output depend on the whole tile, so tiles are always max-merged
+        if 'deeplabv3p' in HyperParams.get().test_tile_exact:
+            raise Exception('exact tiles are not supported by deeplabv3p, remove it from test_tile_exact')
+        self.tile_batcher = TileBatcher(self.img_size, 0.5, memory_budget=HyperParams.get().test_tile_memory)
 
         self.input_batch = tf.placeholder(tf.float32, shape=(None, self.img_size, self.img_size, 3), name='image')
         self.mask_batch = tf.placeholder(tf.float32, shape=(None, self.img_size, self.img_size, 1), name='mask')
@@ -77,9 +83,15 @@ class NetworkDeepLabV3p(Network):
         # ds_train = MapDataComponent(ds_train, data_to_elastic_transform_wrapper)
         ds_train = MapDataComponent(ds_train, erosion_mask)
         ds_train = MapData(ds_train, lambda x: data_to_segment_input(x, is_gray=False, unet_weight=True))
-        ds_train = PrefetchData(ds_train, 256, 24)
-        ds_train = BatchData(ds_train, self.batchsize)
-        ds_train = MapDataComponent(ds_train, data_to_normalize1)
+        if HyperParams.get().data_shm_prefetch:
+            # batches are built in workers and passed through shared memory, not pickled
+            ds_train = BatchData(ds_train, self.batchsize)
+            ds_train = MapDataComponent(ds_train, data_to_normalize1)
+            ds_train = SharedMemoryPrefetchData(ds_train, 32, 24)
+        else:
+            ds_train = PrefetchData(ds_train, 256, 24)
+            ds_train = BatchData(ds_train, self.batchsize)
+            ds_train = MapDataComponent(ds_train, data_to_normalize1)
 
         ds_valid = CellImageDataManagerValid()
         ds_valid = MapDataComponent(ds_valid, lambda x: resize_shortedge_if_small(x, self.img_size))
@@ -107,26 +119,7 @@ class NetworkDeepLabV3p(Network):
 
     def inference(self, tf_sess, image, cutoff_instance_max=0.9, cutoff_instance_avg=0.0):
         # TODO : Mirror Padding?
-        cascades, windows = Network.sliding_window(image, self.img_size, 0.5)
-
-        # by batch
-        def chunker(seq, size):
-            return (seq[pos:pos + size] for pos in range(0, len(seq), size))
-
-        outputs = []
-        for b in chunker(cascades, 64):
-            output = tf_sess.run(self.get_output(), feed_dict={
-                self.input_batch: b,
-                self.is_training: False
-            })
-            outputs.append(output)
-        outputs = np.concatenate(outputs, axis=0)
-
-        # merge multiple results
-        merged_output = np.zeros((image.shape[0], image.shape[1], 1), dtype=np.float32)
-        for window, output in zip(windows, outputs):
-            merged_output[window.indices()] = np.maximum(output, merged_output[window.indices()])
-        merged_output = merged_output.reshape((image.shape[0], image.shape[1]))
+        merged_output = self.predict_probs(tf_sess, [image])[0]
 
         # sementation to instance-aware segmentations.
         instances, scores = Network.parse_merged_output(
@@ -143,6 +136,9 @@ class NetworkDeepLabV3p(Network):
             'scores': scores
         }
 
+    def get_tile_batcher(self):
+        return self.tile_batcher
+
     def get_logit(self):
         return self.logit
 
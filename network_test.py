@@ -1,10 +1,12 @@
 import unittest
 import numpy as np
 import cv2
+import tensorflow as tf
 
 from data_feeder import CellImageData, master_dir_train
 from network import Network
-from network_unet_valid import get_net_input_size
+from network_unet_valid import NetworkUnetValid, get_net_input_size, get_valid_output_size
+from tile_batcher import TileBatcher
 
 
 class TestNetwork(unittest.TestCase):
@@ -79,18 +81,44 @@ class TestNetwork(unittest.TestCase):
             [0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
         ], dtype=np.uint8)
         merged_output = merged_output[..., np.newaxis]
-        instances = Network.parse_merged_output(merged_output, use_separator=False)
+        instances, scores = Network.parse_merged_output(merged_output, cutoff_instance_max=0.5, cutoff_instance_avg=0.5)
         resized = Network.resize_instances(instances, (20, 30))
-        self.assertEqual(len(resized), 5)
-        self.assertEqual(resized[0].shape[0], 20)
-        self.assertEqual(resized[0].shape[1], 30)
-        self.assertEqual(resized[0].shape[2], 1)
+        self.assertEqual(len(resized), len(instances))
+        self.assertEqual(resized[0].shape, (20, 30))
+        self.assertEqual(resized[0].to_mask().shape, (20, 30))
 
     def test_unet_valid_input_size(self):
         # as in the original unet paper
         n = get_net_input_size(388, 4)
         self.assertEqual(n, 572)
 
+    def test_unet_valid_output_size(self):
+        self.assertEqual(get_valid_output_size(228, 4), 228)
+        self.assertEqual(get_valid_output_size(229, 4), 244)
+        for size in range(200, 300):
+            valid = get_valid_output_size(size, 4)
+            self.assertGreaterEqual(valid, size)
+            get_net_input_size(valid, 4)  # asserts even pooling
+            self.assertEqual(get_net_input_size(valid, 4) - valid, get_net_input_size(228, 4) - 228)
+
+    def test_unet_valid_exact_tiles(self):
+        # overlap-tile stitching gives the outputs of the whole image
+        tf.reset_default_graph()
+        network = NetworkUnetValid(batchsize=1)
+        network.build()
+        network.tile_batcher = TileBatcher(network.img_size, padding=network.pad_size, exact=True, align=2 ** network.num_block)
+
+        image = np.random.rand(500, 300, 3).astype(np.float32)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            tiled = network.get_tile_batcher().predict([image], lambda batch: sess.run(network.get_output(), feed_dict={
+                network.input_batch: batch,
+                network.is_training: False
+            }))[0]
+            whole = network.predict_whole(sess, [image])[0]
+        self.assertTupleEqual(tiled.shape, (500, 300))
+        self.assertTrue(np.allclose(tiled, whole, atol=1e-5))
+
     def test_watershed(self):
         d = CellImageData('d7db360fabfce9828559a21f6bffff589ae868e0dc6101d7c1212de34a25e3cb', path=master_dir_train)
         prev_mask_size = len(d.masks)
@@ -1,3 +1,5 @@
+import math
+
 import numpy as np
 import tensorflow as tf
 from tensorflow.contrib import slim
@@ -7,14 +9,16 @@ from data_augmentation import data_to_segment_input, \
     data_to_image, random_flip_lr, random_flip_ud, random_scaling, random_affine, \
     random_color, data_to_normalize1, data_to_elastic_transform_wrapper, resize_shortedge_if_small, random_crop, \
     center_crop, random_color2, erosion_mask, resize_shortedge, mask_size_normalize, crop_mirror, pad_if_small, \
-    mirror_pad, center_crop_if_tcga, random_add_thick_area
+    center_crop_if_tcga, random_add_thick_area, random_geometric, reflect_indices
 from data_feeder import CellImageDataManagerTrain, CellImageDataManagerValid, CellImageDataManagerTest
 from tensorpack.dataflow.common import BatchData, MapData, MapDataComponent
 from tensorpack.dataflow.parallel import PrefetchData, MultiThreadPrefetchData
+from data_shm import SharedMemoryPrefetchData
 
 from hyperparams import HyperParams
 from network import Network
 from network_basic import NetworkBasic
+from tile_batcher import TileBatcher
 
 
 def get_net_input_size(image_size, num_block):
@@ -28,6 +32,14 @@ def get_net_input_size(image_size, num_block):
     return network_input_size
 
 
+def get_valid_output_size(size, num_block):
+    """
+    :return: the smallest output size >= size, whose features are pooled evenly at every block.
+             those are 4 + k * 2^num_block, eg. 228 for 4 blocks.
+    """
+    return size + (4 - size) % (2 ** num_block)
+
+
 class NetworkUnetValid(NetworkBasic):
     def __init__(self, batchsize):
         super().__init__(batchsize, unet_weight=True)
@@ -37,9 +49,15 @@ class NetworkUnetValid(NetworkBasic):
         self.inp_size = get_net_input_size(self.img_size, self.num_block)
         assert (self.inp_size - self.img_size) % 2 == 0
         self.pad_size = (self.inp_size - self.img_size) // 2
+        # exact tiles give the same outputs as predict_whole
+        self.tile_batcher = TileBatcher(self.img_size, 0.5, padding=self.pad_size, memory_budget=HyperParams.get().test_tile_memory,
+                                        exact='unet' in HyperParams.get().test_tile_exact, align=2 ** self.num_block)
 
         self.batchsize = batchsize
         self.input_batch = tf.placeholder(tf.float32, shape=(None, self.img_size + self.pad_size * 2, self.img_size + self.pad_size * 2, 3), name='image')
+        # inference tower of dynamic height and width, see predict_whole
+        self.input_whole = tf.placeholder(tf.float32, shape=(None, None, None, 3), name='image_whole')
+        self.output_whole = None
         self.mask_batch = tf.placeholder(tf.float32, shape=(None, self.img_size, self.img_size, 1), name='mask')
         self.weight_batch = tf.placeholder(tf.float32, shape=(None, self.img_size, self.img_size, 1), name='weight')
         self.unused = None
@@ -53,11 +71,28 @@ class NetworkUnetValid(NetworkBasic):
         net = slim.convolution(net, nb_filter, [3, 3], 1, scope='%s_2' % scope)
         return net
 
-    def build(self):
+    @staticmethod
+    def crop_center(feat, target):
+        """
+        Crop features to the height and width of the target, around the center. Static shapes are kept if known.
+        """
+        if feat.shape[1:3].is_fully_defined() and target.shape[1:3].is_fully_defined():
+            y, x = [int(feat.shape[idx] - target.shape[idx]) // 2 for idx in [1, 2]]
+            h, w = map(int, target.shape[1:3])
+            return tf.slice(feat, [0, y, x, 0], [-1, h, w, -1])
+        feat_shape, target_shape = tf.shape(feat), tf.shape(target)
+        y, x = [(feat_shape[idx] - target_shape[idx]) // 2 for idx in [1, 2]]
+        return tf.slice(feat, tf.stack([0, y, x, 0]), tf.stack([-1, target_shape[1], target_shape[2], -1]))
+
+    def unet(self, net, is_training):
+        """
+        :param is_training: placeholder, or False for an inference-only tower, which adds no update ops
+        :return: logit
+        """
         # https://github.com/tensorflow/tensorflow/blob/master/tensorflow/contrib/layers/python/layers/layers.py#L429
         weight_init = tf.truncated_normal_initializer(mean=0.0, stddev=HyperParams.get().net_init_stddev)
         batch_norm_params = {
-            'is_training': self.is_training,
+            'is_training': is_training,
             'center': True,
             'scale': True,
             'decay': HyperParams.get().net_bn_decay,
@@ -68,7 +103,7 @@ class NetworkUnetValid(NetworkBasic):
 
         dropout_params = {
             'keep_prob': HyperParams.get().net_dropout_keep,
-            'is_training': self.is_training,
+            'is_training': is_training,
         }
 
         conv_args = {
@@ -80,8 +115,6 @@ class NetworkUnetValid(NetworkBasic):
             'weights_regularizer': slim.l2_regularizer(0.0001)
         }
 
-        net = self.input_batch
-
         features = []
         with slim.arg_scope([slim.convolution, slim.conv2d_transpose], **conv_args):
             with slim.arg_scope([slim.dropout], **dropout_params):
@@ -105,10 +138,7 @@ class NetworkUnetValid(NetworkBasic):
                     # get lower layer's feature
                     down_feat = features.pop()
                     assert net.shape[3] == down_feat.shape[3], '%d, %d, %d' % (i, net.shape[3], down_feat.shape[3])
-
-                    y, x = [int(down_feat.shape[idx] - net.shape[idx]) // 2 for idx in [1, 2]]
-                    h, w = map(int, net.shape[1:3])
-                    down_feat = tf.slice(down_feat, [0, y, x, 0], [-1, h, w, -1])
+                    down_feat = NetworkUnetValid.crop_center(down_feat, net)
 
                     net = tf.concat([down_feat, net], axis=-1)
                     net = NetworkUnetValid.double_conv(net, int(max_feature_size/(2**(i+1))), scope='up_conv_%d' % (i + 1))
@@ -118,6 +148,10 @@ class NetworkUnetValid(NetworkBasic):
                                activation_fn=None,
                                padding='SAME',
                                weights_initializer=weight_init)
+        return net
+
+    def build(self):
+        net = self.unet(self.input_batch, self.is_training)
 
         self.logit = net
         self.output = tf.nn.sigmoid(net, 'visualization')
@@ -132,27 +166,41 @@ class NetworkUnetValid(NetworkBasic):
             weights=w
         )
         self.loss_opt = self.loss
+
+        # same variables, so checkpoints are not changed
+        with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+            self.output_whole = tf.nn.sigmoid(self.unet(self.input_whole, False), 'visualization_whole')
         return net
 
     def get_input_flow(self):
         ds_train = CellImageDataManagerTrain()
         # ds_train = MapDataComponent(ds_train, random_affine)  # TODO : no improvement?
         ds_train = MapDataComponent(ds_train, random_color)
-        # ds_train = MapDataComponent(ds_train, random_scaling)
-        ds_train = MapDataComponent(ds_train, mask_size_normalize)  # Resize by instance size - normalization
-        ds_train = MapDataComponent(ds_train, lambda x: resize_shortedge_if_small(x, self.img_size))
-        # ds_train = MapDataComponent(ds_train, lambda x: pad_if_small(x, self.img_size)) # preseve cell's size
-        ds_train = MapDataComponent(ds_train, lambda x: random_crop(x, self.img_size, self.img_size, padding=self.pad_size))
-        # ds_train = MapDataComponent(ds_train, random_add_thick_area)      # TODO : worth?
-        ds_train = MapDataComponent(ds_train, random_flip_lr)
-        ds_train = MapDataComponent(ds_train, random_flip_ud)
+        if HyperParams.get().pre_fused_geometric:
+            # size normalization, crop and flips with a single warp
+            ds_train = MapDataComponent(ds_train, lambda x: random_geometric(x, self.img_size, padding=self.pad_size))
+        else:
+            # ds_train = MapDataComponent(ds_train, random_scaling)
+            ds_train = MapDataComponent(ds_train, mask_size_normalize)  # Resize by instance size - normalization
+            ds_train = MapDataComponent(ds_train, lambda x: resize_shortedge_if_small(x, self.img_size))
+            # ds_train = MapDataComponent(ds_train, lambda x: pad_if_small(x, self.img_size)) # preseve cell's size
+            ds_train = MapDataComponent(ds_train, lambda x: random_crop(x, self.img_size, self.img_size, padding=self.pad_size))
+            # ds_train = MapDataComponent(ds_train, random_add_thick_area)      # TODO : worth?
+            ds_train = MapDataComponent(ds_train, random_flip_lr)
+            ds_train = MapDataComponent(ds_train, random_flip_ud)
         # ds_train = MapDataComponent(ds_train, data_to_elastic_transform_wrapper)
         if self.unet_weight:
             ds_train = MapDataComponent(ds_train, erosion_mask)
         ds_train = MapData(ds_train, lambda x: data_to_segment_input(x, not self.is_color, self.unet_weight))
-        ds_train = PrefetchData(ds_train, 256, 24)
-        ds_train = BatchData(ds_train, self.batchsize)
-        ds_train = MapDataComponent(ds_train, data_to_normalize1)
+        if HyperParams.get().data_shm_prefetch:
+            # batches are built in workers and passed through shared memory, not pickled
+            ds_train = BatchData(ds_train, self.batchsize)
+            ds_train = MapDataComponent(ds_train, data_to_normalize1)
+            ds_train = SharedMemoryPrefetchData(ds_train, 32, 24)
+        else:
+            ds_train = PrefetchData(ds_train, 256, 24)
+            ds_train = BatchData(ds_train, self.batchsize)
+            ds_train = MapDataComponent(ds_train, data_to_normalize1)
 
         ds_valid = CellImageDataManagerValid()
         ds_valid = MapDataComponent(ds_valid, lambda x: resize_shortedge_if_small(x, self.img_size))
@@ -179,30 +227,63 @@ class NetworkUnetValid(NetworkBasic):
 
         return ds_train, ds_valid, ds_valid2, ds_test
 
-    def inference(self, tf_sess, image, cutoff_instance_max=0.0, cutoff_instance_avg=0.0):
-        # TODO : Mirror Padding?
-        cascades, windows = Network.sliding_window(image, self.img_size, 0.5)
-
-        # by batch
-        outputs = []
+    def predict_probs(self, tf_sess, images):
+        if HyperParams.get().test_whole_image:
+            return self.predict_whole(tf_sess, images)
+        return super().predict_probs(tf_sess, images)
+
+    def predict_whole(self, tf_sess, images):
+        """
+        Fully-convolutional inference of whole images, each pixel computed once.
+        An image is mirror-padded to a valid output size and run at once, or split into large tiles with exact context
+        margins if it exceeds test_whole_image_memory. Tile offsets are multiples of 2^num_block, so that pooling is
+        aligned as in the whole image, and tiles give the same outputs.
+        :return: list of (h, w) float32 maps
+        """
+        align = 2 ** self.num_block
         padding = self.pad_size
-        mirror_padded = mirror_pad(image, padding)
-        for ws in chunker(windows, 64):
-            b = []
-            for w in ws:
-                b.append(mirror_padded[w.y:w.y+w.h+padding*2, w.x:w.x+w.w+padding*2])
-            output = tf_sess.run(self.get_output(), feed_dict={
-                self.input_batch: b,
-                self.is_training: False
-            })
-            outputs.append(output)
-        outputs = np.concatenate(outputs, axis=0)
-
-        # merge multiple results
-        merged_output = np.zeros((image.shape[0], image.shape[1], 1), dtype=np.float32)
-        for window, output in zip(windows, outputs):
-            merged_output[window.indices()] = np.maximum(output, merged_output[window.indices()])
-        merged_output = merged_output.reshape((image.shape[0], image.shape[1]))
+        budget = HyperParams.get().test_whole_image_memory * 1024 * 1024
+        # float32 features of the first block, about 8 maps are alive at once
+        bytes_per_pixel = HyperParams.get().unet_base_feature * 4 * 8
+        max_pixels = max(budget // bytes_per_pixel, (self.img_size + padding * 2) ** 2)
+
+        def get_tile_size(out_size):
+            if (out_size + padding * 2) ** 2 <= max_pixels:
+                return out_size
+            tile_size = int(math.sqrt(max_pixels)) - padding * 2
+            tile_size -= (tile_size - 4) % align
+            return min(out_size, max(self.img_size, tile_size))
+
+        # tiles of the same shape are batched together, over images
+        padded_images, merged_outputs, jobs = [], [], {}
+        for idx, image in enumerate(images):
+            h, w = image.shape[:2]
+            out_h, out_w = get_valid_output_size(h, self.num_block), get_valid_output_size(w, self.num_block)
+            rows = reflect_indices(-padding, out_h + padding * 2, h)
+            cols = reflect_indices(-padding, out_w + padding * 2, w)
+            padded_images.append(np.asarray(image, dtype=np.float32)[np.ix_(rows, cols)])
+            merged_outputs.append(np.zeros((out_h, out_w), dtype=np.float32))
+
+            tile_h, tile_w = get_tile_size(out_h), get_tile_size(out_w)
+            # out_size - tile_size is a multiple of align, as both are valid output sizes
+            ys = list(range(0, out_h - tile_h, tile_h - tile_h % align)) + [out_h - tile_h]
+            xs = list(range(0, out_w - tile_w, tile_w - tile_w % align)) + [out_w - tile_w]
+            jobs.setdefault((tile_h, tile_w), []).extend([(idx, y, x) for y in ys for x in xs])
+
+        for (tile_h, tile_w), tiles in jobs.items():
+            batchsize = max(1, max_pixels // ((tile_h + padding * 2) * (tile_w + padding * 2)))
+            for ts in chunker(tiles, batchsize):
+                batch = np.stack([padded_images[idx][y:y + tile_h + padding * 2, x:x + tile_w + padding * 2] for idx, y, x in ts])
+                outputs = tf_sess.run(self.output_whole, feed_dict={
+                    self.input_whole: batch
+                })
+                # overlaps of tiles have the same outputs
+                for (idx, y, x), output in zip(ts, outputs):
+                    merged_outputs[idx][y:y + tile_h, x:x + tile_w] = output[:, :, 0]
+        return [merged[:image.shape[0], :image.shape[1]] for image, merged in zip(images, merged_outputs)]
+
+    def inference(self, tf_sess, image, cutoff_instance_max=0.0, cutoff_instance_avg=0.0):
+        merged_output = self.predict_probs(tf_sess, [image])[0]
 
         # sementation to instance-aware segmentations.
         instances, scores = Network.parse_merged_output(
@@ -0,0 +1,166 @@
+import json
+import logging
+import sys
+from collections import OrderedDict
+from itertools import product
+from multiprocessing import Pool
+
+import numpy as np
+from hyperopt import hp, fmin, tpe, Trials, STATUS_OK
+
+from data_feeder import CellImageDataManagerValid
+from hyperparams import HyperParams
+from instance import paint_instances
+from prob_cache import ProbMapCache, get_checkpoint_hash, parse_view_key
+from submission import get_label_metric, thr_list
+from train import Trainer, postprocess_views
+
+logger = logging.getLogger('postprocess_sweep')
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler(sys.stdout)
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter('[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s')
+ch.setFormatter(formatter)
+logger.handlers = []
+logger.addHandler(ch)
+
+GRID = OrderedDict([
+    ('post_cutoff_max_th', [0.7, 0.8, 0.9]),
+    ('post_cutoff_avg_th', [0.0, 0.2]),
+    ('post_dilation_iter', [1, 2, 3]),
+    ('post_voting_th', [3, 4, 5]),
+    ('test_aug_nms_iou', [0.2, 0.3, 0.4]),
+])
+
+TPE_SPACE = {
+    'post_cutoff_max_th': hp.uniform('post_cutoff_max_th', 0.5, 0.95),
+    'post_cutoff_avg_th': hp.uniform('post_cutoff_avg_th', 0.0, 0.5),
+    'post_dilation_iter': hp.choice('post_dilation_iter', [0, 1, 2, 3, 4]),
+    'post_voting_th': hp.choice('post_voting_th', [1, 2, 3, 4, 5, 6]),
+    'test_aug_nms_iou': hp.uniform('test_aug_nms_iou', 0.1, 0.6),
+}
+
+# set before the pool is forked, so that workers share the decoded label maps of every trial
+_cache = None
+_labels = {}
+
+
+def load_views(cache, image_id):
+    """
+    Views of the latest inference of an image, as Trainer.inference_views returns.
+    Only one rescaled scale is taken even if the index has several, so that a from_set is never duplicated.
+    :return: list of (from_set, prob, None) in the order of from_set, at most 6
+    """
+    views = {}
+    scales = set()
+    for view in cache.views(image_id):
+        orientation, scale = parse_view_key(view)
+        if scale is not None:
+            if scales and scale not in scales:
+                logger.warning('%s has several rescaled views, %s ignored' % (image_id, view))
+                continue
+            scales.add(scale)
+        from_set = (1 if scale is None else 4) + (0 if orientation is None else orientation + 1)
+        views[from_set] = (from_set, np.asarray(cache.get(image_id, view), dtype=np.float32), None)
+    return [views[from_set] for from_set in sorted(views.keys())]
+
+
+def _evaluate(args):
+    """
+    Post-process cached views of an image with the parameters, as Trainer.single_id does.
+    :return: score of the image, mean of tp / (tp + fp + fn) over iou thresholds
+    """
+    params, image_id = args
+    for k, v in params.items():
+        setattr(HyperParams.get(), k, v)
+
+    label_true = _labels[image_id]
+    views = load_views(_cache, image_id)
+    instances, _ = postprocess_views(views, label_true.shape[:2], num_views=min(len(views), 6))
+    tp, fp, fn = get_label_metric(paint_instances(instances, label_true.shape), label_true, thr_list)
+    return float(np.mean(tp / np.maximum(tp + fp + fn, 1)))
+
+
+class PostprocessSweep:
+    """
+    Search post-processing parameters over cached probability maps of the validation set, without the network.
+
+    Images of a trial are post-processed by a process pool, whose workers are forked once
+    and keep the decoded ground-truth label maps for every trial.
+    """
+    def __init__(self, cache, ids, processes=8):
+        global _cache, _labels
+        _cache = cache
+        trainer = Trainer()
+        _labels = {}
+        for image_id in ids:
+            d = trainer._get_cell_data(image_id, 'train')
+            _labels[image_id] = d.multi_masks_batch()[..., 0]
+        self.ids = ids
+        self.pool = Pool(processes=processes)
+        self.results = []
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def evaluate(self, params):
+        """
+        :return: mean score over images
+        """
+        scores = self.pool.map(_evaluate, [(params, image_id) for image_id in self.ids])
+        score = float(np.mean(scores))
+        self.results.append({'params': params, 'score': score})
+        logger.info('score=%.5f params=%s' % (score, params))
+        return score
+
+    def run_grid(self, grid=GRID):
+        for values in product(*grid.values()):
+            self.evaluate(OrderedDict(zip(grid.keys(), values)))
+        return self.results
+
+    def run_tpe(self, space=TPE_SPACE, max_evals=50):
+        def objective(params):
+            return {'loss': 1.0 - self.evaluate(params), 'status': STATUS_OK}
+        fmin(objective, space, algo=tpe.suggest, max_evals=max_evals, trials=Trials())
+        return self.results
+
+
+def sweep(checkpoint, cache='', search='grid', max_evals=50, processes=8, output=''):
+    """
+    :param checkpoint: checkpoint whose probability maps are cached, by Trainer.validate with test_prob_cache
+    :param cache: directory of the cache, test_prob_cache if empty
+    :param search: 'grid' or 'tpe'
+    :param output: json file of every configuration and its score
+    """
+    cache = ProbMapCache(cache or HyperParams.get().test_prob_cache, get_checkpoint_hash(checkpoint))
+    cached = set(cache.ids())
+    ids = [x for x in CellImageDataManagerValid.LIST if x in cached]
+    if len(ids) < len(CellImageDataManagerValid.LIST):
+        logger.warning('%d of %d validation images are not cached at %s' % (
+            len(CellImageDataManagerValid.LIST) - len(ids), len(CellImageDataManagerValid.LIST), cache.path))
+    if not ids:
+        raise Exception('no cached probability maps at %s' % cache.path)
+
+    s = PostprocessSweep(cache, ids, processes=processes)
+    try:
+        if search == 'grid':
+            results = s.run_grid()
+        elif search == 'tpe':
+            results = s.run_tpe(max_evals=max_evals)
+        else:
+            raise Exception('search(%s) is not valid' % search)
+    finally:
+        s.close()
+
+    results = sorted(results, key=lambda x: x['score'], reverse=True)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+    logger.info('best score=%.5f params=%s' % (results[0]['score'], results[0]['params']))
+    return results[0]
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(sweep)
@@ -0,0 +1,63 @@
+import shutil
+import tempfile
+import unittest
+from collections import OrderedDict
+
+import numpy as np
+
+import postprocess_sweep
+from prob_cache import ProbMapCache, get_view_key, parse_view_key
+
+
+class TestPostprocessSweep(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = ProbMapCache(self.path, 'checkpoint')
+
+        # two nuclei, predicted the same in every view
+        self.label = np.zeros((64, 64), dtype=np.int32)
+        self.label[10:30, 10:25] = 1
+        self.label[40:55, 30:60] = 2
+        prob = np.where(self.label > 0, 0.95, 0.05).astype(np.float32)
+
+        # rescaled views are cached at their resolution
+        prob_rescaled = np.repeat(np.repeat(prob, 2, axis=0), 2, axis=1)
+        views = [get_view_key(o, s) for s in [None, 2.0] for o in [None, 0, 1]]
+        for view in views:
+            self.cache.put('a', view, prob if parse_view_key(view)[1] is None else prob_rescaled)
+        # stale rescaled views of other parameters
+        for o in [None, 0, 1]:
+            self.cache.put('a', get_view_key(o, 0.75), np.zeros_like(prob))
+        self.cache.put_index('a', views)
+
+        postprocess_sweep._cache = self.cache
+        postprocess_sweep._labels = {'a': self.label}
+        self.params = OrderedDict([
+            ('post_cutoff_max_th', 0.8),
+            ('post_cutoff_avg_th', 0.0),
+            ('post_dilation_iter', 0),
+            ('post_voting_th', 5),
+            ('test_aug_nms_iou', 0.3),
+        ])
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_load_views(self):
+        views = postprocess_sweep.load_views(self.cache, 'a')
+        self.assertListEqual([from_set for from_set, _, _ in views], [1, 2, 3, 4, 5, 6])
+        self.assertTrue(all([np.max(prob) > 0.9 for _, prob, _ in views]))
+        self.assertListEqual([prob.shape for _, prob, _ in views], [(64, 64)] * 3 + [(128, 128)] * 3)
+
+    def test_evaluate(self):
+        self.assertAlmostEqual(postprocess_sweep._evaluate((self.params, 'a')), 1.0)
+
+        # a nucleus missing in the views
+        self.label[0:5, 0:5] = 3
+        score = postprocess_sweep._evaluate((self.params, 'a'))
+        self.assertLess(score, 1.0)
+        self.assertGreater(score, 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
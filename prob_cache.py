@@ -0,0 +1,141 @@
+import hashlib
+import json
+import logging
+import os
+import sys
+
+import numpy as np
+
+logger = logging.getLogger('prob_cache')
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler(sys.stdout)
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter('[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s')
+ch.setFormatter(formatter)
+logger.handlers = []
+logger.addHandler(ch)
+
+
+def get_checkpoint_hash(checkpoint):
+    """
+    :return: hash of the checkpoint's index file, which changes whenever the weights are saved again.
+             hash of the path if there is no index file.
+    """
+    sha1 = hashlib.sha1()
+    index_path = checkpoint + '.index'
+    if os.path.exists(index_path):
+        with open(index_path, 'rb') as f:
+            sha1.update(f.read())
+    else:
+        sha1.update(os.path.abspath(checkpoint).encode('utf-8'))
+    return sha1.hexdigest()[:16]
+
+
+def get_view_key(orientation=None, scale=None):
+    """
+    :param orientation: None(the image itself) or flip orientation of cv2.flip
+    :param scale: None for the views at the default scale, or the scale of the re-inference
+    """
+    key = 'orig' if orientation is None else 'flip%d' % orientation
+    if scale is not None:
+        key += '_x%.4f' % scale
+    return key
+
+
+def parse_view_key(view):
+    """
+    :return: (orientation, scale) of get_view_key
+    """
+    tokens = view.split('_x')
+    orientation = None if tokens[0] == 'orig' else int(tokens[0][len('flip'):])
+    scale = float(tokens[1]) if len(tokens) > 1 else None
+    return orientation, scale
+
+
+class ProbMapCache:
+    """
+    Merged probability maps of the network, keyed by checkpoint, image id and test-time augmentation view.
+
+    A map is saved as a float16 .npy file at '<path>/<checkpoint hash>_v<VERSION>/<image id>/<view>.npy'
+    and memory-mapped when read, so that post-processing can run again without the network.
+
+    The scale of rescaled views depends on post-processing parameters, so maps of several scales may be cached
+    for an image. 'index.json' of the image records the views of its latest inference, which readers use.
+    """
+    INDEX = 'index.json'
+    # 2 : maps of the view resolution
+    VERSION = 2
+
+    def __init__(self, path, checkpoint_hash):
+        self.path = os.path.join(path, '%s_v%d' % (checkpoint_hash, ProbMapCache.VERSION))
+        self.checkpoint_hash = checkpoint_hash
+
+    def _mappath(self, image_id, view):
+        return os.path.join(self.path, image_id, view + '.npy')
+
+    def __contains__(self, item):
+        image_id, view = item
+        return os.path.exists(self._mappath(image_id, view))
+
+    def _indexpath(self, image_id):
+        return os.path.join(self.path, image_id, ProbMapCache.INDEX)
+
+    def ids(self):
+        """
+        :return: ids of images with an index of views
+        """
+        if not os.path.exists(self.path):
+            return []
+        return sorted([x for x in os.listdir(self.path) if os.path.exists(self._indexpath(x))])
+
+    def views(self, image_id):
+        """
+        :return: views of the latest inference of the image, in the order of put_index. empty if not indexed.
+        """
+        path = self._indexpath(image_id)
+        if not os.path.exists(path):
+            return []
+        with open(path, 'r') as f:
+            return json.load(f)['views']
+
+    def cached_views(self, image_id):
+        """
+        :return: every cached view of the image, including those of stale scales
+        """
+        path = os.path.join(self.path, image_id)
+        if not os.path.exists(path):
+            return []
+        return sorted([x[:-4] for x in os.listdir(path) if x.endswith('.npy')])
+
+    def put_index(self, image_id, views):
+        """
+        :param views: views of an inference of the image, which are cached already
+        """
+        missing = [view for view in views if (image_id, view) not in self]
+        if missing:
+            raise Exception('views not cached, id=%s views=%s' % (image_id, missing))
+        path = self._indexpath(image_id)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'views': list(views)}, f)
+        os.replace(path + '.tmp', path)
+
+    def get(self, image_id, view):
+        """
+        :return: read-only float16 memory-mapped (h, w) map, None if not cached
+        """
+        path = self._mappath(image_id, view)
+        if not os.path.exists(path):
+            return None
+        return np.load(path, mmap_mode='r')
+
+    def put(self, image_id, view, prob):
+        """
+        :return: float16 map as stored
+        """
+        path = self._mappath(image_id, view)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        prob = np.ascontiguousarray(prob, dtype=np.float16)
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, prob)
+        os.replace(path + '.tmp', path)
+        return prob
@@ -0,0 +1,68 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from prob_cache import ProbMapCache, get_checkpoint_hash, get_view_key, parse_view_key
+
+
+class TestProbMapCache(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_put_get(self):
+        cache = ProbMapCache(self.path, 'checkpoint')
+        prob = np.random.rand(31, 45).astype(np.float32)
+        view = get_view_key(1, 1.25)
+        self.assertIsNone(cache.get('a', view))
+
+        stored = cache.put('a', view, prob)
+        self.assertTrue(('a', view) in cache)
+        self.assertListEqual(cache.cached_views('a'), ['flip1_x1.2500'])
+
+        cached = cache.get('a', view)
+        self.assertEqual(cached.dtype, np.float16)
+        self.assertTrue(np.array_equal(cached, stored))
+        self.assertTrue(np.allclose(cached, prob, atol=1e-3))
+        self.assertIsNone(ProbMapCache(self.path, 'other').get('a', view))
+
+    def test_index(self):
+        cache = ProbMapCache(self.path, 'checkpoint')
+        prob = np.random.rand(8, 8).astype(np.float32)
+        for scale in [1.25, 0.75]:
+            for orientation in [None, 0]:
+                cache.put('a', get_view_key(orientation, scale), prob)
+        self.assertListEqual(cache.ids(), [])
+        self.assertListEqual(cache.views('a'), [])
+        self.assertEqual(len(cache.cached_views('a')), 4)
+
+        # only the views of the latest inference are read
+        cache.put_index('a', [get_view_key(None, 0.75), get_view_key(0, 0.75)])
+        self.assertListEqual(cache.ids(), ['a'])
+        self.assertListEqual(cache.views('a'), ['orig_x0.7500', 'flip0_x0.7500'])
+        with self.assertRaises(Exception):
+            cache.put_index('a', [get_view_key(1, 0.75)])
+
+    def test_view_key(self):
+        for orientation in [None, 0, 1]:
+            for scale in [None, 1.0, 0.75]:
+                self.assertTupleEqual(parse_view_key(get_view_key(orientation, scale)), (orientation, scale))
+
+    def test_checkpoint_hash(self):
+        checkpoint = os.path.join(self.path, 'model-100')
+        with open(checkpoint + '.index', 'wb') as f:
+            f.write(b'weights 1')
+        hash1 = get_checkpoint_hash(checkpoint)
+        self.assertEqual(hash1, get_checkpoint_hash(checkpoint))
+        with open(checkpoint + '.index', 'wb') as f:
+            f.write(b'weights 2')
+        self.assertNotEqual(hash1, get_checkpoint_hash(checkpoint))
+
+
+if __name__ == '__main__':
+    unittest.main()
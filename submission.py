@@ -5,7 +5,6 @@ import cv2
 import logging
 import json
 import numpy as np
-import pandas as pd
 import time
 import pickle
 
@@ -13,7 +12,9 @@ import sys
 
 from data_augmentation import get_rect_of_mask
 from data_feeder import CellImageDataManagerTest, CellImageDataManagerValid
+from data_store import InstanceStore
 from hyperparams import HyperParams
+from instance import Instance, PackedInstances, to_instance, paint_instances, pairwise_iou
 try:
     from kaggle.api.kaggle_api_extended import KaggleApi
 except:
@@ -39,17 +40,60 @@ def rle_encoding(x):
     :param x: (h, w, 1) numpy
     :return: run length encoded list
     """
-    dots = np.where(x.T.flatten() == 1)[0]
-    rle = []
-    prev = -2
-    cnt = 0
-    for b in dots:
-        if b > prev + 1:
-            rle.extend((b + 1, 0))
-        rle[-1] += 1
-        cnt += 1
-        prev = b
-    return rle, cnt
+    dots = (x.T.flatten() == 1).astype(np.int8)
+    # a run starts at +1 and ends at -1 of the difference
+    changes = np.flatnonzero(np.diff(np.concatenate([[0], dots, [0]])))
+    starts, ends = changes[0::2], changes[1::2]
+    rle = np.stack([starts + 1, ends - starts], axis=1).ravel().tolist()
+    return rle, int(np.sum(ends - starts))
+
+
+def rle_encoding_label(label):
+    """
+    Run length encode every instance of a label image at once.
+    :param label: (h, w) or (h, w, 1) label image, 0=background
+    :return: list of (run length encoded list, # of pixels) for labels 1, 2, ..., label.max()
+    """
+    label = np.asarray(label)
+    flat = label.reshape(label.shape[:2]).T.ravel()
+    if flat.size == 0:
+        return []
+
+    # runs of the same label in the column-major order
+    boundaries = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    starts = np.concatenate([[0], boundaries])
+    lengths = np.diff(np.concatenate([starts, [flat.size]]))
+    values = flat[starts]
+
+    foreground = values > 0
+    starts, lengths, values = starts[foreground], lengths[foreground], values[foreground]
+    order = np.argsort(values, kind='stable')
+    starts, lengths, values = starts[order], lengths[order], values[order]
+
+    num_labels = int(flat.max())
+    splits = np.searchsorted(values, np.arange(1, num_labels + 2))
+    result = []
+    for idx in range(num_labels):
+        s, e = splits[idx], splits[idx + 1]
+        rle = np.stack([starts[s:e] + 1, lengths[s:e]], axis=1).ravel().tolist()
+        result.append((rle, int(np.sum(lengths[s:e]))))
+    return result
+
+
+def rle_decoding(rle, shape):
+    """
+    :param rle: run length encoded list or its space-separated string
+    :param shape: (h, w) of the image
+    :return: (h, w) bool numpy
+    """
+    if isinstance(rle, str):
+        rle = rle.split()
+    rle = np.asarray(rle, dtype=np.int64).reshape((-1, 2))
+    h, w = shape[:2]
+    delta = np.zeros((h * w + 1,), dtype=np.int32)
+    np.add.at(delta, rle[:, 0] - 1, 1)
+    np.add.at(delta, rle[:, 0] - 1 + rle[:, 1], -1)
+    return (np.cumsum(delta[:-1]) > 0).reshape((w, h)).T
 
 
 def get_iou1(a, b):
@@ -71,6 +115,9 @@ def get_iou1(a, b):
 
 
 def get_iou2(a, b):
+    if isinstance(a, Instance) or isinstance(b, Instance):
+        return to_instance(a).iou(to_instance(b))
+
     try:
         rmin1, rmax1, cmin1, cmax1 = get_rect_of_mask(a)
         rmin2, rmax2, cmin2, cmax2 = get_rect_of_mask(b)
@@ -101,50 +148,91 @@ def get_iou2(a, b):
 get_iou = get_iou2
 
 
+def get_label_metric(label_pred, label_true, thr_list):
+    """
+    Count tp, fp, fn at every threshold from a joint histogram of two label images.
+    Since a threshold is 0.5 or higher, a prediction matches at most one ground truth.
+    :param label_pred: (h, w) or (h, w, 1) label image of predictions, 0=background
+    :param label_true: (h, w) or (h, w, 1) label image of ground truths, 0=background
+    :param thr_list: iou thresholds
+    :return: (tp, fp, fn), each is an int array of len(thr_list)
+    """
+    label_pred = np.asarray(label_pred, dtype=np.int64).ravel()
+    label_true = np.asarray(label_true, dtype=np.int64).ravel()
+    n_true = int(label_true.max()) + 1 if label_true.size > 0 else 1
+    n_pred = int(label_pred.max()) + 1 if label_pred.size > 0 else 1
+
+    # contingency matrix, (# of predictions + 1, # of ground truths + 1) including the background
+    joint = np.bincount(label_pred * n_true + label_true, minlength=n_pred * n_true).reshape((n_pred, n_true))
+    area_pred = joint.sum(axis=1)[1:]
+    area_true = joint.sum(axis=0)[1:]
+    intersection = joint[1:, 1:]
+
+    # ious of overlapped pairs only
+    idx_pred, idx_true = np.nonzero(intersection)
+    inter = intersection[idx_pred, idx_true]
+    ious = inter / (area_pred[idx_pred] + area_true[idx_true] - inter)
+
+    thr_list = np.asarray(thr_list)
+    cnt_tps = np.sum(ious[np.newaxis, :] > thr_list[:, np.newaxis], axis=1).astype(np.int32)
+    cnt_fps = np.count_nonzero(area_pred) - cnt_tps
+    cnt_fns = np.count_nonzero(area_true) - cnt_tps
+    return cnt_tps, cnt_fps, cnt_fns
+
+
 def get_metric(instances, label_trues, thr_list):
     """
-    :param instances:  list of (h, w) numpy array
-    :param label_trues:  list of (h, w) numpy array
+    :param instances:  list of Instances or (h, w) numpy array
+    :param label_trues:  list of Instances or (h, w) numpy array. an earlier one wins on overlapped pixels.
     :param thr_list:
     :return:
     """
     if len(label_trues) == 0:
         return 0.0
 
+    label_trues = [to_instance(x) for x in label_trues]
+    instances = [to_instance(x) for x in instances]
+    shape = label_trues[0].shape
+    label_pred = paint_instances(instances, shape)
+    if np.count_nonzero(label_pred) != sum([x.area for x in instances]):
+        # a painted prediction would lose pixels to later ones, or be dropped if covered entirely
+        return get_instance_metric(instances, label_trues, thr_list)
+
+    # painted in reverse, so that an earlier one wins
+    label_true = paint_instances(label_trues[::-1], shape)
+    label_true = np.where(label_true > 0, len(label_trues) + 1 - label_true, 0)
+    return get_label_metric(label_pred, label_true, thr_list)
+
+
+def get_instance_metric(instances, label_trues, thr_list):
+    """
+    Match overlapped predictions one by one : each prediction in order takes the unmatched ground truth of the highest iou,
+    and it is a false positive if there is none or the iou is not higher than the threshold.
+    :param instances: list of Instances
+    :param label_trues: list of Instances
+    :return: (tp, fp, fn), each is an int array of len(thr_list)
+    """
+    thr_list = np.asarray(thr_list)
+    ious = pairwise_iou(instances, label_trues)
     cnt_tps = np.zeros((len(thr_list)), dtype=np.int32)
     cnt_fps = np.zeros((len(thr_list)), dtype=np.int32)
     cnt_ass = np.zeros((len(thr_list), len(label_trues)), dtype=np.int32)
-    max_found = set()
-    for label_pred in instances:
-        max_label_idx = -1
-        max_label_iou = 0.0
-        max_label = None
-        for idx_label, label_true in enumerate(label_trues):
-            if idx_label in max_found:
-                continue
-            # measure ious between label_preds & label_true
-            iou = get_iou(label_true, label_pred)
-
-            if iou > max_label_iou:
-                max_label_idx = idx_label
-                max_label_iou = iou
-                max_label = label_true
-
-        if max_label is None:
-            # false positive
-            cnt_fps = cnt_fps + 1
-        else:
-            max_found.add(idx_label)    # TODO
-            for th_idx, thr in enumerate(thr_list):
-                if max_label_iou > thr:
-                    cnt_tps[th_idx] += 1
-                    cnt_ass[th_idx][max_label_idx] = 1
-                else:
-                    cnt_fps[th_idx] += 1
-
+    found = set()
+    for idx in range(len(instances)):
+        row = ious.getrow(idx)
+        max_label_idx, max_label_iou = -1, 0.0
+        for idx_label, iou in sorted(zip(row.indices, row.data)):
+            if idx_label not in found and iou > max_label_iou:
+                max_label_idx, max_label_iou = idx_label, iou
+        if max_label_idx < 0:
+            cnt_fps += 1
+            continue
+        found.add(max_label_idx)
+        matched = max_label_iou > thr_list
+        cnt_tps += matched
+        cnt_fps += ~matched
+        cnt_ass[matched, max_label_idx] = 1
     cnt_fns = len(label_trues) - np.sum(cnt_ass, axis=1)
-
-    # return the metric
     return cnt_tps, cnt_fps, cnt_fns
 
 
@@ -161,6 +249,80 @@ def get_multiple_metric(thr_list, instances, label_trues):
     return cnt_tp, cnt_fp, cnt_fn
 
 
+INSTANCES_VERSION = 2
+
+
+def pack_instances_dict(instances_dict):
+    """
+    :param instances_dict: id -> (instances, scores), list of (instance, score) as rcnn results, or PackedInstances
+    :return: id -> PackedInstances
+    """
+    packed = {}
+    for idx, value in instances_dict.items():
+        if isinstance(value, list):
+            value = ([x[0] for x in value], [x[1] for x in value])
+        if not isinstance(value, PackedInstances):
+            instances, scores = value
+            value = PackedInstances.pack(instances, scores)
+        packed[idx] = value
+    return packed
+
+
+def load_instances(path):
+    """
+    Load instances saved by KaggleSubmission.save(). Full-size masks of old pickles are packed on load.
+    :return: {'valid_instances': id -> PackedInstances, 'test_instances': id -> PackedInstances}
+    """
+    with open(path, 'rb') as f:
+        data = pickle.load(f)
+    if data.get('version', 1) == INSTANCES_VERSION:
+        return data
+    return {
+        'version': INSTANCES_VERSION,
+        'valid_instances': pack_instances_dict(data['valid_instances']),
+        'test_instances': pack_instances_dict(data['test_instances'])
+    }
+
+
+def get_storepath(pklpath):
+    return os.path.splitext(pklpath)[0] + '_instances'
+
+
+class EnsembleSource:
+    """
+    Results of a model to be ensembled, fetched per image from a memory-mapped InstanceStore.
+    A pickle without its store, eg. an old one, is converted once and the store is kept next to it.
+    """
+    def __init__(self, pklpath):
+        self.pklpath = pklpath
+        storepath = get_storepath(pklpath)
+        if not os.path.exists(os.path.join(storepath, 'index.json')) or \
+                os.path.getmtime(storepath) < os.path.getmtime(pklpath):
+            logger.info('converting %s to an instance store...' % pklpath)
+            data = load_instances(pklpath)
+            InstanceStore.build(storepath, {
+                'valid_instances': data['valid_instances'],
+                'test_instances': data['test_instances']
+            })
+        self.store = InstanceStore(storepath)
+
+    @staticmethod
+    def _set_name(set_type):
+        return 'valid_instances' if set_type == 'train' else 'test_instances'
+
+    def count(self, set_type, single_id):
+        return self.store.count(EnsembleSource._set_name(set_type), single_id)
+
+    def get(self, set_type, single_id):
+        """
+        :return: (list of Instances, list of scores), (None, None) if not found.
+        """
+        packed = self.store.read(EnsembleSource._set_name(set_type), single_id)
+        if packed is None:
+            return None, None
+        return packed.unpack()
+
+
 class KaggleSubmission:
     BASEPATH = os.path.dirname(os.path.realpath(__file__)) + ("/submissions" if HyperParams.get().dataset_stage == 1 else "/submissions_stage2")
     CNAME = 'data-science-bowl-2018'
@@ -203,16 +365,17 @@ class KaggleSubmission:
         """
 
         :param idx: test sample id
-        :param instances: list of (h, w, 1) numpy containing
+        :param instances: list of non-overlapped Instances or (h, w, 1) numpy containing
         """
         if len(instances) == 0:
             self.test_ids.append(idx)
             self.rles.append([])
             return
 
-        for instance in instances:
-            rles, cnt = rle_encoding(instance)
-
+        # encode all instances at once from a label image
+        instances = [to_instance(x) for x in instances]
+        label = paint_instances(instances, instances[0].shape)
+        for rles, cnt in rle_encoding_label(label):
             if cnt < 3:
                 continue
             assert len(rles) % 2 == 0
@@ -245,15 +408,12 @@ class KaggleSubmission:
         return filepath
 
     def save(self):
-        sub = pd.DataFrame()
-        sub['ImageId'] = self.test_ids
-        sub['EncodedPixels'] = pd.Series(self.rles).apply(lambda x: ' '.join(str(y) for y in x))
-
         # save a submission file
         filepath = self.get_filepath()
         f = open(filepath, 'w')
+        f.write('ImageId,EncodedPixels\n')
+        f.writelines(['%s,%s\n' % (test_id, ' '.join(map(str, rles))) for test_id, rles in zip(self.test_ids, self.rles)])
         f.close()
-        sub.to_csv(filepath, index=False)
         logger.info('%s saved at %s.' % (self.name, filepath))
 
         # save hyperparameters
@@ -321,13 +481,20 @@ class KaggleSubmission:
         f.write(html)
         f.close()
 
-        # save pkl
+        # save pkl, and its instance store for ensembles
+        valid_instances = pack_instances_dict(self.valid_instances)
+        test_instances = pack_instances_dict(self.test_instances)
         f = open(self.get_pklpath(), 'wb')
         pickle.dump({
-            'valid_instances': self.valid_instances,
-            'test_instances': self.test_instances
+            'version': INSTANCES_VERSION,
+            'valid_instances': valid_instances,
+            'test_instances': test_instances
         }, f, pickle.HIGHEST_PROTOCOL)
         f.close()
+        InstanceStore.build(get_storepath(self.get_pklpath()), {
+            'valid_instances': valid_instances,
+            'test_instances': test_instances
+        })
 
     def submit_result(self, submit_msg='KakaoAutoML'):
         """
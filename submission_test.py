@@ -2,7 +2,7 @@ import unittest
 import numpy as np
 import time
 
-from submission import rle_encoding, get_iou, get_metric, get_iou1, get_iou2
+from submission import rle_encoding, rle_encoding_label, rle_decoding, get_iou, get_metric, get_label_metric, get_iou1, get_iou2
 
 
 class TestSubmission(unittest.TestCase):
@@ -54,6 +54,14 @@ class TestSubmission(unittest.TestCase):
         rles, cnt = rle_encoding(a)
         self.assertEqual(cnt, 5)
         self.assertListEqual(rles, [3, 2, 19, 2, 25, 1])
+        self.assertTrue(np.array_equal(rle_decoding('3 2 19 2 25 1', (5, 5)), a[..., 0] == 1))
+
+        label = a * 2
+        label[2, 0] = 1
+        (rles1, cnt1), (rles2, cnt2) = rle_encoding_label(label)
+        self.assertListEqual(rles1, [3, 1])
+        self.assertListEqual(rles2, [4, 1, 19, 2, 25, 1])
+        self.assertEqual(cnt1 + cnt2, 5)
 
     def test_iou(self):
         iou = get_iou(self.a, self.b)
@@ -148,3 +156,33 @@ class TestSubmission(unittest.TestCase):
         self.assertEqual(np.mean(tp), 2)
         self.assertEqual(np.mean(fp), 0)
         self.assertEqual(np.mean(fn), 0)
+
+    def test_metric_overlapped(self):
+        labels = np.zeros((2, 5, 5), dtype=np.uint8)
+        labels[0, 0:2, 0:2] = 1
+        labels[1, 3:5, 3:5] = 1
+        preds = np.zeros((3, 5, 5), dtype=np.uint8)
+        preds[0, 1, 1] = 1
+        preds[1, 0:2, 0:2] = 1
+        preds[2, 3:5, 3:5] = 1
+        preds[2, 4, 4] = 0
+
+        # the first one is covered by the second entirely, but still takes the first label(iou=0.25)
+        tp, fp, fn = get_metric(preds, labels, thr_list=[0.5, 0.95])
+        self.assertListEqual(list(tp), [1, 0])
+        self.assertListEqual(list(fp), [2, 3])
+        self.assertListEqual(list(fn), [1, 2])
+
+    def test_label_metric(self):
+        label_pred = self.instances[0] + self.instances[1] * 2
+        label_true = np.array([
+            [0, 0, 0, 2, 2],
+            [0, 0, 0, 2, 2],
+            [1, 1, 0, 0, 0],
+            [1, 0, 0, 0, 0],
+            [0, 0, 0, 0, 0],
+        ])
+        tp, fp, fn = get_label_metric(label_pred, label_true[..., np.newaxis], thr_list=[0.5, 0.95])
+        self.assertListEqual(list(tp), [1, 0])
+        self.assertListEqual(list(fp), [1, 2])
+        self.assertListEqual(list(fn), [1, 2])
@@ -0,0 +1,206 @@
+import functools
+import logging
+import math
+import sys
+
+import numpy as np
+
+from data_augmentation import reflect_indices
+
+logger = logging.getLogger('tile_batcher')
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler(sys.stdout)
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter('[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s')
+ch.setFormatter(formatter)
+logger.handlers = []
+logger.addHandler(ch)
+
+
+@functools.lru_cache(maxsize=128)
+def get_windows(img_h, img_w, window, overlap):
+    """
+    Window grid of slidingwindow.generate(HeightWidthChannel), in the same order. Cached per image shape.
+    :return: read-only (n, 4) int array of (x, y, w, h)
+    """
+    win_w, win_h = min(window, img_w), min(window, img_h)
+
+    def get_offsets(size, win):
+        step = win - int(math.floor(win * overlap))
+        last = size - win
+        offsets = list(range(0, last + 1, step))
+        if len(offsets) == 0 or offsets[-1] != last:
+            offsets.append(last)
+        return offsets
+
+    windows = np.array([(x, y, win_w, win_h)
+                        for x in get_offsets(img_w, win_w)
+                        for y in get_offsets(img_h, win_h)], dtype=np.int64)
+    windows.flags.writeable = False
+    return windows
+
+
+def get_receptive_margin(layers):
+    """
+    Half of the receptive field of stacked layers, in input pixels.
+    :param layers: list of (kernel size, stride). an upsampling by n is (1, 1 / n) if nearest,
+                   or (3, 1 / n) if bilinear, which reaches a neighbouring input cell.
+    """
+    margin, jump = 0.0, 1.0
+    for kernel, stride in layers:
+        margin += (kernel - 1) / 2.0 * jump
+        jump *= stride
+    return int(math.ceil(margin))
+
+
+@functools.lru_cache(maxsize=128)
+def get_exact_windows(img_h, img_w, window, margin, align):
+    """
+    Window grid whose outputs are stitched without overlaps, each output pixel taken from one window only.
+    Windows are at offsets of multiples of align, and the outputs within the margin from inner borders are dropped.
+    The last windows go beyond the image, whose inputs are mirrored, so that every window is aligned.
+    :return: read-only (n, 8) int array of (x, y, w, h) and the kept region (x1, y1, x2, y2) in image coordinates
+    """
+    def get_offsets(size):
+        win = window
+        step = (win - margin * 2) - (win - margin * 2) % align
+        if step <= 0:
+            raise Exception('no output left in window=%d, margin=%d, align=%d' % (window, margin, align))
+        offsets = list(range(0, max(size - win, 0) + 1, step))
+        if offsets[-1] + win < size:
+            offsets.append(offsets[-1] + step)
+
+        # kept regions, from the end of the previous one to the inner margin
+        regions = []
+        for idx, offset in enumerate(offsets):
+            start = regions[-1][1] if regions else 0
+            end = size if idx == len(offsets) - 1 else min(offset + win - margin, size)
+            regions.append((start, end))
+        return [(offset, win, start, end) for offset, (start, end) in zip(offsets, regions)]
+
+    windows = np.array([(x, y, w, h, x1, y1, x2, y2)
+                        for x, w, x1, x2 in get_offsets(img_w)
+                        for y, h, y1, y2 in get_offsets(img_h)], dtype=np.int64)
+    windows.flags.writeable = False
+    return windows
+
+
+class TileBatcher:
+    """
+    Sliding-window tiles of images, written straight into a preallocated batch buffer.
+
+    Tiles are (window + padding * 2) squares whose regions out of the image are mirrored, as crop_mirror does.
+    The batch size is chosen from the memory budget and the tile shape, and outputs of the network are max-merged
+    into probability maps of the images.
+
+    In the exact mode, tiles follow get_exact_windows and each output pixel is computed once.
+    A valid-padding network with context padding gives the same outputs as the whole image if align is its total
+    stride of pooling. A same-padding network needs a margin of its receptive field(see get_receptive_margin) instead,
+    and gives the outputs of the image mirrored beyond its bottom and right borders up to the last windows.
+    A network whose outputs depend on the whole tile(eg. global pooling) can not be stitched exactly.
+    """
+    def __init__(self, window, overlap=0.5, padding=0, memory_budget=128, max_batchsize=256,
+                 exact=False, margin=0, align=1):
+        """
+        :param memory_budget: in MB, for the input tiles and the outputs of a batch
+        """
+        self.window = window
+        self.overlap = overlap
+        self.padding = padding
+        self.exact = exact
+        self.margin = margin
+        self.align = align
+        self.memory_budget = memory_budget
+        self.max_batchsize = max_batchsize
+        self.buffer = None
+
+    def get_batchsize(self, channels):
+        tile_size = self.window + self.padding * 2
+        tile_bytes = (tile_size * tile_size * channels + self.window * self.window) * np.dtype(np.float32).itemsize
+        return int(max(1, min(self.max_batchsize, self.memory_budget * 1024 * 1024 // tile_bytes)))
+
+    def _get_buffer(self, channels):
+        tile_size = self.window + self.padding * 2
+        if self.buffer is None or self.buffer.shape[3] != channels:
+            batchsize = self.get_batchsize(channels)
+            self.buffer = np.empty((batchsize, tile_size, tile_size, channels), dtype=np.float32)
+            logger.debug('tile batch=%d, shape=%s' % (batchsize, self.buffer.shape[1:]))
+        return self.buffer
+
+    def _fill(self, out, img, x, y, w, h):
+        p = self.padding
+        img_h, img_w = img.shape[:2]
+        x1, y1, x2, y2 = x - p, y - p, x + w + p, y + h + p
+        if x1 >= 0 and y1 >= 0 and x2 <= img_w and y2 <= img_h:
+            out[...] = img[y1:y2, x1:x2]
+        else:
+            rows = reflect_indices(y1, h + p * 2, img_h)
+            cols = reflect_indices(x1, w + p * 2, img_w)
+            out[...] = img[np.ix_(rows, cols)]
+
+    def get_windows(self, img_h, img_w):
+        """
+        :return: (n, 8) int array of (x, y, w, h) and the region (x1, y1, x2, y2) whose outputs are merged
+        """
+        if self.exact:
+            return get_exact_windows(img_h, img_w, self.window, self.margin, self.align)
+        windows = get_windows(img_h, img_w, self.window, self.overlap)
+        return np.concatenate([windows, windows[:, :2], windows[:, :2] + windows[:, 2:4]], axis=1)
+
+    def batches(self, images):
+        """
+        The batch is a view of the shared buffer, valid until the next batch is requested.
+        A batch holds tiles of the same shape only, so an image smaller than the window starts a new batch.
+        :param images: list of (h, w, c) images
+        :return: generator of (batch, tiles), tiles is (n, 9) int array of (image index, window of get_windows)
+        """
+        if len(images) == 0:
+            return
+        channels = images[0].shape[2]
+        buf = self._get_buffer(channels)
+        tiles = []
+        tile_shape = None
+        for idx, img in enumerate(images):
+            if img.ndim != 3 or img.shape[2] != channels:
+                raise Exception('image of shape %s, expected %d channels' % (img.shape, channels))
+            windows = self.get_windows(img.shape[0], img.shape[1])
+            shape = tuple(windows[0, 2:4])
+            if tiles and shape != tile_shape:
+                yield buf[:len(tiles), :tile_shape[1] + self.padding * 2, :tile_shape[0] + self.padding * 2], np.array(tiles)
+                tiles = []
+            tile_shape = shape
+            for window in windows:
+                x, y, w, h = window[:4]
+                self._fill(buf[len(tiles), :h + self.padding * 2, :w + self.padding * 2], img, x, y, w, h)
+                tiles.append((idx, ) + tuple(window))
+                if len(tiles) == len(buf):
+                    yield buf[:len(tiles), :h + self.padding * 2, :w + self.padding * 2], np.array(tiles)
+                    tiles = []
+        if tiles:
+            yield buf[:len(tiles), :tile_shape[1] + self.padding * 2, :tile_shape[0] + self.padding * 2], np.array(tiles)
+
+    def merge(self, merged_outputs, outputs, tiles):
+        """
+        Merge outputs of tiles into the maps in place, by maximum or by copying the kept regions in the exact mode.
+        :param merged_outputs: list of (h, w) float32 maps
+        :param outputs: (n, h, w) or (n, h, w, 1) outputs of the tiles
+        """
+        outputs = np.asarray(outputs)
+        outputs = outputs.reshape(outputs.shape[:3])
+        for (idx, x, y, w, h, x1, y1, x2, y2), output in zip(tiles, outputs):
+            region = merged_outputs[idx][y1:y2, x1:x2]
+            output = output[y1 - y:y2 - y, x1 - x:x2 - x]
+            if self.exact:
+                region[...] = output
+            else:
+                np.maximum(region, output, out=region)
+
+    def predict(self, images, run):
+        """
+        :param run: function of a batch of tiles, which returns their outputs
+        :return: list of (h, w) float32 maps
+        """
+        merged_outputs = [np.zeros(image.shape[:2], dtype=np.float32) for image in images]
+        for batch, tiles in self.batches(images):
+            self.merge(merged_outputs, run(batch), tiles)
+        return merged_outputs
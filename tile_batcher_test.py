@@ -0,0 +1,114 @@
+import unittest
+
+import numpy as np
+import slidingwindow as sw
+from scipy import ndimage
+
+from data_augmentation import crop_mirror, reflect_indices
+from tile_batcher import TileBatcher, get_windows, get_exact_windows, get_receptive_margin
+
+
+class TestTileBatcher(unittest.TestCase):
+    def test_windows(self):
+        for shape, window, overlap in [((300, 500), 228, 0.5), ((228, 228), 228, 0.5), ((100, 250), 224, 0.2), ((80, 80), 100, 0.0)]:
+            img = np.zeros(shape + (3, ), dtype=np.uint8)
+            windows = sw.generate(img, sw.DimOrder.HeightWidthChannel, window, overlap)
+            expected = [(w.x, w.y, w.w, w.h) for w in windows]
+            self.assertListEqual([tuple(x) for x in get_windows(shape[0], shape[1], window, overlap)], expected)
+
+    def test_batches(self):
+        images = [np.random.rand(300, 250, 3), np.random.rand(120, 260, 3), np.random.rand(150, 150, 3)]
+        batcher = TileBatcher(128, 0.5, padding=20, memory_budget=1)
+        batchsize = batcher.get_batchsize(3)
+        self.assertEqual(batchsize, 1024 * 1024 // ((168 * 168 * 3 + 128 * 128) * 4))
+
+        num_tiles = 0
+        for batch, tiles in batcher.batches(images):
+            self.assertLessEqual(len(batch), batchsize)
+            for tile, (idx, x, y, w, h) in zip(batch, tiles[:, :5]):
+                self.assertTrue(np.allclose(tile, crop_mirror(images[idx], x, y, w, h, 20)))
+            num_tiles += len(tiles)
+        self.assertEqual(num_tiles, sum([len(get_windows(img.shape[0], img.shape[1], 128, 0.5)) for img in images]))
+
+    def test_predict(self):
+        images = [np.random.rand(300, 250, 3), np.random.rand(100, 260, 3)]
+        batcher = TileBatcher(128, 0.5, padding=20, memory_budget=1)
+        probs = batcher.predict(images, lambda batch: batch[:, 20:-20, 20:-20, :1] * 0.5)
+        for img, prob in zip(images, probs):
+            self.assertEqual(prob.dtype, np.float32)
+            self.assertTrue(np.allclose(prob, img[:, :, 0] * 0.5, atol=1e-6))
+
+    def test_exact_windows(self):
+        for img_h, img_w in [(500, 300), (100, 90)]:
+            windows = get_exact_windows(img_h, img_w, 228, 10, 16)
+            coverage = np.zeros((img_h, img_w), dtype=np.int32)
+            for x, y, w, h, x1, y1, x2, y2 in windows:
+                self.assertTrue(x <= x1 and x2 <= x + w and y <= y1 and y2 <= y + h)
+                coverage[y1:y2, x1:x2] += 1
+            self.assertTrue(np.all(coverage == 1))
+            self.assertTrue(np.all(windows[:, :2] % 16 == 0))
+
+    def test_exact_valid(self):
+        # valid-padding network, whose output depends on the phase of 16x16 pooling
+        padding, align = 20, 16
+
+        def run(batch):
+            n, h, w, _ = batch.shape
+            pooled = batch[:, :h // align * align, :w // align * align, 0]
+            pooled = pooled.reshape(n, h // align, align, w // align, align).max(axis=(2, 4))
+            pooled = np.repeat(np.repeat(pooled, align, axis=1), align, axis=2)
+            return batch[:, padding:h - padding, padding:w - padding, 1] + pooled[:, padding:h - padding, padding:w - padding]
+
+        images = [np.random.rand(300, 250, 3).astype(np.float32), np.random.rand(130, 133, 3).astype(np.float32)]
+        batcher = TileBatcher(100, padding=padding, memory_budget=1, exact=True, align=align)
+        probs = batcher.predict(images, run)
+        for img, prob in zip(images, probs):
+            # whole image, mirror-padded to multiples of the align
+            out_h, out_w = [(x + align - 1) // align * align for x in img.shape[:2]]
+            rows = reflect_indices(-padding, out_h + padding * 2, img.shape[0])
+            cols = reflect_indices(-padding, out_w + padding * 2, img.shape[1])
+            expected = run(img[np.ix_(rows, cols)][np.newaxis])[0, :img.shape[0], :img.shape[1]]
+            self.assertTrue(np.array_equal(prob, expected))
+
+    def test_exact_same(self):
+        # same-padding network : conv 3x3, max pooling 2x2, conv 3x3 and nearest upsampling
+        align = 2
+        margin = get_receptive_margin([(3, 1), (2, 2), (3, 1), (1, 1 / 2.0)])
+        self.assertEqual(margin, 4)
+
+        def net(img):
+            h, w = img.shape
+            x = ndimage.uniform_filter(img, size=3, mode='constant')
+            x = x.reshape(h // 2, 2, w // 2, 2).max(axis=(1, 3))
+            x = ndimage.uniform_filter(x, size=3, mode='constant')
+            return np.repeat(np.repeat(x, 2, axis=0), 2, axis=1)
+
+        def run(batch):
+            return np.stack([net(x[:, :, 0]) for x in batch])
+
+        images = [np.random.rand(300, 250, 3).astype(np.float32), np.random.rand(80, 91, 3).astype(np.float32)]
+        batcher = TileBatcher(100, memory_budget=1, exact=True, margin=margin, align=align)
+        probs = batcher.predict(images, run)
+        for img, prob in zip(images, probs):
+            # whole image, mirrored beyond the bottom and right borders up to the last windows
+            windows = get_exact_windows(img.shape[0], img.shape[1], 100, margin, align)
+            out_w, out_h = [int(np.max(windows[:, i] + windows[:, i + 2])) for i in range(2)]
+            rows = reflect_indices(0, out_h, img.shape[0])
+            cols = reflect_indices(0, out_w, img.shape[1])
+            expected = net(img[np.ix_(rows, cols)][:, :, 0])[:img.shape[0], :img.shape[1]]
+            self.assertTrue(np.allclose(prob, expected, atol=1e-6))
+
+        # outputs differ at the seams without the margin
+        seamed = TileBatcher(100, memory_budget=1, exact=True, margin=0, align=align).predict(images, run)
+        self.assertFalse(np.allclose(seamed[0], probs[0], atol=1e-6))
+
+    def test_receptive_margin(self):
+        self.assertEqual(get_receptive_margin([(3, 1)]), 1)
+        self.assertEqual(get_receptive_margin([(3, 2), (3, 1)]), 3)
+        # network_basic
+        layers = [(3, 1), (3, 1), (1, 1)] + [(3, 1), (3, 2)] * 4 + [(3, 1), (3, 1 / 8.0), (5, 1), (3, 1 / 2.0)]
+        self.assertEqual(get_receptive_margin(layers), 70)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,36 +1,39 @@
 import logging
+import math
 
 import os
 from multiprocessing.pool import Pool
+from collections import deque
 from itertools import compress
 
 import sys
-from scipy import ndimage
 
-import pickle
 import cv2
 import datetime
 import fire
 import numpy as np
+from scipy import sparse
 import tensorflow as tf
 from tqdm import tqdm
 
 from checkmate.checkmate import BestCheckpointSaver, get_best_checkpoint
-from commons import chunker, ensemble_models
-from data_augmentation import get_max_size_of_masks, mask_size_normalize, center_crop, get_size_of_mask, \
-    get_rect_of_mask
-from data_feeder import batch_to_multi_masks, CellImageData, master_dir_test, master_dir_train, \
-    CellImageDataManagerValid, CellImageDataManagerTrain, CellImageDataManagerTest, extra1_dir, extra2_dir, \
-    master_dir_train2, IDX_LIST2
+from commons import chunker, ensemble_models, imap_bounded
+from data_augmentation import mask_size_normalize, center_crop
+from data_feeder import CellImageData, master_dir_test, master_dir_train, \
+    CellImageDataManagerValid, CellImageDataManagerTrain, CellImageDataManagerTest, get_data_source, get_data_store, \
+    DataManifest
+from ensemble_queue import ShardQueue, get_config_hash
 from hyperparams import HyperParams
+from instance import PackedInstances, instances_from_label, to_instance, paint_instances, pairwise_iou
 from network import Network
 from network_basic import NetworkBasic
 from network_deeplabv3p import NetworkDeepLabV3p
 from network_unet import NetworkUnet
 from network_fusionnet import NetworkFusionNet
 from network_unet_valid import NetworkUnetValid
+from prob_cache import ProbMapCache, get_checkpoint_hash, get_view_key
 from stopwatch import StopWatch
-from submission import KaggleSubmission, get_multiple_metric, thr_list, get_iou
+from submission import KaggleSubmission, EnsembleSource, get_multiple_metric, get_label_metric, thr_list
 
 logger = logging.getLogger('train')
 logger.setLevel(logging.INFO if os.environ.get('DEBUG', 0) == 0 else logging.DEBUG)
@@ -47,6 +50,7 @@ class Trainer:
         self.batchsize = 16
         self.network = None
         self.sess = None
+        self.prob_cache = None
 
         self.ensembles = None
 
@@ -65,6 +69,17 @@ class Trainer:
             raise Exception('model name(%s) is not valid' % model)
         logger.info('constructing network model: %s' % model)
 
+    def set_checkpoint(self, checkpoint):
+        """
+        Probability maps of the restored checkpoint are cached if test_prob_cache is set. see ProbMapCache
+        """
+        cache_path = HyperParams.get().test_prob_cache
+        if cache_path and checkpoint:
+            self.prob_cache = ProbMapCache(cache_path, get_checkpoint_hash(checkpoint))
+            logger.info('probability maps cached at %s' % self.prob_cache.path)
+        else:
+            self.prob_cache = None
+
     def init_session(self):
         if self.sess is not None:
             return
@@ -139,13 +154,16 @@ class Trainer:
         elif checkpoint == 'best':
             path = get_best_checkpoint(model_path)
             saver.restore(self.sess, path)
+            self.set_checkpoint(path)
             logger.info('restored from best checkpoint, %s' % path)
         elif checkpoint == 'latest':
             path = tf.train.latest_checkpoint(model_path)
             saver.restore(self.sess, path)
+            self.set_checkpoint(path)
             logger.info('restored from latest checkpoint, %s' % path)
         else:
             saver.restore(self.sess, checkpoint)
+            self.set_checkpoint(checkpoint)
             logger.info('restored from checkpoint, %s' % checkpoint)
 
         step = self.sess.run(global_step)
@@ -245,6 +263,7 @@ class Trainer:
             if chk_path:
                 logger.info('training is done. Start to evaluate the best model. %s' % chk_path)
                 saver.restore(self.sess, chk_path)
+                self.set_checkpoint(chk_path)
         except Exception as e:
             logger.warning('error while loading the best model:' + str(e))
 
@@ -287,30 +306,15 @@ class Trainer:
         # show sample in test set
         logger.info('saving...')
         if save_result:
-            for i, single_id in tqdm(enumerate(CellImageDataManagerTest.LIST), total=len(CellImageDataManagerTest.LIST)):    # TODO
-                try:
-                    result = self.single_id(None, None, single_id, 'test', False, False)
-                except Exception as e:
-                    logger.warning('single_id=%s err=%s' % (single_id, str(e)))
-                    continue
-                image = result['image']
-                instances = result['instances']
-                img_h, img_w = image.shape[:2]
-
-                img_vis = Network.visualize(image, None, instances, None)
-
-                # save to submit
-                instances = Network.resize_instances(instances, (img_h, img_w))
-                kaggle_submit.save_image(single_id, img_vis)
-                kaggle_submit.test_instances[single_id] = (instances, result['instance_scores'])
-                kaggle_submit.add_result(single_id, instances)
-                # for single_id in tqdm(CellImageDataManagerTest.LIST[1120:], desc='test set evaluation'):
-                #     result = self.single_id(None, None, single_id, set_type='test', show=False, verbose=False)
-
-                # temporal saving
-                if i % 500 == 0:
-                    kaggle_submit.save()
-            kaggle_submit.save()
+            # workers live only while the test set is predicted
+            pipeline = TestPipeline(self.network.preprocess)
+            try:
+                self.save_test_results(kaggle_submit, CellImageDataManagerTest.LIST, pipeline)
+            except BaseException:
+                pipeline.terminate()
+                raise
+            finally:
+                pipeline.close()
         logger.info('done. epoch=%d best_loss_val=%.4f best_mIOU=%.4f name= %s' % (m_epoch, best_loss_val, best_miou_val, name))
         return best_miou_val, name
 
@@ -326,6 +330,7 @@ class Trainer:
         if checkpoint:
             saver = tf.train.Saver()
             saver.restore(self.sess, checkpoint)
+            self.set_checkpoint(checkpoint)
             logger.info('restored from checkpoint, %s' % checkpoint)
 
         for single_id in CellImageDataManagerValid.LIST:
@@ -337,19 +342,7 @@ class Trainer:
         return mIOU
 
     def _get_cell_data(self, single_id, set_type):
-        if 'TCGA' in single_id:
-            d = CellImageData(single_id, extra1_dir, ext='tif')
-            # generally, TCGAs have lots of instances -> slow matching performance
-            d = center_crop(d, 224, 224, padding=0)
-        elif 'TNBC' in single_id:
-            d = CellImageData(single_id, extra2_dir, ext='png')
-            # generally, TCGAs have lots of instances -> slow matching performance
-            d = center_crop(d, 224, 224, padding=0)
-        elif single_id in IDX_LIST2:
-            d = CellImageData(single_id, master_dir_train2, ext='png')
-        else:
-            d = CellImageData(single_id, (master_dir_train if set_type == 'train' else master_dir_test))
-        return d
+        return get_cell_data(single_id, set_type)
 
     def single_id(self, model, checkpoint, single_id, set_type='train', show=True, verbose=True):
         if model:
@@ -360,12 +353,12 @@ class Trainer:
         if checkpoint:
             saver = tf.train.Saver()
             saver.restore(self.sess, checkpoint)
+            self.set_checkpoint(checkpoint)
             if verbose:
                 logger.info('restored from checkpoint, %s' % checkpoint)
 
         d = self._get_cell_data(single_id, set_type)
         h, w = d.img.shape[:2]
-        shortedge = min(h, w)
         logger.debug('%s image size=(%d x %d)' % (single_id, w, h))
 
         watch = StopWatch()
@@ -374,120 +367,19 @@ class Trainer:
 
         image = d.image(is_gray=False)
 
-        total_instances = []
-        total_scores = []
-        total_from_set = []
-        cutoff_instance_max = HyperParams.get().post_cutoff_max_th
-        cutoff_instance_avg = HyperParams.get().post_cutoff_avg_th
-
         watch.start()
-        logger.debug('inference at default scale+ %dx%d' % (w, h))
-        inference_result = self.network.inference(self.sess, image, cutoff_instance_max=cutoff_instance_max, cutoff_instance_avg=cutoff_instance_avg)
-        instances_pre, scores_pre = inference_result['instances'], inference_result['scores']
-        instances_pre = Network.resize_instances(instances_pre, target_size=(h, w))
-        total_instances = total_instances + instances_pre
-        total_scores = total_scores + scores_pre
-        total_from_set = [1] * len(instances_pre)
-        watch.stop()
-        logger.debug('inference- elapsed=%.5f' % watch.get_elapsed())
-        watch.reset()
-
-        logger.debug('inference with flips+')
-        # re-inference using flip
-        for flip_orientation in range(2):
-            flipped = cv2.flip(image.copy(), flip_orientation)
-            inference_result = self.network.inference(self.sess, flipped, cutoff_instance_max=cutoff_instance_max, cutoff_instance_avg=cutoff_instance_avg)
-            instances_flip, scores_flip = inference_result['instances'], inference_result['scores']
-            instances_flip = [cv2.flip(instance.astype(np.uint8), flip_orientation) for instance in instances_flip]
-            instances_flip = Network.resize_instances(instances_flip, target_size=(h, w))
-
-            total_instances = total_instances + instances_flip
-            total_scores = total_scores + scores_flip
-            total_from_set = total_from_set + [2 + flip_orientation] * len(instances_flip)
-
-        watch.stop()
-        logger.debug('inference- elapsed=%.5f' % watch.get_elapsed())
-        watch.reset()
-        logger.debug('inference with scaling+flips+')
-
-        # re-inference after rescale image
-        def inference_with_scale(image, resize_target):
-            image = cv2.resize(image.copy(), None, None, resize_target, resize_target, interpolation=cv2.INTER_AREA)
-            inference_result = self.network.inference(self.sess, image, cutoff_instance_max=cutoff_instance_max, cutoff_instance_avg=cutoff_instance_avg)
-            instances_rescale, scores_rescale = inference_result['instances'], inference_result['scores']
-
-            instances_rescale = Network.resize_instances(instances_rescale, target_size=(h, w))
-            return instances_rescale, scores_rescale
-
-        max_mask = get_max_size_of_masks(instances_pre)
-        logger.debug('max_mask=%d' % max_mask)
-        resize_target = HyperParams.get().test_aug_scale_t / max_mask
-        resize_target = min(HyperParams.get().test_aug_scale_max, resize_target)
-        resize_target = max(HyperParams.get().test_aug_scale_min, resize_target)
-        import math
-        # resize_target = 2.0 / (1.0 + math.exp(-1.5*(resize_target - 1.0)))
-        # resize_target = max(0.5, resize_target)
-        resize_target = max(228.0 / shortedge, resize_target)
-        # if resize_target > 1.0 and min(w, h) > 1000:
-        #     logger.debug('too large image, no resize')
-        #     resize_target = 0.8
-        logger.debug('resize_target=%.4f' % resize_target)
-
-        instances_rescale, scores_rescale = inference_with_scale(image, resize_target)
-        total_instances = total_instances + instances_rescale
-        total_scores = total_scores + scores_rescale
-        total_from_set = total_from_set + [4] * len(instances_rescale)
-
-        # re-inference using flip + rescale
-        for flip_orientation in range(2):
-            flipped = cv2.flip(image.copy(), flip_orientation)
-            instances_flip, scores_flip = inference_with_scale(flipped, resize_target)
-            instances_flip = [cv2.flip(instance.astype(np.uint8), flip_orientation) for instance in instances_flip]
-            instances_flip = Network.resize_instances(instances_flip, target_size=(h, w))
-
-            total_instances = total_instances + instances_flip
-            total_scores = total_scores + scores_flip
-            total_from_set = total_from_set + [5 + flip_orientation] * len(instances_flip)
-
+        views, num_views, resize_target = self.inference_views(single_id, image, (h, w))
         watch.stop()
         logger.debug('inference- elapsed=%.5f' % watch.get_elapsed())
         watch.reset()
 
         watch.start()
-        logger.debug('voting+ size=%d' % len(total_instances))
-
-        # TODO : Voting?
-        voting_th = HyperParams.get().post_voting_th
-        rects = [get_rect_of_mask(a) for a in total_instances]
-        voted = []
-        for i, x in enumerate(total_instances):
-            voted.append(filter_by_voting((x, total_instances, voting_th, 0.3, rects[i], rects)))
-
-        total_instances = list(compress(total_instances, voted))
-        total_scores = list(compress(total_scores, voted))
-        total_from_set = list(compress(total_from_set, voted))
-
-        watch.stop()
-        logger.debug('voting elapsed=%.5f' % watch.get_elapsed())
-        watch.reset()
-
-        # nms
-        watch.start()
-        logger.debug('nms+ size=%d' % len(total_instances))
-        instances, scores = Network.nms(total_instances, total_scores, total_from_set, thresh=HyperParams.get().test_aug_nms_iou)
+        logger.debug('voting+nms+ views=%d' % len(views))
+        instances, scores = postprocess_views(views, (h, w), num_views)
         watch.stop()
-        logger.debug('nms elapsed=%.5f' % watch.get_elapsed())
+        logger.debug('voting+nms- elapsed=%.5f' % watch.get_elapsed())
         watch.reset()
 
-        # remove overlaps
-        logger.debug('remove overlaps+')
-        sorted_idx = [i[0] for i in sorted(enumerate(instances), key=lambda x: get_size_of_mask(x[1]), reverse=True)]
-        instances = [instances[x] for x in sorted_idx]
-        scores = [scores[x] for x in sorted_idx]
-
-        instances = [ndimage.morphology.binary_fill_holes(i) for i in instances]
-        instances, scores = Network.remove_overlaps(instances, scores)
-
         # TODO : Filter by score?
         # logger.debug('filter by score+')
         # score_filter_th = HyperParams.get().post_filter_th
@@ -501,7 +393,7 @@ class Trainer:
         score_desc = []
         labels = []
         if len(d.masks) > 0:    # has label masks
-            labels = list(d.multi_masks(transpose=False))
+            labels = instances_from_label(d.multi_masks_batch())
             labels = Network.resize_instances(labels, target_size=(h, w))
             tp, fp, fn = get_multiple_metric(thr_list, instances, labels)
 
@@ -543,23 +435,179 @@ class Trainer:
                 'score_desc': score_desc
             }
 
+    def inference_views(self, single_id, image, size):
+        """
+        Probability maps of test-time augmentation views : the image and its flips, and those of the image rescaled
+        by the size of instances. If test_aug_adaptive is set, further views are run only for ambiguous images.
+        :param image: preprocessed image
+        :param size: (h, w) of the original image, which instances of views are resized to
+        :return: (views, # of views, resize_target).
+                 a view is [from_set, prob, (instances, scores) if parsed already, or None], see postprocess_views.
+                 a map is of the view resolution, where post-processing thresholds apply as they were tuned.
+        """
+        h, w = size
+        shortedge = min(h, w)
+        views = []
+        view_keys = []
+
+        def predict_views(img, orientations, scale=None):
+            """
+            Tiles of the image and its flips are run in shared batches, and the probability maps are un-flipped.
+            Cached maps are read instead, and maps are always used as cached(float16) for the same results.
+            :param orientations: list of None(the image itself) or flip orientations
+            :return: list of probability maps of the size of img
+            """
+            keys = [get_view_key(o, scale) for o in orientations]
+            probs = [None] * len(orientations)
+            if self.prob_cache is not None:
+                probs = [self.prob_cache.get(single_id, key) for key in keys]
+            missing = [view_idx for view_idx, prob in enumerate(probs) if prob is None]
+            if missing:
+                imgs = [img if orientations[view_idx] is None else cv2.flip(img, orientations[view_idx]) for view_idx in missing]
+                for view_idx, prob in zip(missing, self.network.predict_probs(self.sess, imgs)):
+                    o = orientations[view_idx]
+                    if o is not None:
+                        prob = cv2.flip(prob, o)
+                    if self.prob_cache is not None:
+                        prob = self.prob_cache.put(single_id, keys[view_idx], prob)
+                    probs[view_idx] = prob
+            return [np.asarray(prob, dtype=np.float32) for prob in probs]
+
+        def add_views(img, orientations, from_set, scale=None):
+            for o, prob in zip(orientations, predict_views(img, orientations, scale)):
+                views.append([from_set + (0 if o is None else o + 1), prob, None])
+                view_keys.append(get_view_key(o, scale))
+            return views[-len(orientations):]
+
+        def parse(view):
+            if view[2] is None:
+                view[2] = parse_view(view[1], size)
+            return view[2]
+
+        # adaptive : further views only for ambiguous images
+        adaptive = HyperParams.get().test_aug_adaptive
+        num_views = 6
+
+        logger.debug('inference at default scale with flips+ %dx%d' % (w, h))
+        if not adaptive:
+            instances_pre, _ = parse(add_views(image, [None, 0, 1], 1)[0])
+        else:
+            base_view = add_views(image, [None], 1)[0]
+            instances_pre, _ = parse(base_view)
+
+            ambiguity = get_ambiguity(base_view[1], HyperParams.get().test_aug_adaptive_margin)
+            if ambiguity <= HyperParams.get().test_aug_adaptive_ambiguity_th:
+                num_views = 1
+            else:
+                flip_views = add_views(image, [0, 1], 1)
+                stability = min([get_stability(instances_pre, parse(x)[0]) for x in flip_views])
+                if stability >= HyperParams.get().test_aug_adaptive_stability_th:
+                    num_views = 3
+                logger.debug('stability=%.4f' % stability)
+            logger.debug('ambiguity=%.4f views=%d' % (ambiguity, num_views))
+        logger.debug('inference with scaling+flips+')
+
+        max_mask = max([1] + [x.size for x in instances_pre])
+        logger.debug('max_mask=%d' % max_mask)
+        resize_target = HyperParams.get().test_aug_scale_t / max_mask
+        resize_target = min(HyperParams.get().test_aug_scale_max, resize_target)
+        resize_target = max(HyperParams.get().test_aug_scale_min, resize_target)
+        # resize_target = 2.0 / (1.0 + math.exp(-1.5*(resize_target - 1.0)))
+        # resize_target = max(0.5, resize_target)
+        resize_target = max(228.0 / shortedge, resize_target)
+        # if resize_target > 1.0 and min(w, h) > 1000:
+        #     logger.debug('too large image, no resize')
+        #     resize_target = 0.8
+        logger.debug('resize_target=%.4f' % resize_target)
+
+        # re-inference after rescale image, with flips
+        if num_views == 6:
+            rescaled = cv2.resize(image.copy(), None, None, resize_target, resize_target, interpolation=cv2.INTER_AREA)
+            add_views(rescaled, [None, 0, 1], 4, scale=resize_target)
+
+        # the scale of this inference, among maps of other scales cached by other parameters
+        if self.prob_cache is not None:
+            self.prob_cache.put_index(single_id, view_keys)
+        return views, num_views, resize_target
+
+    def save_test_results(self, kaggle_submit, ids, pipeline, max_pending=16):
+        """
+        Predict the test set as a pipeline, whose results are added to the submission in the order of ids.
+        Images are loaded and preprocessed by the load pool, the network runs in this process,
+        and post-processing with visualization runs in the post pool, so that the session does not wait for them.
+        An image which fails is added with no instances, so that the submission has a row for every id.
+        :param pipeline: TestPipeline, closed by the caller
+        :param max_pending: # of images in each queue between stages
+        :return: list of failed ids
+        """
+        pending = deque()
+        failed = []
+        written = 0
+
+        def write(single_id, result):
+            """
+            :param result: AsyncResult of the post pool, or error message of the earlier stages
+            """
+            nonlocal written
+            if isinstance(result, str):
+                fail(single_id, result)
+                return
+            try:
+                packed, img_vis = result.get()
+            except Exception as e:
+                fail(single_id, str(e))
+                return
+            kaggle_submit.save_image(single_id, img_vis)
+            kaggle_submit.test_instances[single_id] = packed
+            kaggle_submit.add_result(single_id, packed.unpack()[0])
+
+            # temporal saving
+            written += 1
+            if written % 500 == 0:
+                kaggle_submit.save()
+
+        def fail(single_id, err):
+            logger.warning('single_id=%s err=%s' % (single_id, err))
+            failed.append(single_id)
+            kaggle_submit.test_scores[single_id] = (0.0, 0.0)
+            kaggle_submit.add_result(single_id, [])
+
+        loaded = imap_bounded(pipeline.load_pool, _pipeline_load, ids, max_pending)
+        for single_id, image, size, err in tqdm(loaded, total=len(ids)):
+            if err is None:
+                try:
+                    views, num_views, _ = self.inference_views(single_id, image, size)
+                except Exception as e:
+                    err = str(e)
+            if err is not None:
+                # written in order, after the pending ones
+                pending.append((single_id, err))
+            else:
+                pending.append((single_id, pipeline.post_pool.apply_async(_pipeline_postprocess, ((image, size, views, num_views), ))))
+
+            # written as soon as the oldest is done, or when the queue is full
+            while pending and (len(pending) >= max_pending or isinstance(pending[0][1], str) or pending[0][1].ready()):
+                write(*pending.popleft())
+        while pending:
+            write(*pending.popleft())
+        kaggle_submit.save()
+        if failed:
+            logger.error('%d of %d test images failed, submitted with no instances. eg. %s' % (len(failed), len(ids), failed[:5]))
+        return failed
+
     def _load_ensembles(self, model):
         if self.ensembles is not None:
             return
         logger.info('load ensembles...')
         self.ensembles = {'rcnn': [], 'unet': []}
 
+        # results are fetched per image from memory-mapped stores
         models = ensemble_models[model]
-        # TODO : RCNN Load
         for path in models['rcnn']:
-            with open(path, 'rb') as f:
-                data = pickle.load(f)
-                self.ensembles['rcnn'].append(data)
+            self.ensembles['rcnn'].append(EnsembleSource(path))
 
         for path in models['unet']:
-            with open(path, 'rb') as f:
-                data = pickle.load(f)
-                self.ensembles['unet'].append(data)
+            self.ensembles['unet'].append(EnsembleSource(path))
 
         logger.debug('_load_ensembles-')
 
@@ -593,6 +641,120 @@ class Trainer:
             kaggle_submit.add_result(single_id, instances)
         kaggle_submit.save()
 
+    def ensemble_models_parallel(self, model='stage1_unet', set_type='test', tag='default', processes=8, num_shards=None, workdir=None):
+        """
+        Ensemble the test set by a local process pool over a queue of shards, and merge them into a submission.
+        Workers of other hosts can join with ensemble_worker() when the workdir is on a shared filesystem.
+        :param processes: # of local workers. 0 to plan and merge only.
+        :param num_shards: # of shards, 8 per local worker if None.
+        """
+        name = 'ensemble_%s_%s' % (tag, model)
+        workdir = workdir or os.path.join(KaggleSubmission.BASEPATH, name, 'shards')
+        self._load_ensembles(model)
+
+        # estimated cost : (# of instances from all models) x (image area)
+        manifest = DataManifest.get()
+        sources = self.ensembles['rcnn'] + self.ensembles['unet']
+        ids = CellImageDataManagerTest.LIST
+        costs = []
+        for single_id in ids:
+            cnt = sum([source.count(set_type, single_id) for source in sources])
+            img_h, img_w = manifest.entries[single_id]['shape'][:2] if single_id in manifest else (256, 256)
+            costs.append((cnt + 1) * img_h * img_w)
+        ShardQueue.plan(workdir, ids, costs, num_shards or max(processes, 1) * 8,
+                        config_hash=self._ensemble_config_hash(model, set_type))
+
+        if processes > 0:
+            pool = Pool(processes=processes)
+            pool.map(_ensemble_worker, [(model, set_type, tag, workdir)] * processes, chunksize=1)
+            pool.close()
+            pool.join()
+
+        self.ensemble_merge(model, set_type, tag, workdir)
+
+    def ensemble_worker(self, model='stage1_unet', set_type='test', tag='default', workdir=None):
+        """
+        Take shards from the queue until none is left.
+        """
+        name = 'ensemble_%s_%s' % (tag, model)
+        workdir = workdir or os.path.join(KaggleSubmission.BASEPATH, name, 'shards')
+        queue = ShardQueue(workdir)
+        queue.check_config(self._ensemble_config_hash(model, set_type))
+        kaggle_submit = KaggleSubmission(name)
+
+        while True:
+            shard_idx = queue.claim()
+            if shard_idx is None:
+                break
+            logger.info('shard %d/%d size=%d' % (shard_idx, len(queue), len(queue.shards[shard_idx])))
+
+            try:
+                results = []
+                for single_id in queue.shards[shard_idx]:
+                    # a failed image is merged with no instances, see ensemble_merge
+                    try:
+                        result = self.ensemble_models_id(single_id, set_type=set_type, model=model, show=False, verbose=False)
+                    except Exception as e:
+                        logger.warning('single_id=%s err=%s' % (single_id, str(e)))
+                        results.append((single_id, None))
+                        continue
+                    image = result['image']
+                    img_h, img_w = image.shape[:2]
+
+                    img_vis = Network.visualize(image, None, result['instances'], None)
+                    kaggle_submit.save_image(single_id, img_vis)
+
+                    instances = Network.resize_instances(result['instances'], (img_h, img_w))
+                    results.append((single_id, PackedInstances.pack(instances, result['instance_scores'], shape=(img_h, img_w))))
+                queue.put(shard_idx, results)
+            finally:
+                queue.release(shard_idx)
+
+    def _ensemble_config_hash(self, model, set_type):
+        """
+        :return: hash of the models and the thresholds of an ensemble, so that shards of another config are never merged
+        """
+        params = HyperParams.get().__dict__
+        config = {
+            'models': ensemble_models[model],
+            'set_type': set_type,
+            'params': {k: v for k, v in params.items() if k.startswith('ensemble_') or k.startswith('rcnn_') or k.startswith('post_')},
+        }
+        return get_config_hash(config)
+
+    def ensemble_merge(self, model='stage1_unet', set_type='test', tag='default', workdir=None):
+        """
+        Merge results of every shard into a submission, after checking that every test id is done.
+        """
+        name = 'ensemble_%s_%s' % (tag, model)
+        workdir = workdir or os.path.join(KaggleSubmission.BASEPATH, name, 'shards')
+        queue = ShardQueue(workdir)
+        queue.check_config(self._ensemble_config_hash(model, set_type))
+
+        done = {}
+        for results in queue.results():
+            for single_id, packed in results:
+                done[single_id] = packed
+        missing = [x for x in CellImageDataManagerTest.LIST if x not in done]
+        if missing:
+            raise Exception('%d ids are not in the results, eg. %s' % (len(missing), missing[:5]))
+
+        kaggle_submit = KaggleSubmission(name)
+        failed = [x for x in CellImageDataManagerTest.LIST if done[x] is None]
+        for single_id in CellImageDataManagerTest.LIST:
+            if done[single_id] is None:
+                kaggle_submit.test_scores[single_id] = (0.0, 0.0)
+                kaggle_submit.add_result(single_id, [])
+                continue
+            instances, _ = done[single_id].unpack()
+            kaggle_submit.test_scores[single_id] = (0.0, 0.0)
+            kaggle_submit.test_instances[single_id] = done[single_id]
+            kaggle_submit.add_result(single_id, instances)
+        kaggle_submit.save()
+        logger.info('merged %d shards, %d ids' % (len(queue), len(done)))
+        if failed:
+            logger.error('%d of %d images failed, submitted with no instances. eg. %s' % (len(failed), len(done), failed[:5]))
+
     def ensemble_models_id(self, single_id, set_type='train', model='stage1_unet', show=True, verbose=True):
         self._load_ensembles(model)
         d = self._get_cell_data(single_id, set_type)
@@ -606,38 +768,27 @@ class Trainer:
 
         # TODO : RCNN Ensemble
         rcnn_ensemble = False
-        for idx, data in enumerate(self.ensembles['rcnn']):
+        for idx, source in enumerate(self.ensembles['rcnn']):
+            instances, scores = source.get(set_type, single_id)
             if set_type == 'train':
-                instances, scores = data['valid_instances'].get(single_id, (None, None))
                 rcnn_ensemble = True
-            else:
-                # TODO
-                ls = data['test_instances'].get(single_id, None)
-                if ls is None:
-                    instances = scores = None
-                else:
-                    instances = [x[0] for x in ls]
-                    scores = [x[1] for x in ls]
-                    rcnn_ensemble = True
-                    logger.debug('rcnn # instances = %d' % len(instances))
+            elif instances is not None:
+                rcnn_ensemble = True
+                logger.debug('rcnn # instances = %d' % len(instances))
 
             if instances is None:
                 logger.warning('Not found id=%s in RCNN %d Model' % (single_id, idx + 1))
                 continue
 
-            rcnn_instances.extend([instance[:d.img_h, :d.img_w] for instance in instances])
+            rcnn_instances.extend([instance.clip(d.img_h, d.img_w) for instance in instances])
             rcnn_scores.extend([s * HyperParams.get().rcnn_score_rescale for s in scores])     # rescale scores
 
         total_instances = []
         total_scores = []
 
         # TODO : UNet Ensemble
-        for idx, data in enumerate(self.ensembles['unet']):
-            if set_type == 'train':
-                instances, scores = data['valid_instances'].get(single_id, (None, None))
-            else:
-                instances, scores = data['test_instances'].get(single_id, (None, None))
-
+        for idx, source in enumerate(self.ensembles['unet']):
+            instances, scores = source.get(set_type, single_id)
             if instances is None:
                 logger.warning('Not found id=%s in UNet %d Model' % (single_id, idx + 1))
                 continue
@@ -657,13 +808,12 @@ class Trainer:
         # TODO : Voting?
         voting_th = HyperParams.get().ensemble_voting_th
 
-        rects = [get_rect_of_mask(a) for a in total_instances]
-        voted = []
-        for i, x in enumerate(total_instances):
-            voted.append(filter_by_voting((x, total_instances, voting_th, 0.3, rects[i], rects)))
+        ious = pairwise_iou(total_instances)
+        voted = filter_by_voting(ious, voting_th, 0.3)
 
         total_instances = list(compress(total_instances, voted))
         total_scores = list(compress(total_scores, voted))
+        ious = ious[voted][:, voted]
 
         watch.stop()
         logger.debug('voting elapsed=%.5f' % watch.get_elapsed())
@@ -672,52 +822,48 @@ class Trainer:
         # nms
         watch.start()
         logger.debug('nms+ size=%d' % len(total_instances))
-        instances, scores = Network.nms(total_instances, total_scores, None, thresh=HyperParams.get().ensemble_nms_iou)
+        keep = Network.nms_indices(total_scores, ious, None, thresh=HyperParams.get().ensemble_nms_iou)
+        instances = [total_instances[x] for x in keep]
+        scores = [total_scores[x] for x in keep]
+        ious = ious[keep][:, keep]
         watch.stop()
         logger.debug('nms elapsed=%.5f' % watch.get_elapsed())
         watch.reset()
 
         # high threshold if not exists in RCNN
+        ious_rcnn = pairwise_iou(instances, rcnn_instances)
         if rcnn_ensemble:
-            voted = []
-            for i, x in enumerate(instances):
-                voted.append(filter_by_voting((x, rcnn_instances, 1, 0.3, None, None)))
-
-            new_instances = []
-            new_scores = []
-            for instance, score, v in zip(instances, scores, voted):
-                if v:
-                    new_instances.append(instance)
-                    new_scores.append(score)
-                elif score > HyperParams.get().ensemble_th_no_rcnn:
-                    new_instances.append(instance)
-                    new_scores.append(score)
-            instances, scores = new_instances, new_scores
-
-        # nms with rcnn
+            voted = filter_by_voting(ious_rcnn, 1, 0.3)
+            voted = voted | (np.array(scores) > HyperParams.get().ensemble_th_no_rcnn)
+
+            instances = list(compress(instances, voted))
+            scores = list(compress(scores, voted))
+            ious = ious[voted][:, voted]
+            ious_rcnn = ious_rcnn[voted]
+
+        # nms with rcnn, reusing ious between unet instances
         instances = instances + rcnn_instances
         scores = scores + rcnn_scores
+        ious = sparse.bmat([[ious, ious_rcnn], [ious_rcnn.T, pairwise_iou(rcnn_instances)]], format='csr')
         watch.start()
         logger.debug('nms_rcnn+ size=%d' % len(instances))
-        instances, scores = Network.nms(instances, scores, None, thresh=HyperParams.get().ensemble_nms_iou)
+        instances, scores = Network.nms(instances, scores, None, thresh=HyperParams.get().ensemble_nms_iou, ious=ious)
         watch.stop()
         logger.debug('nms_rcnn- size=%d elapsed=%.5f' % (len(instances), watch.get_elapsed()))
         watch.reset()
 
         # remove overlaps
         logger.debug('remove overlaps+')
-        sorted_idx = [i[0] for i in sorted(enumerate(instances), key=lambda x: get_size_of_mask(x[1]), reverse=False)]
+        sorted_idx = [i[0] for i in sorted(enumerate(instances), key=lambda x: x[1].size, reverse=False)]
         instances = [instances[x] for x in sorted_idx]
         scores = [scores[x] for x in sorted_idx]
 
-        instances2 = [ndimage.morphology.binary_fill_holes(i) for i in instances]
+        instances2 = [i.fill_holes() for i in instances]
         instances2, scores2 = Network.remove_overlaps(instances2, scores)
 
         # remove deleted instances
         logger.debug('remove deleted+ size=%d' % len(instances2))
-        voted = []
-        for x in instances2:
-            voted.append(filter_by_voting((x, instances, 1, 0.75, None, None)))
+        voted = filter_by_voting(pairwise_iou(instances2, instances), 1, 0.75)
         instances = list(compress(instances2, voted))
         scores = list(compress(scores2, voted))
 
@@ -734,7 +880,7 @@ class Trainer:
         score_desc = []
         labels = []
         if len(d.masks) > 0:  # has label masks
-            labels = list(d.multi_masks(transpose=False))
+            labels = instances_from_label(d.multi_masks_batch())
             tp, fp, fn = get_multiple_metric(thr_list, instances, labels)
 
             logger.debug('instances=%d, labels=%d' % (len(instances), len(labels)))
@@ -773,34 +919,177 @@ class Trainer:
             }
 
 
-def do_get_multiple_metric(args):
-    thr_list, instances, multi_masks_batch = args
-    if np.max(multi_masks_batch) == 0:
-        # no label
-        label = []
-    else:
-        label = batch_to_multi_masks(multi_masks_batch, transpose=False)
-    return get_multiple_metric(thr_list, instances, label)
+def get_cell_data(single_id, set_type):
+    path, ext = get_data_source(single_id, (master_dir_train if set_type == 'train' else master_dir_test))
+    d = CellImageData(single_id, path, ext=ext, store=get_data_store())
+    if 'TCGA' in single_id or 'TNBC' in single_id:
+        # generally, TCGAs have lots of instances -> slow matching performance
+        d = center_crop(d, 224, 224, padding=0)
+    return d
 
 
-def filter_by_voting(args):
-    x, total_list, voting_th, iou_th, rect, rects = args
+class TestPipeline:
+    """
+    Process pools of Trainer.save_test_results : the load pool preprocesses test images, the post pool post-processes
+    probability maps of the network.
 
-    voted = []
-    for i2, x2 in enumerate(total_list):
-        if rect is not None and rects is not None:
-            rmin1, rmax1, cmin1, cmax1 = rect
-            rmin2, rmax2, cmin2, cmax2 = rects[i2]
+    Workers are forked when this is created, so it should be created right before the test set is predicted, and
+    closed after it. Workers run no tensorflow ops. The preprocessing function is passed to each load worker by the
+    pool initializer.
+    """
+    def __init__(self, preprocess, processes=8):
+        """
+        :param preprocess: function of CellImageData, eg. preprocess of the network
+        """
+        self.load_pool = Pool(processes=max(1, processes // 2), initializer=_pipeline_init, initargs=(preprocess, ))
+        self.post_pool = Pool(processes=processes)
 
-            overlap_r = (rmin1 <= rmin2 <= rmax1 or rmin1 <= rmax2 <= rmax1) or (rmin2 <= rmin1 <= rmax2 or rmin2 <= rmax1 <= rmax2)
-            overlap_c = (cmin1 <= cmin2 <= cmax1 or cmin1 <= cmax2 <= cmax1) or (cmin2 <= cmin1 <= cmax2 or cmin2 <= cmax1 <= cmax2)
+    def close(self):
+        for pool in [self.load_pool, self.post_pool]:
+            pool.close()
+            pool.join()
+
+    def terminate(self):
+        """
+        Stop workers without finishing pending tasks, eg. on an error. close() should follow it.
+        """
+        for pool in [self.load_pool, self.post_pool]:
+            pool.terminate()
 
-            if not (overlap_r and overlap_c):
-                voted.append(0)
-                continue
-        voted.append(1 if get_iou(x, x2) > iou_th else 0)
 
-    return sum(voted) >= voting_th
+# preprocessing function of a load worker, set by its initializer. see TestPipeline
+_pipeline_preprocess = None
+
+
+def _pipeline_init(preprocess):
+    global _pipeline_preprocess
+    _pipeline_preprocess = preprocess
+
+
+def _pipeline_load(single_id):
+    """
+    :return: (single_id, preprocessed image, (h, w) of the original, error message or None)
+    """
+    try:
+        d = get_cell_data(single_id, 'test')
+        h, w = d.img.shape[:2]
+        d = _pipeline_preprocess(d)
+        return single_id, d.image(is_gray=False), (h, w), None
+    except Exception as e:
+        return single_id, None, None, str(e)
+
+
+def _pipeline_postprocess(args):
+    """
+    Post-process views of an image, and visualize it.
+    :return: (PackedInstances of the original size, visualized image)
+    """
+    image, (h, w), views, num_views = args
+    instances, scores = postprocess_views(views, (h, w), num_views)
+    image = cv2.resize(image, (w, h), interpolation=cv2.INTER_AREA)
+    img_vis = Network.visualize(image, None, instances, None)
+
+    instances = Network.resize_instances(instances, (h, w))
+    return PackedInstances.pack(instances, scores, shape=(h, w)), img_vis
+
+
+def _ensemble_worker(args):
+    model, set_type, tag, workdir = args
+    Trainer().ensemble_worker(model, set_type, tag, workdir)
+
+
+def do_get_multiple_metric(args):
+    thr_list, instances, multi_masks_batch = args
+    if np.max(multi_masks_batch) == 0:
+        # no label
+        return get_multiple_metric(thr_list, instances, [])
+    label_pred = paint_instances([to_instance(x) for x in instances], multi_masks_batch.shape[:2])
+    return get_label_metric(label_pred, multi_masks_batch, thr_list)
+
+
+def get_ambiguity(prob, margin, cutoff=0.5):
+    """
+    :return: ratio of uncertain pixels, |prob - cutoff| < margin, to the pixels which may be foreground
+    """
+    uncertain = np.count_nonzero(np.abs(prob - cutoff) < margin)
+    return uncertain / max(np.count_nonzero(prob > cutoff - margin), 1)
+
+
+def get_stability(instances, instances_other, iou_th=0.5):
+    """
+    :return: ratio of instances found in the other view, with iou > iou_th
+    """
+    if len(instances) == 0 or len(instances_other) == 0:
+        return 1.0 if len(instances) == len(instances_other) else 0.0
+    ious = pairwise_iou(instances, instances_other)
+    return np.count_nonzero(ious.max(axis=1).toarray().ravel() > iou_th) / len(instances)
+
+
+def parse_view(prob, size):
+    """
+    Instances are extracted at the resolution of the view, with post_cutoff_max_th, post_cutoff_avg_th and
+    post_dilation_iter, and resized to the original size afterwards.
+    :param size: (h, w) of the original image
+    :return: (instances, scores) of a probability map
+    """
+    instances, scores = Network.parse_merged_output(
+        prob, cutoff=0.5,
+        cutoff_instance_max=HyperParams.get().post_cutoff_max_th,
+        cutoff_instance_avg=HyperParams.get().post_cutoff_avg_th
+    )
+    return Network.resize_instances(instances, size), scores
+
+
+def postprocess_views(views, size, num_views=6):
+    """
+    :param views: list of (from_set, prob, (instances, scores) or None) as Trainer.inference_views
+    :param size: (h, w) of the original image
+    :return: (instances, scores) merged over the views
+    """
+    total_instances, total_scores, total_from_set = [], [], []
+    for from_set, prob, parsed in views:
+        instances, scores = parsed if parsed is not None else parse_view(prob, size)
+        total_instances = total_instances + instances
+        total_scores = total_scores + scores
+        total_from_set = total_from_set + [from_set] * len(instances)
+    return merge_instances(total_instances, total_scores, total_from_set, num_views)
+
+
+def merge_instances(total_instances, total_scores, total_from_set, num_views=6):
+    """
+    Merge instances of test-time augmentation views, by voting, nms and removing overlaps.
+    post_voting_th, test_aug_nms_iou are read from HyperParams.
+    :param total_from_set: view of each instance, 1~6
+    :param num_views: # of views run. votes are out of 6 views, and scaled down when some are skipped
+    :return: (instances, scores)
+    """
+    voting_th = max(1, int(math.ceil(HyperParams.get().post_voting_th * num_views / 6.0)))
+    ious = pairwise_iou(total_instances)
+    voted = filter_by_voting(ious, voting_th, 0.3)
+
+    total_instances = list(compress(total_instances, voted))
+    total_scores = list(compress(total_scores, voted))
+    total_from_set = list(compress(total_from_set, voted))
+    ious = ious[voted][:, voted]
+
+    instances, scores = Network.nms(total_instances, total_scores, total_from_set, thresh=HyperParams.get().test_aug_nms_iou, ious=ious)
+
+    # remove overlaps
+    sorted_idx = [i[0] for i in sorted(enumerate(instances), key=lambda x: x[1].size, reverse=True)]
+    instances = [instances[x] for x in sorted_idx]
+    scores = [scores[x] for x in sorted_idx]
+
+    instances = [i.fill_holes() for i in instances]
+    return Network.remove_overlaps(instances, scores)
+
+
+def filter_by_voting(ious, voting_th, iou_th):
+    """
+    :param ious: sparse (n, m) iou matrix between instances and voters, as pairwise_iou()
+    :return: bool array of n, True if an instance overlaps at least voting_th voters with iou > iou_th.
+    """
+    votes = np.asarray((ious > iou_th).sum(axis=1)).ravel()
+    return votes >= voting_th
 
 
 if __name__ == '__main__':